@@ -1,14 +1,35 @@
 import os
 import io
+import json
 import time
 import base64
+import contextvars
+import hashlib
+import math
+import random
 import re
+import threading
+import uuid
+from abc import ABC, abstractmethod
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional, Literal
+from difflib import SequenceMatcher
+from functools import lru_cache
+from itertools import chain, count
+from typing import Any, Callable, Iterator, Optional, Literal
 
+import numpy as np
 import requests
 import streamlit as st
-from openai import OpenAI
+from streamlit.errors import StreamlitAPIException
+from openai import APITimeoutError, OpenAI
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from PIL import Image
 
@@ -302,10 +323,25 @@ def getStyleInstruction(styleMode: StyleMode) -> str:
 """
 
 
+@lru_cache(maxsize=32)
+def build_style_instruction(style_mode: Optional[str]) -> str:
+    return getStyleInstruction(normalize_style_mode(style_mode)).strip()
+
+
+@lru_cache(maxsize=32)
 def build_system_prompt(style_mode: Optional[str]) -> str:
-    mode = normalize_style_mode(style_mode)
-    style_instruction = getStyleInstruction(mode).strip()
-    return f"{BASE_PROMPT}\n\n{style_instruction}"
+    # 某一风格下完整的指令文本，用作提示词版本指纹；实际发送时按 build_analysis_messages 的顺序排布。
+    return f"{BASE_PROMPT}\n\n{build_style_instruction(style_mode)}"
+
+
+def build_analysis_messages(user_content: str, style_mode: Optional[str]) -> list[dict]:
+    # 上游（DeepSeek）按请求前缀做上下文缓存：
+    # - system 只放所有用户、所有风格都逐字节相同的 BASE_PROMPT
+    # - 风格指令放在聊天记录之后，同一段记录切换风格 / 后台预生成时，BASE_PROMPT + 聊天记录 整段都能命中缓存
+    return [
+        {"role": "system", "content": BASE_PROMPT},
+        {"role": "user", "content": f"{user_content}\n\n{build_style_instruction(style_mode)}"},
+    ]
 
 
 TIMESTAMP_RE = re.compile(
@@ -318,6 +354,9 @@ TIMESTAMP_RE = re.compile(
     r"|(?:今天|昨天|前天)(?:\s*\d{1,2}:\d{2})?"
     r")$"
 )
+# 数字另用 str.isdecimal 判断：它和正则里的 \d 一样覆盖全角等所有 Unicode 数字
+TIMESTAMP_FIRST_CHARS = frozenset("上下星今昨前")
+WHITESPACE_RE = re.compile(r"\s+")
 
 
 def sanitize_report_markdown(report: str) -> str:
@@ -335,19 +374,108 @@ def sanitize_report_markdown(report: str) -> str:
     return "\n".join(lines).strip()
 
 
+def sanitize_partial_report_markdown(partial: str) -> str:
+    # 流式输出时首行标题可能只吐出一半（如 "### 👑 Sober"），
+    # 此时还无法判断是否为重复标题，先不渲染，等整行到齐再交给 sanitize_report_markdown。
+    stripped = (partial or "").lstrip()
+    if stripped.startswith("#") and "\n" not in stripped:
+        return ""
+    return sanitize_report_markdown(partial)
+
+
+# 报告固定的六个小节（见 BASE_PROMPT 的 Output Format），按编号识别，不依赖前面的 emoji
+REPORT_SECTION_RE = re.compile(r"^#{2,6}\s*\S*?\s*([1-6])\s*[.．、]\s*(.+?)\s*$")
+REPORT_SECTION_COUNT = 6
+
+
+@dataclass
+class ReportSection:
+    number: int
+    title: str
+    body: str
+
+
+@dataclass
+class ParsedReport:
+    # preamble 是第一个小节之前的内容（免责声明等），sections 按报告中出现的顺序排列
+    preamble: str
+    sections: list[ReportSection]
+
+    def section(self, number: int) -> Optional[ReportSection]:
+        return next((s for s in self.sections if s.number == number), None)
+
+    def is_complete(self) -> bool:
+        return {s.number for s in self.sections} == set(range(1, REPORT_SECTION_COUNT + 1))
+
+    def replace(self, number: int, body: str) -> "ParsedReport":
+        sections = [ReportSection(s.number, s.title, body.strip()) if s.number == number else s for s in self.sections]
+        return ParsedReport(self.preamble, sections)
+
+    def to_markdown(self) -> str:
+        parts = [self.preamble] if self.preamble else []
+        parts += [f"#### {s.title}\n{s.body}".strip() for s in self.sections]
+        return "\n\n".join(parts).strip()
+
+    def to_dict(self) -> dict:
+        return {
+            "preamble": self.preamble,
+            "sections": [{"number": s.number, "title": s.title, "body": s.body} for s in self.sections],
+        }
+
+
+def parse_report(report: str) -> ParsedReport:
+    preamble: list[str] = []
+    sections: list[tuple[int, str, list[str]]] = []
+    seen: set[int] = set()
+    for line in (report or "").splitlines():
+        m = REPORT_SECTION_RE.match(line.strip())
+        # 同一编号再次出现时当正文处理，避免正文里的小标题把小节切乱
+        if m and int(m.group(1)) not in seen:
+            seen.add(int(m.group(1)))
+            sections.append((int(m.group(1)), line.strip().lstrip("#").strip(), []))
+        elif sections:
+            sections[-1][2].append(line)
+        else:
+            preamble.append(line)
+    return ParsedReport(
+        preamble="\n".join(preamble).strip(),
+        sections=[ReportSection(number, title, "\n".join(body).strip()) for number, title, body in sections],
+    )
+
+
 def get_secret(key: str) -> Optional[str]:
     try:
         value = st.secrets.get(key)
     except Exception:
         value = None
+    # 脱离 Streamlit 运行（批处理 / 服务）时从环境变量读取
+    if value is None:
+        value = os.environ.get(key)
     return value
 
 
-def require_secret(key: str) -> str:
+def get_int_setting(key: str, default: int) -> int:
+    value = get_secret(key)
+    if value is None or str(value).strip() == "":
+        return default
     try:
-        value = st.secrets[key]
-    except Exception:
-        raise RuntimeError(f"missing_secret:{key}")
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def get_float_setting(key: str, default: float) -> float:
+    value = get_secret(key)
+    if value is None or str(value).strip() == "":
+        return default
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def require_secret(key: str) -> str:
+    value = get_secret(key)
     if value is None:
         raise RuntimeError(f"missing_secret:{key}")
     value_str = str(value).strip()
@@ -360,13 +488,678 @@ def get_deepseek_api_key() -> Optional[str]:
     return require_secret("DEEPSEEK_API_KEY")
 
 
+def build_http_session(pool_size: int, max_retries: int, backoff_factor: float) -> requests.Session:
+    # POST 只重试建连失败（请求还没发出去）；读超时和 429/5xx 由调用方自己的退避循环重试，
+    # 这样每次重发都重新经过限流与熔断，也受端到端预算约束
+    retry_kwargs: dict[str, Any] = {
+        "total": max_retries,
+        "connect": max_retries,
+        "read": max_retries,
+        "status": max_retries,
+        "backoff_factor": backoff_factor,
+        "status_forcelist": (429, 500, 502, 503, 504),
+        "allowed_methods": frozenset({"GET"}),
+        "respect_retry_after_header": True,
+        "raise_on_status": False,
+    }
+    try:
+        retry = Retry(**retry_kwargs, backoff_jitter=backoff_factor)
+    except TypeError:
+        # urllib3 < 2 没有 backoff_jitter，退化为不带抖动的指数退避
+        retry = Retry(**retry_kwargs)
+
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+@st.cache_resource(show_spinner=False)
+def get_baidu_http_session() -> requests.Session:
+    return build_http_session(
+        pool_size=get_int_setting("BAIDU_HTTP_POOL_SIZE", 16),
+        max_retries=get_int_setting("BAIDU_HTTP_MAX_RETRIES", 2),
+        backoff_factor=get_float_setting("BAIDU_HTTP_BACKOFF_SECONDS", 0.5),
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def get_openai_client(api_key: str, base_url: str, max_retries: int, timeout: float) -> OpenAI:
+    # SDK 自带连接池与 429/5xx 的指数退避重试（含抖动），这里只负责让客户端长期复用。
+    return OpenAI(
+        api_key=api_key,
+        base_url=base_url,
+        max_retries=max_retries,
+        timeout=timeout,
+    )
+
+
 def build_client() -> OpenAI:
     api_key = get_deepseek_api_key()
     base_url = get_secret("DEEPSEEK_BASE_URL")
 
-    return OpenAI(
-        api_key=api_key,
-        base_url=base_url or "https://api.deepseek.com/v1",
+    return get_openai_client(
+        str(api_key),
+        str(base_url or "https://api.deepseek.com/v1"),
+        get_int_setting("DEEPSEEK_MAX_RETRIES", 2),
+        get_float_setting("DEEPSEEK_TIMEOUT_SECONDS", 60),
+    )
+
+
+CURRENT_SESSION: ContextVar[str] = ContextVar("sq_session", default="anonymous")
+
+
+def submit_with_context(pool: ThreadPoolExecutor, fn: Callable[..., Any], *args: Any) -> Future:
+    # 工作线程继承提交方的 contextvars（会话标识等），上游限流才能按会话公平排队
+    return pool.submit(contextvars.copy_context().run, fn, *args)
+
+
+class FairRateLimiter:
+    # 进程级令牌桶，每个上游一个实例，所有会话共用配额：
+    # - 等待中的请求按会话分队，轮到的会话拿到令牌后排到队尾，多个会话轮流放行，
+    #   一个会话一次上传 20 张截图也不会把其他会话挤到最后；
+    # - 排队总数超过 max_queue 或等待超过 timeout_seconds 时抛 rate_limited，形成背压。
+    def __init__(
+        self,
+        name: str,
+        rate_per_second: float,
+        burst: float = 0,
+        max_queue: int = 200,
+        timeout_seconds: float = 120,
+    ) -> None:
+        self.name = name
+        self.rate = float(rate_per_second)
+        self.capacity = float(burst) if burst > 0 else max(1.0, self.rate)
+        self.max_queue = int(max_queue)
+        self.timeout_seconds = float(timeout_seconds)
+        self.waiting = 0
+        self.granted = 0
+        self.rejected = 0
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._queues: "OrderedDict[str, deque[object]]" = OrderedDict()
+        self._cond = threading.Condition()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _position(self, session_id: str, ticket: object) -> int:
+        # 按轮转顺序模拟放行：第 k 轮放行每个会话的第 k 个请求
+        sessions = list(self._queues.items())
+        rank = next(i for i, (sid, _) in enumerate(sessions) if sid == session_id)
+        k = self._queues[session_id].index(ticket)
+        ahead = sum(min(len(q), k) for _, q in sessions)
+        ahead += sum(1 for _, q in sessions[:rank] if len(q) > k)
+        return ahead + 1
+
+    def _release_ticket(self, session_id: str, ticket: object) -> None:
+        queue = self._queues.pop(session_id)
+        queue.remove(ticket)
+        if queue:
+            self._queues[session_id] = queue
+        self.waiting -= 1
+        self._cond.notify_all()
+
+    def acquire(self, session_id: Optional[str] = None, on_wait: Optional[Callable[[int], None]] = None) -> None:
+        if self.rate <= 0:
+            return
+        session_id = session_id or CURRENT_SESSION.get()
+        ticket = object()
+        with self._cond:
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise RuntimeError(f"rate_limited:{self.name}")
+            self._queues.setdefault(session_id, deque()).append(ticket)
+            self.waiting += 1
+            deadline = time.monotonic() + self.timeout_seconds
+            budget = CURRENT_DEADLINE.get()
+            if budget is not None:
+                deadline = min(deadline, budget)
+            last_position = 0
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    is_head = next(iter(self._queues)) == session_id and self._queues[session_id][0] is ticket
+                    if is_head and self._tokens >= 1:
+                        self._tokens -= 1
+                        self.granted += 1
+                        return
+                    if now >= deadline:
+                        self.rejected += 1
+                        raise RuntimeError(f"rate_limited:{self.name}")
+                    if on_wait is not None:
+                        position = self._position(session_id, ticket)
+                        if position != last_position:
+                            last_position = position
+                            # 回调可能要刷新界面，放开锁再调用
+                            self._cond.release()
+                            try:
+                                on_wait(position)
+                            finally:
+                                self._cond.acquire()
+                            continue
+                    timeout = (1 - self._tokens) / self.rate if is_head else 0.5
+                    self._cond.wait(max(0.001, min(timeout, 0.5, deadline - now)))
+            finally:
+                self._release_ticket(session_id, ticket)
+
+    def queue_position(self, session_id: Optional[str] = None) -> Optional[int]:
+        session_id = session_id or CURRENT_SESSION.get()
+        with self._cond:
+            queue = self._queues.get(session_id)
+            if not queue:
+                return None
+            return self._position(session_id, queue[0])
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "name": self.name,
+                "rate": self.rate,
+                "waiting": self.waiting,
+                "sessions": len(self._queues),
+                "granted": self.granted,
+                "rejected": self.rejected,
+            }
+
+
+# 上游名 -> (QPS 配置项, 默认 QPS)；百度 OCR 免费额度为 2 QPS，<=0 表示不限流
+UPSTREAM_RATE_SETTINGS = {
+    "baidu_token": ("BAIDU_TOKEN_QPS", 1.0),
+    "baidu_ocr": ("BAIDU_OCR_QPS", 2.0),
+    "llm": ("LLM_QPS", 5.0),
+}
+
+
+@st.cache_resource(show_spinner=False)
+def get_upstream_limiter(name: str) -> FairRateLimiter:
+    setting, default_qps = UPSTREAM_RATE_SETTINGS[name]
+    qps = get_float_setting(setting, default_qps)
+    return FairRateLimiter(
+        name,
+        rate_per_second=qps,
+        burst=get_float_setting(f"{setting}_BURST", 0),
+        max_queue=get_int_setting("UPSTREAM_MAX_QUEUE", 200),
+        timeout_seconds=get_float_setting("UPSTREAM_QUEUE_TIMEOUT_SECONDS", 120),
+    )
+
+
+CURRENT_DEADLINE: ContextVar[Optional[float]] = ContextVar("sq_deadline", default=None)
+
+
+@contextmanager
+def deadline_scope(seconds: float) -> Iterator[None]:
+    # 端到端预算（time.monotonic 截止时间）：嵌套时取更早的那个，工作线程经 submit_with_context 继承
+    deadline = time.monotonic() + seconds if seconds > 0 else None
+    current = CURRENT_DEADLINE.get()
+    if current is not None and (deadline is None or current < deadline):
+        deadline = current
+    token = CURRENT_DEADLINE.set(deadline)
+    try:
+        yield
+    finally:
+        CURRENT_DEADLINE.reset(token)
+
+
+def remaining_time(stage_timeout: Optional[float] = None) -> Optional[float]:
+    # 单个阶段的超时 = min(阶段上限, 端到端剩余预算)；预算已用完直接失败，不再发请求
+    deadline = CURRENT_DEADLINE.get()
+    if deadline is None:
+        return stage_timeout
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise RuntimeError("deadline_exceeded")
+    return left if stage_timeout is None else min(stage_timeout, left)
+
+
+@st.cache_resource(show_spinner=False)
+def get_llm_slots() -> threading.BoundedSemaphore:
+    # 进程级 LLM 并发上限：前台报告、分段提炼、单节重写和后台预生成共用同一组名额
+    return threading.BoundedSemaphore(max(1, get_int_setting("LLM_MAX_CONCURRENCY", 8)))
+
+
+@contextmanager
+def llm_slot() -> Iterator[None]:
+    slots = get_llm_slots()
+    if not slots.acquire(timeout=remaining_time(get_float_setting("LLM_SLOT_TIMEOUT_SECONDS", 60))):
+        raise RuntimeError("rate_limited:llm_concurrency")
+    try:
+        yield
+    finally:
+        slots.release()
+
+
+# 百度返回的业务错误里属于调用方自己的问题：无权限（6）、配额用尽（17/19）、token 无效或过期（110/111）、图片或参数不合规（216xxx）
+BAIDU_CALLER_ERROR_PREFIXES = tuple(f"baidu_ocr_error:{code}:" for code in (6, 17, 19, 110, 111)) + ("baidu_ocr_error:216",)
+
+
+def upstream_http_error(prefix: str, status: int) -> RuntimeError:
+    # 带上状态码，熔断器据此把 4xx 当成调用方问题
+    e = RuntimeError(f"{prefix}_{status}")
+    e.status_code = status
+    return e
+
+
+def counts_as_upstream_failure(e: Exception) -> bool:
+    # 排队超时、熔断本身和调用方的问题（凭证、配额、图片不合规、4xx）不算上游故障
+    if isinstance(e, RuntimeError) and str(e).startswith(("rate_limited:", "circuit_open:") + BAIDU_CALLER_ERROR_PREFIXES):
+        return False
+    status = getattr(e, "status_code", None)
+    if isinstance(status, int) and 400 <= status < 500 and status != 429:
+        return False
+    return True
+
+
+class CircuitBreaker:
+    # 连续失败 failure_threshold 次后熔断 reset_seconds，期间直接抛 circuit_open 快速失败；
+    # 冷却结束后放一个探测请求（半开），成功则恢复，失败则重新熔断。
+    def __init__(self, name: str, failure_threshold: int = 5, reset_seconds: float = 30) -> None:
+        self.name = name
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.reset_seconds = float(reset_seconds)
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probe_started: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "open" if time.monotonic() - self.opened_at < self.reset_seconds else "half_open"
+
+    def retry_after(self) -> float:
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.reset_seconds - (time.monotonic() - self.opened_at))
+
+    def _is_blocked(self, now: float) -> bool:
+        if self.opened_at is None:
+            return False
+        if now - self.opened_at < self.reset_seconds:
+            return True
+        return self._probe_started is not None and now - self._probe_started < self.reset_seconds
+
+    def is_open(self) -> bool:
+        # 只读查询：此刻发请求会不会被拒（熔断冷却中，或半开且探测请求还没结束）
+        return self._is_blocked(time.monotonic())
+
+    def check(self) -> None:
+        # 只检查、不占用探测名额：进入限流队列之前先快速失败
+        if self.is_open():
+            raise RuntimeError(f"circuit_open:{self.name}")
+
+    def before_call(self) -> None:
+        with self._lock:
+            if self.opened_at is None:
+                return
+            now = time.monotonic()
+            if self._is_blocked(now):
+                raise RuntimeError(f"circuit_open:{self.name}")
+            self._probe_started = now
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probe_started = None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._probe_started is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._probe_started = None
+
+    @contextmanager
+    def guard(self) -> Iterator[None]:
+        self.before_call()
+        try:
+            yield
+        except Exception as e:
+            if counts_as_upstream_failure(e):
+                self.record_failure()
+            else:
+                with self._lock:
+                    self._probe_started = None
+            raise
+        else:
+            self.record_success()
+        finally:
+            # 调用方中途放弃（例如关闭生成器）时释放探测名额
+            if self._probe_started is not None and self.opened_at is not None:
+                with self._lock:
+                    self._probe_started = None
+
+    def stats(self) -> dict:
+        return {"name": self.name, "state": self.state, "failures": self.failures, "retry_after": round(self.retry_after(), 1)}
+
+
+@st.cache_resource(show_spinner=False)
+def get_circuit_breaker(name: str) -> CircuitBreaker:
+    return CircuitBreaker(
+        name,
+        failure_threshold=get_int_setting("CIRCUIT_FAILURE_THRESHOLD", 5),
+        reset_seconds=get_float_setting("CIRCUIT_RESET_SECONDS", 30),
+    )
+
+
+class LatencyWindow:
+    # 最近 max_samples 次耗时，用来估计对冲请求的触发延迟（p95）
+    def __init__(self, max_samples: int = 200) -> None:
+        self._samples: deque[float] = deque(maxlen=max_samples)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q: float, min_samples: int = 20) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < min_samples:
+                return None
+            return float(np.percentile(np.fromiter(self._samples, dtype=float), q))
+
+
+@st.cache_resource(show_spinner=False)
+def get_latency_window(name: str) -> LatencyWindow:
+    return LatencyWindow()
+
+
+@st.cache_resource(show_spinner=False)
+def get_hedge_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(
+        max_workers=max(2, get_int_setting("LLM_HEDGE_MAX_WORKERS", 16)),
+        thread_name_prefix="sq-hedge",
+    )
+
+
+def hedge_delay(latency_name: str) -> Optional[float]:
+    # 未开启对冲时返回 None；样本不足时用固定延迟，否则取 p95 且不低于下限
+    if not get_int_setting("LLM_HEDGE_ENABLED", 0):
+        return None
+    p95 = get_latency_window(latency_name).percentile(95)
+    if p95 is None:
+        return get_float_setting("LLM_HEDGE_DELAY_SECONDS", 10)
+    return max(get_float_setting("LLM_HEDGE_MIN_DELAY_SECONDS", 2), p95)
+
+
+def hedged_call(
+    primary: Callable[[], Any],
+    hedge: Callable[[], Any],
+    hedge_after: float,
+    on_discard: Optional[Callable[[Any], None]] = None,
+) -> Any:
+    # 对冲请求：主请求 hedge_after 秒内没有结果就再发一个，取先成功的那个；
+    # 落败的一方完成后交给 on_discard 清理（例如关闭流）。
+    executor = get_hedge_executor()
+    futures = [submit_with_context(executor, primary)]
+    hedged = False
+    errors: list[BaseException] = []
+
+    def discard(future: Future) -> None:
+        if on_discard is not None and not future.cancelled() and future.exception() is None:
+            on_discard(future.result())
+
+    while futures:
+        budget = remaining_time()
+        timeout = budget if hedged else (hedge_after if budget is None else min(hedge_after, budget))
+        done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+        if not done:
+            if hedged or (budget is not None and budget <= hedge_after):
+                for future in futures:
+                    future.add_done_callback(discard)
+                raise RuntimeError("deadline_exceeded")
+            futures.append(submit_with_context(executor, hedge))
+            hedged = True
+            continue
+        for future in done:
+            futures.remove(future)
+            if future.exception() is None:
+                for other in futures:
+                    other.add_done_callback(discard)
+                return future.result()
+            errors.append(future.exception())
+        if not hedged:
+            break
+    raise errors[0]
+
+
+CURRENT_TRACE: ContextVar[Optional["Trace"]] = ContextVar("sq_trace", default=None)
+CURRENT_SPAN_ID: ContextVar[Optional[int]] = ContextVar("sq_span", default=None)
+_span_ids = count(1)
+
+
+class Trace:
+    # 一次截图识别或一次诊断的各阶段耗时；工作线程里的 span 经 submit_with_context 汇总到同一个 trace
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.started_at = time.time()
+        self.started = time.monotonic()
+        self.duration = 0.0
+        self.spans: list[dict] = []
+        self._lock = threading.Lock()
+
+    def add(self, span_record: dict) -> None:
+        with self._lock:
+            self.spans.append(span_record)
+
+    def breakdown(self) -> list[dict]:
+        # 按阶段汇总；并发阶段（多张截图、多个分块）的累计耗时可能超过整体耗时
+        rows: dict[str, dict] = {}
+        with self._lock:
+            spans = list(self.spans)
+        for record in spans:
+            row = rows.setdefault(record["name"], {"stage": record["name"], "count": 0, "total_ms": 0.0, "max_ms": 0.0, "errors": 0})
+            row["count"] += 1
+            row["total_ms"] = round(row["total_ms"] + record["duration_ms"], 2)
+            row["max_ms"] = max(row["max_ms"], record["duration_ms"])
+            row["errors"] += 1 if record.get("error") else 0
+        return sorted(rows.values(), key=lambda row: row["total_ms"], reverse=True)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            spans = list(self.spans)
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started_at": datetime.fromtimestamp(self.started_at).isoformat(timespec="milliseconds"),
+            "duration_ms": round(self.duration * 1000, 2),
+            "spans": spans,
+        }
+
+
+def _finish_span(
+    name: str,
+    span_id: int,
+    parent_id: Optional[int],
+    started: float,
+    duration: float,
+    attrs: dict,
+    error: Optional[str],
+) -> None:
+    get_metrics().observe(name, duration, attrs, error)
+    trace = CURRENT_TRACE.get()
+    if trace is None:
+        return
+    record = {
+        "name": name,
+        "span_id": span_id,
+        "parent_id": parent_id,
+        "offset_ms": round((started - trace.started) * 1000, 2),
+        "duration_ms": round(duration * 1000, 2),
+        "thread": threading.current_thread().name,
+        **attrs,
+    }
+    if error:
+        record["error"] = error
+    trace.add(record)
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[dict]:
+    # 记录一个阶段的耗时；调用方可以往 yield 出来的 dict 里补充字节数、token 用量等属性
+    span_id = next(_span_ids)
+    parent_id = CURRENT_SPAN_ID.get()
+    token = CURRENT_SPAN_ID.set(span_id)
+    started = time.monotonic()
+    error: Optional[str] = None
+    try:
+        yield attrs
+    except Exception as e:
+        error = str(e)[:200] if isinstance(e, RuntimeError) else type(e).__name__
+        raise
+    finally:
+        CURRENT_SPAN_ID.reset(token)
+        _finish_span(name, span_id, parent_id, started, time.monotonic() - started, attrs, error)
+
+
+def record_span(name: str, started: float, attrs: Optional[dict] = None, error: Optional[str] = None) -> None:
+    # 不改动当前 span 的版本：给生成器这类跨多次 yield 的阶段用
+    _finish_span(name, next(_span_ids), CURRENT_SPAN_ID.get(), started, time.monotonic() - started, attrs or {}, error)
+
+
+@contextmanager
+def start_trace(name: str, detached: bool = False) -> Iterator[Trace]:
+    # 已经在 trace 里时沿用外层（界面调用库函数的情况）；detached 强制新开（后台预生成）
+    current = CURRENT_TRACE.get()
+    if current is not None and not detached:
+        yield current
+        return
+    trace = Trace(name)
+    trace_token = CURRENT_TRACE.set(trace)
+    span_token = CURRENT_SPAN_ID.set(None)
+    try:
+        with span(name):
+            yield trace
+    finally:
+        trace.duration = time.monotonic() - trace.started
+        CURRENT_SPAN_ID.reset(span_token)
+        CURRENT_TRACE.reset(trace_token)
+        get_telemetry_sink().write_trace(trace)
+
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# span 属性里这些数值会累加成计数器
+COUNTED_SPAN_ATTRS = ("bytes", "prompt_tokens", "completion_tokens", "prompt_cache_hit_tokens", "prompt_cache_miss_tokens")
+
+
+class MetricsRegistry:
+    def __init__(self, buckets: tuple[float, ...] = STAGE_BUCKETS) -> None:
+        self.buckets = buckets
+        self._histograms: dict[str, dict] = {}
+        self._errors: dict[str, int] = {}
+        self._counters: dict[tuple[str, str], float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float, attrs: dict, error: Optional[str]) -> None:
+        with self._lock:
+            hist = self._histograms.get(stage)
+            if hist is None:
+                hist = self._histograms[stage] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    hist["buckets"][i] += 1
+            hist["sum"] += seconds
+            hist["count"] += 1
+            if error:
+                self._errors[stage] = self._errors.get(stage, 0) + 1
+            for key in COUNTED_SPAN_ATTRS:
+                value = attrs.get(key)
+                if isinstance(value, (int, float)):
+                    self._counters[(key, stage)] = self._counters.get((key, stage), 0) + value
+
+    def render(self) -> str:
+        lines = [
+            "# HELP sq_stage_duration_seconds Time spent per pipeline stage.",
+            "# TYPE sq_stage_duration_seconds histogram",
+        ]
+        with self._lock:
+            for stage, hist in sorted(self._histograms.items()):
+                for bound, value in zip(self.buckets, hist["buckets"]):
+                    lines.append(f'sq_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {value}')
+                lines.append(f'sq_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {hist["count"]}')
+                lines.append(f'sq_stage_duration_seconds_sum{{stage="{stage}"}} {hist["sum"]:.6f}')
+                lines.append(f'sq_stage_duration_seconds_count{{stage="{stage}"}} {hist["count"]}')
+            lines += ["# HELP sq_stage_errors_total Failed stage executions.", "# TYPE sq_stage_errors_total counter"]
+            lines += [f'sq_stage_errors_total{{stage="{stage}"}} {value}' for stage, value in sorted(self._errors.items())]
+            for key in COUNTED_SPAN_ATTRS:
+                rows = sorted((stage, value) for (name, stage), value in self._counters.items() if name == key)
+                if rows:
+                    lines += [f"# TYPE sq_{key}_total counter"]
+                    lines += [f'sq_{key}_total{{stage="{stage}"}} {value:g}' for stage, value in rows]
+        return "\n".join(lines) + "\n"
+
+
+@st.cache_resource(show_spinner=False)
+def get_metrics() -> MetricsRegistry:
+    return MetricsRegistry()
+
+
+def render_metrics() -> str:
+    # 阶段耗时之外，再附上限流队列、熔断和缓存的即时状态
+    lines = [get_metrics().render().rstrip("\n")]
+    lines += ["# TYPE sq_upstream_queue_waiting gauge", "# TYPE sq_circuit_open gauge"]
+    for name in UPSTREAM_RATE_SETTINGS:
+        lines.append(f'sq_upstream_queue_waiting{{upstream="{name}"}} {get_upstream_limiter(name).stats()["waiting"]}')
+        lines.append(f'sq_circuit_open{{upstream="{name}"}} {int(get_circuit_breaker(name).state != "closed")}')
+    router_stats = get_ocr_router().stats()
+    lines += ["# TYPE sq_ocr_backend_latency_seconds gauge", "# TYPE sq_ocr_backend_routed_total counter"]
+    for name, backend_stats in router_stats["backends"].items():
+        lines.append(f'sq_ocr_backend_latency_seconds{{backend="{name}"}} {backend_stats["ewma_seconds_per_unit"]}')
+        lines.append(f'sq_ocr_backend_routed_total{{backend="{name}"}} {backend_stats["routed"]}')
+    lines += ["# TYPE sq_ocr_fallbacks_total counter", f"sq_ocr_fallbacks_total {router_stats['fallbacks']}"]
+    lines += ["# TYPE sq_cache_hits_total counter", "# TYPE sq_cache_misses_total counter"]
+    for cache_name, cache in (("ocr", get_ocr_cache().memory), ("report", get_report_cache()), ("chunk_notes", get_chunk_notes_cache())):
+        stats = cache.stats()
+        lines.append(f'sq_cache_hits_total{{cache="{cache_name}"}} {stats["hits"]}')
+        lines.append(f'sq_cache_misses_total{{cache="{cache_name}"}} {stats["misses"]}')
+    return "\n".join(lines) + "\n"
+
+
+class TelemetrySink:
+    # TRACE_LOG_PATH：每个 trace 追加一行 JSON；METRICS_PATH：定期整体重写一次指标文本（node_exporter textfile 格式）
+    def __init__(self, trace_log_path: Optional[str], metrics_path: Optional[str], metrics_interval_seconds: float) -> None:
+        self.trace_log_path = trace_log_path
+        self.metrics_path = metrics_path
+        self.metrics_interval_seconds = float(metrics_interval_seconds)
+        self._last_metrics_write = 0.0
+        self._lock = threading.Lock()
+
+    def write_trace(self, trace: Trace) -> None:
+        try:
+            if self.trace_log_path:
+                line = json.dumps(trace.to_dict(), ensure_ascii=False)
+                with self._lock, open(self.trace_log_path, "a", encoding="utf-8") as fh:
+                    fh.write(line + "\n")
+            self.flush_metrics()
+        except OSError:
+            pass
+
+    def flush_metrics(self, force: bool = False) -> None:
+        if not self.metrics_path:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._last_metrics_write < self.metrics_interval_seconds:
+                return
+            self._last_metrics_write = now
+        tmp_path = f"{self.metrics_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fh:
+            fh.write(render_metrics())
+        os.replace(tmp_path, self.metrics_path)
+
+
+@st.cache_resource(show_spinner=False)
+def get_telemetry_sink() -> TelemetrySink:
+    return TelemetrySink(
+        trace_log_path=get_secret("TRACE_LOG_PATH"),
+        metrics_path=get_secret("METRICS_PATH"),
+        metrics_interval_seconds=get_float_setting("METRICS_FLUSH_SECONDS", 10),
     )
 
 
@@ -378,25 +1171,28 @@ def get_baidu_ocr_secret_key() -> Optional[str]:
     return require_secret("BAIDU_OCR_SECRET_KEY")
 
 
-def ensure_baidu_access_token(api_key: str, secret_key: str) -> str:
+def baidu_endpoint(setting: str, path: str) -> str:
+    # 每个地址都可以整体覆盖；否则拼在 BAIDU_BASE_URL 后面（压测时指向 loadtest 里的本地假服务）
+    return get_secret(setting) or (get_secret("BAIDU_BASE_URL") or "https://aip.baidubce.com").rstrip("/") + path
+
+
+def fetch_baidu_access_token(api_key: str, secret_key: str) -> tuple[str, float]:
+    get_upstream_limiter("baidu_token").acquire()
     now = time.time()
-    token = st.session_state.get("baidu_access_token")
-    expires_at = st.session_state.get("baidu_access_token_expires_at", 0.0)
-    if token and expires_at and now < float(expires_at) - 60:
-        return str(token)
-
-    resp = requests.get(
-        "https://aip.baidubce.com/oauth/2.0/token",
-        params={
-            "grant_type": "client_credentials",
-            "client_id": api_key,
-            "client_secret": secret_key,
-        },
-        timeout=20,
-    )
-    data = resp.json()
-    if resp.status_code != 200:
-        raise RuntimeError(f"baidu_token_http_{resp.status_code}")
+    with get_circuit_breaker("baidu_token").guard(), span("baidu_token"):
+        resp = get_baidu_http_session().get(
+            baidu_endpoint("BAIDU_OAUTH_URL", "/oauth/2.0/token"),
+            params={
+                "grant_type": "client_credentials",
+                "client_id": api_key,
+                "client_secret": secret_key,
+            },
+            timeout=remaining_time(get_float_setting("BAIDU_TOKEN_TIMEOUT_SECONDS", 10)),
+        )
+        # 先看状态码：网关出错时返回的是 HTML，直接 json() 只会得到一个看不出原因的解析错误
+        if resp.status_code != 200:
+            raise upstream_http_error("baidu_token_http", resp.status_code)
+        data = resp.json()
     if "error" in data or "error_description" in data:
         raise RuntimeError(f"baidu_token_error:{data.get('error')}")
 
@@ -405,34 +1201,626 @@ def ensure_baidu_access_token(api_key: str, secret_key: str) -> str:
         raise RuntimeError("baidu_token_missing")
 
     expires_in = int(data.get("expires_in") or 0)
-    st.session_state["baidu_access_token"] = access_token
-    st.session_state["baidu_access_token_expires_at"] = now + (expires_in if expires_in > 0 else 3600)
-    return str(access_token)
-
-
-def baidu_general_ocr(image_bytes: bytes, api_key: str, secret_key: str) -> dict:
-    access_token = ensure_baidu_access_token(api_key, secret_key)
-    request_url = "https://aip.baidubce.com/rest/2.0/ocr/v1/general"
-    resp = requests.post(
-        f"{request_url}?access_token={access_token}",
-        headers={"Content-Type": "application/x-www-form-urlencoded"},
-        data={
+    return str(access_token), now + (expires_in if expires_in > 0 else 3600)
+
+
+class BaiduTokenStore:
+    # 进程级 token 存储，所有会话共用：
+    # - 进入刷新窗口（剩余寿命不足 refresh_ratio 或 refresh_margin）后，后台提前刷新，调用方继续用旧 token；
+    # - 真正过期时阻塞刷新，同一组密钥同时只有一个线程去请求，其他线程等待结果（single-flight）。
+    def __init__(self, refresh_margin_seconds: float = 300, refresh_ratio: float = 0.1) -> None:
+        self.refresh_margin_seconds = float(refresh_margin_seconds)
+        self.refresh_ratio = float(refresh_ratio)
+        self._tokens: dict[str, tuple[str, float, float]] = {}
+        self._locks: dict[str, threading.Lock] = {}
+        self._background: set[str] = set()
+        self._guard = threading.Lock()
+
+    @staticmethod
+    def _key(api_key: str, secret_key: str) -> str:
+        return hashlib.sha256(f"{api_key}:{secret_key}".encode("utf-8")).hexdigest()
+
+    def _lock_for(self, key: str) -> threading.Lock:
+        with self._guard:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = threading.Lock()
+            return lock
+
+    def _store(self, key: str, token: str, expires_at: float) -> None:
+        now = time.time()
+        lifetime = max(0.0, expires_at - now)
+        refresh_at = expires_at - max(self.refresh_margin_seconds, lifetime * self.refresh_ratio)
+        with self._guard:
+            self._tokens[key] = (token, max(now, refresh_at), expires_at)
+
+    def _refresh(self, key: str, api_key: str, secret_key: str) -> str:
+        with self._lock_for(key):
+            current = self._tokens.get(key)
+            if current is not None and time.time() < current[1]:
+                return current[0]
+            token, expires_at = fetch_baidu_access_token(api_key, secret_key)
+            self._store(key, token, expires_at)
+            return token
+
+    def _refresh_in_background(self, key: str, api_key: str, secret_key: str) -> None:
+        with self._guard:
+            if key in self._background:
+                return
+            self._background.add(key)
+
+        def run() -> None:
+            try:
+                self._refresh(key, api_key, secret_key)
+            except Exception:
+                pass
+            finally:
+                with self._guard:
+                    self._background.discard(key)
+
+        threading.Thread(target=run, name="sq-baidu-token-refresh", daemon=True).start()
+
+    def get(self, api_key: str, secret_key: str) -> str:
+        key = self._key(api_key, secret_key)
+        now = time.time()
+        current = self._tokens.get(key)
+        if current is not None:
+            token, refresh_at, expires_at = current
+            if now < refresh_at:
+                return token
+            if now < expires_at - 60:
+                self._refresh_in_background(key, api_key, secret_key)
+                return token
+        return self._refresh(key, api_key, secret_key)
+
+    def invalidate(self, api_key: str, secret_key: str, token: Optional[str] = None) -> None:
+        # 带上失效的 token 时只在它仍是当前值时才清掉，避免并发请求把别人刚换到的新 token 也作废
+        key = self._key(api_key, secret_key)
+        with self._guard:
+            current = self._tokens.get(key)
+            if current is not None and (token is None or current[0] == token):
+                self._tokens.pop(key)
+
+
+@st.cache_resource(show_spinner=False)
+def get_baidu_token_store() -> BaiduTokenStore:
+    return BaiduTokenStore(
+        refresh_margin_seconds=get_int_setting("BAIDU_TOKEN_REFRESH_MARGIN_SECONDS", 300),
+    )
+
+
+def ensure_baidu_access_token(api_key: str, secret_key: str) -> str:
+    return get_baidu_token_store().get(api_key, secret_key)
+
+
+BAIDU_QPS_ERROR_CODES = frozenset({18})
+BAIDU_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+def is_transient_http_error(e: Exception) -> bool:
+    if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+        return True
+    return getattr(e, "status_code", None) in BAIDU_RETRY_STATUSES
+BAIDU_TOKEN_ERROR_CODES = frozenset({110, 111})
+
+
+def baidu_general_ocr(
+    image_bytes: bytes,
+    api_key: str,
+    secret_key: str,
+    access_token: Optional[str] = None,
+) -> dict:
+    if not access_token:
+        access_token = ensure_baidu_access_token(api_key, secret_key)
+    request_url = baidu_endpoint("BAIDU_OCR_URL", "/rest/2.0/ocr/v1/general")
+    with span("base64_encode", bytes=len(image_bytes)):
+        payload = {
             "image": base64.b64encode(image_bytes).decode("utf-8"),
             "language_type": "CHN_ENG",
             "detect_direction": "true",
             "recognize_granularity": "big",
-        },
-        timeout=30,
+        }
+    max_retries = get_int_setting("BAIDU_QPS_MAX_RETRIES", 3)
+    breaker = get_circuit_breaker("baidu_ocr")
+    attempt = 0
+    token_renewed = False
+
+    def backoff() -> None:
+        delay = get_float_setting("BAIDU_QPS_BACKOFF_SECONDS", 0.5) * (2 ** (attempt - 1)) * random.uniform(1.0, 1.5)
+        time.sleep(remaining_time(delay))
+
+    while True:
+        breaker.check()
+        get_upstream_limiter("baidu_ocr").acquire()
+        try:
+            with breaker.guard(), span("baidu_ocr_http", bytes=len(payload["image"]), attempt=attempt) as attrs:
+                resp = get_baidu_http_session().post(
+                    f"{request_url}?access_token={access_token}",
+                    headers={"Content-Type": "application/x-www-form-urlencoded"},
+                    data=payload,
+                    timeout=remaining_time(get_float_setting("BAIDU_OCR_TIMEOUT_SECONDS", 20)),
+                )
+                if resp.status_code != 200:
+                    raise upstream_http_error("baidu_ocr_http", resp.status_code)
+                data = resp.json()
+                code = data.get("error_code")
+                attrs["boxes"] = len(data.get("words_result") or [])
+                if code is not None:
+                    attrs["error_code"] = code
+                retryable = BAIDU_QPS_ERROR_CODES if token_renewed else BAIDU_QPS_ERROR_CODES | BAIDU_TOKEN_ERROR_CODES
+                if code is not None and code not in retryable:
+                    msg = data.get("error_msg")
+                    raise RuntimeError(f"baidu_ocr_error:{code}:{msg}")
+        except Exception as e:
+            # 网络错误、读超时、429/5xx：退避后重新排队（HTTP 会话对 POST 只重试建连）
+            if attempt >= max_retries or not is_transient_http_error(e):
+                raise
+            attempt += 1
+            backoff()
+            continue
+        if code is None:
+            return data
+        if code in BAIDU_TOKEN_ERROR_CODES:
+            # 110/111 = token 无效或已过期（比如在控制台被重置）：作废缓存的 token，换新的重试一次
+            get_baidu_token_store().invalidate(api_key, secret_key, access_token)
+            access_token = ensure_baidu_access_token(api_key, secret_key)
+            token_renewed = True
+            continue
+        # 18 = QPS 超限：多实例共用配额时本地限流也可能挡不住，退避后重新排队
+        if attempt >= max_retries:
+            raise RuntimeError(f"baidu_ocr_error:{code}:{data.get('error_msg')}")
+        attempt += 1
+        backoff()
+
+
+class LRUCache:
+    def __init__(self, max_entries: int, max_bytes: int = 0, ttl_seconds: float = 0) -> None:
+        self.max_entries = max(1, int(max_entries))
+        self.max_bytes = max(0, int(max_bytes))
+        self.ttl_seconds = max(0.0, float(ttl_seconds))
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bytes = 0
+        self._data: "OrderedDict[str, tuple[float, int, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            created_at, size, value = item
+            if self.ttl_seconds and time.time() - created_at > self.ttl_seconds:
+                self._data.pop(key)
+                self._bytes -= size
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key: str) -> bool:
+        # 只判断是否存在且未过期，不影响命中统计和 LRU 顺序
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and not (self.ttl_seconds and time.time() - item[0] > self.ttl_seconds)
+
+    def put(self, key: str, value: Any, size: int = 0, created_at: Optional[float] = None) -> None:
+        # created_at：从下一级缓存提上来的条目沿用原来的写入时间，TTL 不因提升而重新计时
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._data[key] = (time.time() if created_at is None else float(created_at), int(size), value)
+            self._bytes += int(size)
+            while len(self._data) > self.max_entries or (self.max_bytes and self._bytes > self.max_bytes and len(self._data) > 1):
+                _, (_, evicted_size, _) = self._data.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def image_digest(image_bytes: bytes) -> str:
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+@dataclass
+class OcrBox:
+    # 各识别后端统一的文字框：一行文字及其在原图坐标系中的外接矩形
+    text: str
+    left: int
+    top: int
+    width: int
+    height: int
+    confidence: Optional[float] = None
+
+
+def boxes_from_baidu_json(ocr_json: dict) -> list[OcrBox]:
+    boxes: list[OcrBox] = []
+    for item in ocr_json.get("words_result") or []:
+        text = (item.get("words") or "").strip()
+        loc = item.get("location")
+        if not text or not loc:
+            continue
+        try:
+            boxes.append(OcrBox(text, int(loc["left"]), int(loc["top"]), int(loc["width"]), int(loc["height"])))
+        except (KeyError, TypeError, ValueError):
+            continue
+    return boxes
+
+
+def cached_boxes(entry: dict) -> list[OcrBox]:
+    # 缓存里的框存成 [text, left, top, width, height]；旧版条目只有百度原始 JSON
+    if "boxes" in entry:
+        return [OcrBox(str(text), int(left), int(top), int(width), int(height)) for text, left, top, width, height in entry["boxes"]]
+    return boxes_from_baidu_json(entry.get("ocr_json") or {})
+
+
+class OcrResultCache:
+    # 以图片内容哈希为键，缓存识别出的文字框与拆分好的对话；
+    # 配置了 persist_dir 时同时落盘，进程重启后仍可命中。
+    # 落盘部分按写入时间排队：每次写入都从最旧的文件开始删掉过期的，以及超出条数 / 字节上限的。
+    def __init__(
+        self,
+        memory: LRUCache,
+        persist_dir: Optional[str] = None,
+        max_disk_entries: int = 0,
+        max_disk_bytes: int = 0,
+    ) -> None:
+        self.memory = memory
+        self.persist_dir = persist_dir
+        self.max_disk_entries = max(0, int(max_disk_entries))
+        self.max_disk_bytes = max(0, int(max_disk_bytes))
+        self._disk: "OrderedDict[str, tuple[float, int]]" = OrderedDict()
+        self._disk_bytes = 0
+        self._disk_lock = threading.Lock()
+        if persist_dir:
+            os.makedirs(persist_dir, exist_ok=True)
+            self._load_disk_index()
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(str(self.persist_dir), f"{digest}.json")
+
+    def _expired(self, created_at: float) -> bool:
+        ttl = self.memory.ttl_seconds
+        return bool(ttl) and time.time() - created_at > ttl
+
+    def _load_disk_index(self) -> None:
+        files: list[tuple[float, str, int]] = []
+        for name in os.listdir(str(self.persist_dir)):
+            if not name.endswith(".json"):
+                continue
+            try:
+                stat = os.stat(os.path.join(str(self.persist_dir), name))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, name[: -len(".json")], stat.st_size))
+        with self._disk_lock:
+            for written_at, digest, size in sorted(files):
+                self._disk[digest] = (written_at, size)
+                self._disk_bytes += size
+            self._prune_disk()
+
+    def _over_disk_limit(self) -> bool:
+        return bool(
+            (self.max_disk_entries and len(self._disk) > self.max_disk_entries)
+            or (self.max_disk_bytes and self._disk_bytes > self.max_disk_bytes)
+        )
+
+    def _forget_disk(self, digest: str) -> None:
+        item = self._disk.pop(digest, None)
+        if item is not None:
+            self._disk_bytes -= item[1]
+        try:
+            os.remove(self._path(digest))
+        except OSError:
+            pass
+
+    def _prune_disk(self) -> None:
+        # 调用方持有 _disk_lock
+        while self._disk:
+            digest, (written_at, _) = next(iter(self._disk.items()))
+            if not self._expired(written_at) and not self._over_disk_limit():
+                break
+            self._forget_disk(digest)
+
+    def get(self, digest: str) -> Optional[dict]:
+        entry = self.memory.get(digest)
+        if entry is not None or not self.persist_dir:
+            return entry
+
+        path = self._path(digest)
+        try:
+            with open(path, "r", encoding="utf-8") as fh:
+                entry = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        created_at = float(entry.get("created_at") or 0)
+        if self._expired(created_at):
+            with self._disk_lock:
+                self._forget_disk(digest)
+            return None
+        self.memory.put(digest, entry, size=os.path.getsize(path), created_at=created_at)
+        return entry
+
+    def get_dialogue(self, digest: str) -> Optional[str]:
+        entry = self.get(digest)
+        if entry is None:
+            return None
+        if entry.get("layout_version") != LAYOUT_VERSION:
+            # 版面算法升级后，用缓存的文字框重算对话，不必重新识别
+            boxes = cached_boxes(entry)
+            dialogue = build_role_dialogue_from_boxes(boxes, image_width=int(entry["image_width"]))
+            self.put(digest, boxes, dialogue, int(entry["image_width"]), str(entry.get("backend") or "baidu"))
+            return dialogue
+        return str(entry["dialogue"])
+
+    def put(self, digest: str, boxes: list[OcrBox], dialogue: str, image_width: int, backend: str = "baidu") -> dict:
+        entry = {
+            "boxes": [[box.text, box.left, box.top, box.width, box.height] for box in boxes],
+            "backend": backend,
+            "dialogue": dialogue,
+            "image_width": int(image_width),
+            "layout_version": LAYOUT_VERSION,
+            "created_at": time.time(),
+        }
+        payload = json.dumps(entry, ensure_ascii=False).encode("utf-8")
+        self.memory.put(digest, entry, size=len(payload))
+        if self.persist_dir:
+            path = self._path(digest)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp_path, "wb") as fh:
+                    fh.write(payload)
+                os.replace(tmp_path, path)
+            except OSError:
+                return entry
+            with self._disk_lock:
+                previous = self._disk.pop(digest, None)
+                if previous is not None:
+                    self._disk_bytes -= previous[1]
+                self._disk[digest] = (entry["created_at"], len(payload))
+                self._disk_bytes += len(payload)
+                self._prune_disk()
+        return entry
+
+
+@st.cache_resource(show_spinner=False)
+def get_ocr_cache() -> OcrResultCache:
+    memory = LRUCache(
+        max_entries=get_int_setting("OCR_CACHE_MAX_ENTRIES", 512),
+        max_bytes=get_int_setting("OCR_CACHE_MAX_MB", 64) * 1024 * 1024,
+        ttl_seconds=get_int_setting("OCR_CACHE_TTL_SECONDS", 7 * 24 * 3600),
     )
-    data = resp.json()
-    if resp.status_code != 200:
-        raise RuntimeError(f"baidu_ocr_http_{resp.status_code}")
-    if data.get("error_code") is not None:
-        code = data.get("error_code")
-        msg = data.get("error_msg")
-        raise RuntimeError(f"baidu_ocr_error:{code}:{msg}")
+    persist_dir = get_secret("OCR_CACHE_DIR")
+    return OcrResultCache(
+        memory,
+        persist_dir=str(persist_dir) if persist_dir else None,
+        max_disk_entries=get_int_setting("OCR_CACHE_DISK_MAX_ENTRIES", 20000),
+        max_disk_bytes=get_int_setting("OCR_CACHE_DISK_MAX_MB", 512) * 1024 * 1024,
+    )
+
 
-    return data
+@dataclass
+class ImageTile:
+    data: bytes
+    # 在上传图坐标系中的起始行与高度
+    top: int
+    height: int
+
+
+@dataclass
+class PreparedImage:
+    tiles: list[ImageTile]
+    width: int
+    height: int
+    original_width: int
+    original_height: int
+    # 上传图坐标 / 原图坐标
+    scale: float
+
+
+def tile_ranges(height: int, max_tile_height: int, overlap: int) -> list[tuple[int, int]]:
+    # 只有超过识别服务边长上限的长截图才切块；块数取最少，再把行数平均分到各块，
+    # 避免最后一块贴底对齐后和前一块大面积重叠、白白多识别一遍
+    if height <= max_tile_height:
+        return [(0, height)]
+    overlap = max(0, min(overlap, max_tile_height // 2))
+    count = math.ceil((height - overlap) / (max_tile_height - overlap))
+    size = math.ceil((height + (count - 1) * overlap) / count)
+    step = size - overlap
+    return [(i * step, height if i == count - 1 else i * step + size) for i in range(count)]
+
+
+def encode_jpeg_within_budget(img: Image.Image, budget_bytes: int) -> Optional[bytes]:
+    for quality in (85, 75, 65, 55):
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=quality, optimize=True)
+        data = buf.getvalue()
+        if (len(data) + 2) // 3 * 4 <= budget_bytes:
+            return data
+    return None
+
+
+def prepare_image_for_ocr(
+    image_bytes: bytes,
+    max_width: int = 1080,
+    budget_bytes: int = 1536 * 1024,
+    grayscale: bool = False,
+    max_tile_height: int = 4096,
+    tile_overlap: int = 160,
+) -> PreparedImage:
+    # Image.open 只解析文件头，拿到尺寸不需要完整解码。
+    img = Image.open(io.BytesIO(image_bytes))
+    original_width, original_height = (int(v) for v in img.size)
+    scale = min(1.0, max_width / float(original_width)) if original_width else 1.0
+    encoded_size = (len(image_bytes) + 2) // 3 * 4
+    if scale == 1.0 and original_height <= max_tile_height and encoded_size <= budget_bytes and not grayscale:
+        return PreparedImage(
+            tiles=[ImageTile(data=image_bytes, top=0, height=original_height)],
+            width=original_width,
+            height=original_height,
+            original_width=original_width,
+            original_height=original_height,
+            scale=1.0,
+        )
+
+    mode = "L" if grayscale else "RGB"
+    with span("image_decode", bytes=len(image_bytes)):
+        # JPEG 可以直接按目标尺寸做降采样解码，省掉一次全尺寸解码
+        img.draft(mode, (max(1, int(original_width * scale)), max(1, int(original_height * scale))))
+        if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+            rgba = img.convert("RGBA")
+            base = Image.new("RGBA", rgba.size, (255, 255, 255, 255))
+            img = Image.alpha_composite(base, rgba)
+        img = img.convert(mode)
+
+    tiles: list[ImageTile] = []
+    ranges: list[tuple[int, int]] = []
+    width, height = original_width, original_height
+    with span("image_encode") as attrs:
+        for _ in range(4):
+            width = max(1, int(round(original_width * scale)))
+            height = max(1, int(round(original_height * scale)))
+            resized = img if img.size == (width, height) else img.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+            tiles = []
+            ranges = tile_ranges(height, max_tile_height, tile_overlap)
+            for top, bottom in ranges:
+                part = resized if (top, bottom) == (0, height) else resized.crop((0, top, width, bottom))
+                data = encode_jpeg_within_budget(part, budget_bytes)
+                if data is None:
+                    break
+                tiles.append(ImageTile(data=data, top=top, height=bottom - top))
+            else:
+                break
+            # 最低质量仍超预算：继续缩小分辨率
+            scale *= 0.8
+        attrs.update(tiles=len(tiles), bytes=sum(len(tile.data) for tile in tiles))
+    if len(tiles) < len(ranges):
+        # 缩小几轮后仍有分块压不进预算：只识别前面几块会悄悄丢掉后半段聊天，宁可整张报错
+        raise RuntimeError(f"image_over_budget:{len(tiles)}/{len(ranges)}")
+
+    return PreparedImage(
+        tiles=tiles,
+        width=width,
+        height=height,
+        original_width=original_width,
+        original_height=original_height,
+        scale=width / float(original_width) if original_width else 1.0,
+    )
+
+
+def prepare_image_for_ocr_from_settings(image_bytes: bytes) -> PreparedImage:
+    return prepare_image_for_ocr(
+        image_bytes,
+        max_width=get_int_setting("OCR_MAX_WIDTH", 1080),
+        budget_bytes=get_int_setting("OCR_UPLOAD_BUDGET_KB", 1536) * 1024,
+        grayscale=str(get_secret("OCR_GRAYSCALE") or "").strip().lower() in ("1", "true", "yes", "on"),
+        # 百度通用文字识别要求最长边不超过 4096 像素
+        max_tile_height=get_int_setting("OCR_TILE_HEIGHT", 4096),
+        tile_overlap=get_int_setting("OCR_TILE_OVERLAP", 160),
+    )
+
+
+def merge_tile_ocr_results(tile_results: list[tuple[ImageTile, dict]]) -> dict:
+    # 1) 每块的 location.top 加上块偏移，换算回整图坐标
+    # 2) 贴着块内上下边缘的框多半被裁断，相邻块在重叠带里有完整版本，丢弃
+    # 3) 重叠带里文字相同、位置相近的框只保留先出现的一份
+    merged: list[dict] = []
+    last = len(tile_results) - 1
+    for i, (tile, ocr_json) in enumerate(tile_results):
+        prev_tile = tile_results[i - 1][0] if i > 0 else None
+        for item in ocr_json.get("words_result") or []:
+            loc = item.get("location") or {}
+            if loc.get("top") is None or loc.get("height") is None:
+                continue
+            top = int(loc["top"])
+            height = int(loc["height"])
+            if i > 0 and top <= 2:
+                continue
+            if i < last and top + height >= tile.height - 2:
+                continue
+
+            page_top = top + tile.top
+            if prev_tile is not None and page_top < prev_tile.top + prev_tile.height:
+                text = (item.get("words") or "").strip()
+                left = int(loc.get("left") or 0)
+                tolerance = max(4, height // 2)
+                duplicate = any(
+                    (other.get("words") or "").strip() == text
+                    and abs(int(other["location"]["top"]) - page_top) <= tolerance
+                    and abs(int(other["location"].get("left") or 0) - left) <= tolerance
+                    for other in merged
+                )
+                if duplicate:
+                    continue
+
+            new_item = dict(item)
+            new_item["location"] = dict(loc, top=page_top)
+            merged.append(new_item)
+
+    first_json = tile_results[0][1] if tile_results else {}
+    result = {k: v for k, v in first_json.items() if k not in ("words_result", "words_result_num")}
+    result["words_result"] = merged
+    result["words_result_num"] = len(merged)
+    return result
+
+
+def ocr_prepared_image(
+    prepared: PreparedImage,
+    api_key: str,
+    secret_key: str,
+    access_token: Optional[str] = None,
+) -> dict:
+    if len(prepared.tiles) == 1:
+        return baidu_general_ocr(
+            prepared.tiles[0].data,
+            api_key=api_key,
+            secret_key=secret_key,
+            access_token=access_token,
+        )
+
+    if not access_token:
+        access_token = ensure_baidu_access_token(api_key, secret_key)
+    workers = max(1, min(get_int_setting("OCR_TILE_MAX_WORKERS", 4), len(prepared.tiles)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sq-ocr-tile") as pool:
+        futures = [
+            submit_with_context(pool, baidu_general_ocr, tile.data, api_key, secret_key, access_token)
+            for tile in prepared.tiles
+        ]
+        results = [future.result() for future in futures]
+    return merge_tile_ocr_results(list(zip(prepared.tiles, results)))
+
+
+def rescale_ocr_locations(ocr_json: dict, factor: float) -> dict:
+    if factor == 1.0:
+        return ocr_json
+    words_result = []
+    for item in ocr_json.get("words_result") or []:
+        loc = item.get("location")
+        if loc:
+            item = dict(item)
+            item["location"] = {k: int(round(float(v) * factor)) for k, v in loc.items()}
+        words_result.append(item)
+    scaled = dict(ocr_json)
+    scaled["words_result"] = words_result
+    return scaled
 
 
 def is_timestamp_line(text: str) -> bool:
@@ -441,324 +1829,2006 @@ def is_timestamp_line(text: str) -> bool:
         return True
     if len(t) > 24:
         return False
-    t = re.sub(r"\s+", " ", t)
+    # 所有时间戳格式都以数字或“上/下/星/今/昨/前”开头，先用首字符挡掉绝大多数普通消息
+    if not t[0].isdecimal() and t[0] not in TIMESTAMP_FIRST_CHARS:
+        return False
+    t = WHITESPACE_RE.sub(" ", t)
     return TIMESTAMP_RE.match(t) is not None
 
 
+LAYOUT_VERSION = 2
+# 框数少于这个值时走逐行版：numpy 建数组、排序、reduceat 的固定开销在小图上比逐行循环本身还大
+LAYOUT_VECTORIZE_MIN_BOXES = 128
+
+
+def _segmented_running_max(values: np.ndarray, segment_ids: np.ndarray) -> np.ndarray:
+    # segment_ids 单调不减；给每段叠加一个足够大的偏移，一次 maximum.accumulate 即可分段求前缀最大值
+    if values.size == 0:
+        return values
+    base = values.min()
+    span = int(values.max() - base) + 1
+    offset = segment_ids.astype(np.int64) * span
+    return np.maximum.accumulate(values - base + offset) - offset + base
+
+
+def _column_anchor(edges: np.ndarray, tolerance: float, prefer_low: bool) -> Optional[float]:
+    # 一维密度聚类：取容差窗口内边缘最密集的位置作为这一列的对齐线
+    if edges.size == 0:
+        return None
+    ordered = np.sort(edges)
+    counts = np.searchsorted(ordered, ordered + tolerance, side="right") - np.searchsorted(ordered, ordered - tolerance, side="left")
+    best = np.flatnonzero(counts == counts.max())
+    return float(ordered[best[0] if prefer_low else best[-1]])
+
+
+def _column_anchor_small(edges: list[int], tolerance: float, prefer_low: bool) -> Optional[float]:
+    # _column_anchor 的逐个版本，供小图使用，结果一致
+    if not edges:
+        return None
+    ordered = sorted(edges)
+    counts = [bisect_right(ordered, e + tolerance) - bisect_left(ordered, e - tolerance) for e in ordered]
+    best = max(counts)
+    index = counts.index(best) if prefer_low else len(counts) - 1 - counts[::-1].index(best)
+    return float(ordered[index])
+
+
+def assign_speakers_by_columns_small(lefts: list[int], rights: list[int], image_width: int) -> list[bool]:
+    # assign_speakers_by_columns 的逐个版本，判定规则相同
+    half = image_width / 2.0
+    if len(lefts) == 1:
+        # 只有一个气泡时它自己就是两列的对齐线，贴左贴右的结论与中心点判定一致
+        return [(lefts[0] + rights[0]) / 2.0 >= half]
+    tolerance = max(8.0, image_width * 0.03)
+    left_anchor = _column_anchor_small([v for v in lefts if v < half], tolerance, prefer_low=True)
+    right_anchor = _column_anchor_small([v for v in rights if v > half], tolerance, prefer_low=False)
+    is_me: list[bool] = []
+    for left, right in zip(lefts, rights):
+        left_anchored = left_anchor is not None and abs(left - left_anchor) <= tolerance
+        right_anchored = right_anchor is not None and abs(right - right_anchor) <= tolerance
+        if left_anchored != right_anchored:
+            is_me.append(right_anchored)
+        else:
+            is_me.append((left + right) / 2.0 >= half)
+    return is_me
+
+
+def assign_speakers_by_columns(lefts: np.ndarray, rights: np.ndarray, image_width: int) -> np.ndarray:
+    # 聊天界面里对方的气泡左对齐、我的气泡右对齐：
+    # 分别对左半边的左边缘、右半边的右边缘聚类，找出两列的对齐线；
+    # 只贴左列的判为【对方】，只贴右列的判为【我】；
+    # 两边都贴（通栏长气泡）或都不贴时，才退回中心点与图宽一半比较。
+    if lefts.size == 0:
+        return np.zeros(0, dtype=bool)
+    half = image_width / 2.0
+    tolerance = max(8.0, image_width * 0.03)
+    left_anchor = _column_anchor(lefts[lefts < half], tolerance, prefer_low=True)
+    right_anchor = _column_anchor(rights[rights > half], tolerance, prefer_low=False)
+    left_anchored = np.abs(lefts - left_anchor) <= tolerance if left_anchor is not None else np.zeros(lefts.size, dtype=bool)
+    right_anchored = np.abs(rights - right_anchor) <= tolerance if right_anchor is not None else np.zeros(rights.size, dtype=bool)
+
+    is_me = (lefts + rights) / 2.0 >= half
+    is_me = np.where(left_anchored & ~right_anchored, False, is_me)
+    is_me = np.where(right_anchored & ~left_anchored, True, is_me)
+    return is_me
+
+
 def build_role_dialogue_from_ocr(ocr_json: dict, image_width: int) -> str:
+    # 直接吃百度 general 原始 JSON 的版本：不经过 OcrBox，省掉逐框建对象（基准测试与旧调用方用）
     words_result = ocr_json.get("words_result") or []
-    rows = []
+    texts: list[str] = []
+    boxes: list[tuple[int, int, int, int]] = []
     for item in words_result:
         text = (item.get("words") or "").strip()
-        if not text:
+        loc = item.get("location")
+        if not text or not loc:
             continue
-        loc = item.get("location") or {}
-        left = loc.get("left")
-        top = loc.get("top")
-        width = loc.get("width")
-        height = loc.get("height")
-        if left is None or width is None or top is None or height is None:
+        try:
+            boxes.append((int(loc["top"]), int(loc["left"]), int(loc["width"]), int(loc["height"])))
+        except (KeyError, TypeError, ValueError):
             continue
-        rows.append((int(top), int(left), int(width), int(height), text))
+        texts.append(text)
+    return layout_dialogue(texts, boxes, image_width)
+
+
+def build_role_dialogue_from_boxes(boxes: list[OcrBox], image_width: int) -> str:
+    texts: list[str] = []
+    rows: list[tuple[int, int, int, int]] = []
+    for box in boxes:
+        text = box.text.strip()
+        if text:
+            texts.append(text)
+            rows.append((box.top, box.left, box.width, box.height))
+    return layout_dialogue(texts, rows, image_width)
+
+
+def layout_dialogue(texts: list[str], boxes: list[tuple[int, int, int, int]], image_width: int) -> str:
+    # boxes 与 texts 一一对应，每项为 (top, left, width, height)
+    # 坐标判定算法（V2）：
+    # 1) 按 top（再按 left）从上到下排序
+    # 2) 计算 gap = current_top - last_bottom_y（时间戳行会重置 last_bottom_y）
+    #    - gap 很小：视为同一气泡内换行，拼接到上一句
+    #    - gap 很大或上一行是时间戳：视为新气泡
+    # 3) 说话人按气泡整体的左右边缘贴靠哪一列判定（见 assign_speakers_by_columns）
+    if not boxes:
+        return ""
+    if len(boxes) < LAYOUT_VECTORIZE_MIN_BOXES:
+        return _layout_dialogue_small(texts, boxes, image_width)
+    return _layout_dialogue_vectorized(texts, boxes, image_width)
+
+
+def _layout_dialogue_small(texts: list[str], boxes: list[tuple[int, int, int, int]], image_width: int) -> str:
+    # 逐行版：与向量化版逐项对应，结果一致
+    first_chars = TIMESTAMP_FIRST_CHARS
+    bubble_lefts: list[int] = []
+    bubble_rights: list[int] = []
+    bubble_lines: list[list[str]] = []
+    last_bottom = 0
+    prev_height = 0
+    prev_is_dialogue = False
+    for i in sorted(range(len(boxes)), key=lambda k: (boxes[k][0], boxes[k][1])):
+        top, left, width, height = boxes[i]
+        text = texts[i]
+        if (text[0].isdecimal() or text[0] in first_chars) and is_timestamp_line(text):
+            last_bottom = top + height
+            prev_height = height
+            prev_is_dialogue = False
+            continue
+        gap = top - last_bottom
+        threshold = int(max(6, min(prev_height, height) * 0.9) if prev_height > 0 else max(6, height * 0.9))
+        if prev_is_dialogue and 0 <= gap < threshold:
+            bubble_lines[-1].append(text)
+            if left < bubble_lefts[-1]:
+                bubble_lefts[-1] = left
+            if left + width > bubble_rights[-1]:
+                bubble_rights[-1] = left + width
+        else:
+            bubble_lines.append([text])
+            bubble_lefts.append(left)
+            bubble_rights.append(left + width)
+        if top + height > last_bottom:
+            last_bottom = top + height
+        prev_height = height
+        prev_is_dialogue = True
+    if not bubble_lines:
+        return ""
+    is_me = assign_speakers_by_columns_small(bubble_lefts, bubble_rights, image_width)
+    return "\n".join(
+        ("【我】: " if me else "【对方】: ") + " ".join(lines) for lines, me in zip(bubble_lines, is_me)
+    )
+
+
+def _layout_dialogue_vectorized(texts: list[str], boxes: list[tuple[int, int, int, int]], image_width: int) -> str:
+    arr = np.asarray(boxes, dtype=np.int64)
+    order = np.lexsort((arr[:, 1], arr[:, 0]))
+    arr = arr[order]
+    texts = [texts[i] for i in order.tolist()]
+    top, left, width, height = arr[:, 0], arr[:, 1], arr[:, 2], arr[:, 3]
+    bottom = top + height
+
+    first_chars = TIMESTAMP_FIRST_CHARS
+    is_ts = np.fromiter(
+        ((t[0].isdecimal() or t[0] in first_chars) and is_timestamp_line(t) for t in texts),
+        dtype=bool,
+        count=len(texts),
+    )
+    segment_ids = np.cumsum(is_ts)
+    running_bottom = _segmented_running_max(bottom, segment_ids)
+    # 还没遇到时间戳时 last_bottom_y 的初值是 0
+    running_bottom = np.where(segment_ids == 0, np.maximum(running_bottom, 0), running_bottom)
+
+    prev_bottom = np.concatenate(([0], running_bottom[:-1]))
+    prev_height = np.concatenate(([0], height[:-1]))
+    prev_is_dialogue = np.concatenate(([False], ~is_ts[:-1]))
+
+    gap = top - prev_bottom
+    threshold = np.where(
+        prev_height > 0,
+        np.maximum(6, np.minimum(prev_height, height) * 0.9),
+        np.maximum(6, height * 0.9),
+    ).astype(np.int64)
+    is_continuation = ~is_ts & prev_is_dialogue & (gap >= 0) & (gap < threshold)
+
+    dialogue_rows = np.flatnonzero(~is_ts)
+    if dialogue_rows.size == 0:
+        return ""
+    starts_mask = ~is_continuation[dialogue_rows]
+    group_starts = np.flatnonzero(starts_mask)
+
+    d_left = left[dialogue_rows]
+    d_right = d_left + width[dialogue_rows]
+    group_lefts = np.minimum.reduceat(d_left, group_starts)
+    group_rights = np.maximum.reduceat(d_right, group_starts)
+    is_me = assign_speakers_by_columns(group_lefts, group_rights, image_width)
+
+    # 一次 join 拼出全部气泡：每行前面要么是换行加说话人标记（气泡开头），要么是空格（同一气泡内换行）
+    group_of_row = np.cumsum(starts_mask) - 1
+    row_is_me = is_me[group_of_row]
+    prefixes = np.where(starts_mask, np.where(row_is_me, "\n【我】: ", "\n【对方】: "), " ").tolist()
+    return "".join([p + texts[i] for p, i in zip(prefixes, dialogue_rows.tolist())])[1:]
+
+
+NO_DIALOGUE_NOTE = "（本图未识别到可用对话：可能是时间戳/系统提示或识别不到位置数据）"
+
+
+class OcrBackend(ABC):
+    # 识别后端：输入上传的原图，返回原图坐标系下的 OcrBox 列表。
+    # breaker_name 指向它的熔断器；cost_units / pending_seconds 供路由估算这一张图的耗时。
+    name = ""
+    breaker_name = ""
+    max_pixels = 0
+    prior_seconds = 1.0
+
+    def cost_units(self, pixels: int) -> float:
+        return 1.0
+
+    def pending_seconds(self, expected: float) -> float:
+        return 0.0
+
+    @abstractmethod
+    def recognize(self, image_bytes: bytes) -> list[OcrBox]:
+        ...
+
+
+class BaiduOcrBackend(OcrBackend):
+    name = "baidu"
+    breaker_name = "baidu_ocr"
+
+    def __init__(self, api_key: str, secret_key: str, access_token: Optional[str] = None) -> None:
+        self.api_key = api_key
+        self.secret_key = secret_key
+        self.access_token = access_token
+        self.prior_seconds = get_float_setting("BAIDU_OCR_PRIOR_SECONDS", 1.0)
+
+    def pending_seconds(self, expected: float) -> float:
+        # 限流队列里排在前面的请求要按配额逐个放行
+        stats = get_upstream_limiter("baidu_ocr").stats()
+        return stats["waiting"] / max(float(stats["rate"]), 1e-6)
+
+    def recognize(self, image_bytes: bytes) -> list[OcrBox]:
+        prepared = prepare_image_for_ocr_from_settings(image_bytes)
+        ocr_json = ocr_prepared_image(
+            prepared,
+            api_key=self.api_key,
+            secret_key=self.secret_key,
+            access_token=self.access_token,
+        )
+        # 坐标换算回原图，缓存和版面分析都以原图坐标为准
+        return boxes_from_baidu_json(rescale_ocr_locations(ocr_json, 1.0 / prepared.scale))
+
 
-    rows.sort(key=lambda x: (x[0], x[1]))
+def join_ocr_words(line: str, word: str) -> str:
+    # Tesseract 按词切分：中文逐字直接相连，英文单词和数字之间补空格
+    if line and line[-1].isascii() and line[-1].isalnum() and word[0].isascii() and word[0].isalnum():
+        return f"{line} {word}"
+    return line + word
 
-    dialogue_lines: list[str] = []
-    last_speaker: Optional[str] = None
-    last_bottom_y = 0
-    last_line_height = 0
 
-    for top, left, width, height, text in rows:
-        if is_timestamp_line(text):
-            last_speaker = None
-            last_bottom_y = top + height
-            last_line_height = height
+def boxes_from_tesseract_data(data: dict, factor: float, min_confidence: float) -> list[OcrBox]:
+    # image_to_data 给的是词级结果，按 (block, par, line) 合成行级框，与百度 general 的粒度一致
+    lines: dict[tuple[int, int, int], list[tuple[int, int, int, int, str, float]]] = {}
+    for i, word in enumerate(data.get("text") or []):
+        word = (word or "").strip()
+        confidence = float(data["conf"][i])
+        if not word or confidence < min_confidence:
             continue
+        key = (int(data["block_num"][i]), int(data["par_num"][i]), int(data["line_num"][i]))
+        lines.setdefault(key, []).append(
+            (int(data["left"][i]), int(data["top"][i]), int(data["width"][i]), int(data["height"][i]), word, confidence)
+        )
+
+    boxes: list[OcrBox] = []
+    for words in lines.values():
+        words.sort(key=lambda w: w[0])
+        text = ""
+        for word in words:
+            text = join_ocr_words(text, word[4])
+        left = min(w[0] for w in words)
+        top = min(w[1] for w in words)
+        right = max(w[0] + w[2] for w in words)
+        bottom = max(w[1] + w[3] for w in words)
+        boxes.append(
+            OcrBox(
+                text=text,
+                left=int(round(left * factor)),
+                top=int(round(top * factor)),
+                width=int(round((right - left) * factor)),
+                height=int(round((bottom - top) * factor)),
+                confidence=sum(w[5] for w in words) / len(words),
+            )
+        )
+    return boxes
 
-        gap = top - last_bottom_y
-        proximity_threshold = int(max(6, min(last_line_height, height) * 0.9)) if last_line_height else int(max(6, height * 0.9))
 
-        if last_speaker is not None and gap >= 0 and gap < proximity_threshold:
-            if dialogue_lines:
-                dialogue_lines[-1] = f"{dialogue_lines[-1]} {text}".strip()
+def load_pytesseract() -> Optional[Any]:
+    # 可选依赖：需要 pip install pytesseract 并安装 tesseract 可执行文件与 chi_sim 语言包
+    try:
+        import pytesseract
+    except ImportError:
+        return None
+    try:
+        pytesseract.get_tesseract_version()
+    except Exception:
+        return None
+    return pytesseract
+
+
+class TesseractOcrBackend(OcrBackend):
+    # 本地 CPU 识别：没有网络往返，也不占百度配额；耗时大致与像素数成正比
+    name = "tesseract"
+    breaker_name = "tesseract"
+
+    def __init__(
+        self,
+        module: Any,
+        lang: str = "chi_sim+eng",
+        config: str = "",
+        max_width: int = 1080,
+        min_confidence: float = 40,
+        max_pixels: int = 1080 * 2400,
+        max_workers: int = 2,
+        prior_seconds_per_mp: float = 1.0,
+    ) -> None:
+        self.module = module
+        self.lang = lang
+        self.config = config
+        self.max_width = max(1, int(max_width))
+        self.min_confidence = float(min_confidence)
+        self.max_pixels = max(0, int(max_pixels))
+        self.max_workers = max(1, int(max_workers))
+        self.prior_seconds = float(prior_seconds_per_mp)
+        self.inflight = 0
+        self._slots = threading.BoundedSemaphore(self.max_workers)
+        self._lock = threading.Lock()
+
+    def cost_units(self, pixels: int) -> float:
+        return pixels / 1e6
+
+    def pending_seconds(self, expected: float) -> float:
+        # 本地并发槽位占满时，要等前面的图识别完
+        backlog = self.inflight - self.max_workers + 1
+        return max(0, backlog) * expected / self.max_workers
+
+    def recognize(self, image_bytes: bytes) -> list[OcrBox]:
+        breaker = get_circuit_breaker(self.breaker_name)
+        breaker.check()
+        with self._lock:
+            self.inflight += 1
+        try:
+            with self._slots, breaker.guard(), span("tesseract_ocr", bytes=len(image_bytes)) as attrs:
+                img = Image.open(io.BytesIO(image_bytes))
+                factor = max(1.0, img.width / float(self.max_width))
+                img.draft("L", (max(1, int(img.width / factor)), max(1, int(img.height / factor))))
+                img = img.convert("L")
+                if img.width > self.max_width:
+                    img = img.resize((self.max_width, max(1, int(round(img.height * self.max_width / img.width)))), Image.Resampling.LANCZOS)
+                data = self.module.image_to_data(
+                    img,
+                    lang=self.lang,
+                    config=self.config,
+                    output_type=self.module.Output.DICT,
+                    timeout=remaining_time(get_float_setting("LOCAL_OCR_TIMEOUT_SECONDS", 30)),
+                )
+                boxes = boxes_from_tesseract_data(data, factor, self.min_confidence)
+                attrs["boxes"] = len(boxes)
+        finally:
+            with self._lock:
+                self.inflight -= 1
+        return boxes
+
+
+class OcrRouter:
+    # 逐张挑选识别后端：实测耗时（EWMA，按后端的计价单位归一）+ 排队预估，熔断中的后端排到最后，
+    # 图片超过后端 max_pixels 的也只作兜底；失败时按排序依次回退到下一个后端。
+    def __init__(self, alpha: float = 0.3) -> None:
+        self.alpha = min(1.0, max(0.01, float(alpha)))
+        self.latency: dict[str, float] = {}
+        self.routed: dict[str, int] = {}
+        self.failures: dict[str, int] = {}
+        self.fallbacks = 0
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, seconds_per_unit: float) -> None:
+        with self._lock:
+            previous = self.latency.get(name)
+            self.latency[name] = seconds_per_unit if previous is None else previous + self.alpha * (seconds_per_unit - previous)
+
+    def expected_seconds(self, backend: OcrBackend, pixels: int) -> float:
+        with self._lock:
+            per_unit = self.latency.get(backend.name, backend.prior_seconds)
+        expected = per_unit * backend.cost_units(pixels)
+        return expected + backend.pending_seconds(expected)
+
+    def rank(self, backends: list[OcrBackend], pixels: int) -> list[OcrBackend]:
+        def key(backend: OcrBackend) -> tuple[int, float]:
+            if get_circuit_breaker(backend.breaker_name).is_open():
+                tier = 2
+            elif backend.max_pixels and pixels > backend.max_pixels:
+                tier = 1
             else:
-                dialogue_lines.append(f"【{last_speaker}】: {text}")
+                tier = 0
+            return tier, self.expected_seconds(backend, pixels)
+
+        return sorted(backends, key=key)
+
+    def recognize(self, image_bytes: bytes, backends: list[OcrBackend]) -> tuple[list[OcrBox], int, str]:
+        if not backends:
+            raise RuntimeError("ocr_no_backend")
+        # Image.open 只解析文件头，拿尺寸不需要解码
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            width, height = (int(v) for v in img.size)
+        pixels = width * height
+        last_error: Optional[Exception] = None
+        for attempt, backend in enumerate(self.rank(backends, pixels)):
+            started = time.monotonic()
+            try:
+                boxes = backend.recognize(image_bytes)
+            except Exception as e:
+                last_error = e
+                with self._lock:
+                    self.failures[backend.name] = self.failures.get(backend.name, 0) + 1
+                if str(e) == "deadline_exceeded":
+                    break
+                continue
+            self.observe(backend.name, (time.monotonic() - started) / max(backend.cost_units(pixels), 1e-6))
+            with self._lock:
+                self.routed[backend.name] = self.routed.get(backend.name, 0) + 1
+                if attempt:
+                    self.fallbacks += 1
+            return boxes, width, backend.name
+        raise last_error if last_error is not None else RuntimeError("ocr_no_backend")
+
+    def stats(self) -> dict:
+        with self._lock:
+            names = sorted(set(self.latency) | set(self.routed) | set(self.failures))
+            return {
+                "backends": {
+                    name: {
+                        "ewma_seconds_per_unit": round(self.latency.get(name, 0.0), 4),
+                        "routed": self.routed.get(name, 0),
+                        "failures": self.failures.get(name, 0),
+                    }
+                    for name in names
+                },
+                "fallbacks": self.fallbacks,
+            }
+
+
+@st.cache_resource(show_spinner=False)
+def get_ocr_router() -> OcrRouter:
+    return OcrRouter(alpha=get_float_setting("OCR_ROUTER_EWMA_ALPHA", 0.3))
+
+
+def ocr_backend_names() -> list[str]:
+    # OCR_BACKENDS：逗号分隔的候选后端，默认只用百度；本地识别需显式开启（如 baidu,tesseract），未安装时自动跳过
+    return [name.strip().lower() for name in str(get_secret("OCR_BACKENDS") or "baidu").split(",") if name.strip()]
+
+
+def get_baidu_ocr_credentials() -> tuple[Optional[str], Optional[str]]:
+    # 只有启用了百度后端才要求配置密钥；只用本地识别时返回 (None, None)
+    if "baidu" not in ocr_backend_names():
+        return None, None
+    return get_baidu_ocr_api_key(), get_baidu_ocr_secret_key()
+
+
+@st.cache_resource(show_spinner=False)
+def get_local_ocr_backend() -> Optional[TesseractOcrBackend]:
+    if "tesseract" not in ocr_backend_names():
+        return None
+    module = load_pytesseract()
+    if module is None:
+        return None
+    return TesseractOcrBackend(
+        module,
+        lang=str(get_secret("TESSERACT_LANG") or "chi_sim+eng"),
+        config=str(get_secret("TESSERACT_CONFIG") or ""),
+        max_width=get_int_setting("OCR_MAX_WIDTH", 1080),
+        min_confidence=get_float_setting("TESSERACT_MIN_CONFIDENCE", 40),
+        max_pixels=get_int_setting("LOCAL_OCR_MAX_PIXELS", 1080 * 2400),
+        max_workers=get_int_setting("LOCAL_OCR_MAX_WORKERS", os.cpu_count() or 2),
+        prior_seconds_per_mp=get_float_setting("TESSERACT_PRIOR_SECONDS_PER_MP", 1.0),
+    )
+
+
+def ocr_backends(api_key: Optional[str], secret_key: Optional[str], access_token: Optional[str] = None) -> list[OcrBackend]:
+    backends: list[OcrBackend] = []
+    for name in ocr_backend_names():
+        if name == "baidu" and api_key and secret_key:
+            backends.append(BaiduOcrBackend(api_key, secret_key, access_token))
+        elif name == "tesseract":
+            local = get_local_ocr_backend()
+            if local is not None:
+                backends.append(local)
+    return backends
+
+
+def ocr_image(
+    image_bytes: bytes,
+    api_key: Optional[str],
+    secret_key: Optional[str],
+    access_token: Optional[str] = None,
+) -> tuple[list[OcrBox], str, int, str]:
+    with span("ocr_image", bytes=len(image_bytes)) as attrs:
+        boxes, image_width, backend = get_ocr_router().recognize(
+            image_bytes,
+            ocr_backends(api_key, secret_key, access_token),
+        )
+        attrs["backend"] = backend
+        with span("layout", boxes=len(boxes)):
+            dialogue = build_role_dialogue_from_boxes(boxes, image_width=image_width)
+    return boxes, dialogue, image_width, backend
+
+
+def ocr_image_cached(
+    image_bytes: bytes,
+    api_key: Optional[str],
+    secret_key: Optional[str],
+    access_token: Optional[str],
+    cache: OcrResultCache,
+    digest: str,
+) -> str:
+    boxes, dialogue, image_width, backend = ocr_image(image_bytes, api_key, secret_key, access_token)
+    cache.put(digest, boxes, dialogue, image_width, backend)
+    return dialogue
+
+
+def describe_ocr_error(e: Exception) -> str:
+    message = str(e)
+    if message.startswith("circuit_open:"):
+        return f"识别服务暂时不可用，已暂停调用，约 {math.ceil(get_circuit_breaker(message.split(':', 1)[1]).retry_after())} 秒后可重试"
+    if message.startswith("rate_limited:"):
+        return "当前使用人数较多，排队超时，请稍后重试"
+    if message == "deadline_exceeded" or isinstance(e, requests.Timeout):
+        return "识别超时，请稍后重试"
+    if message == "ocr_no_backend":
+        return "没有可用的识别服务：请检查 OCR_BACKENDS 与百度 OCR 密钥配置"
+    if message.startswith("image_over_budget:"):
+        return "图片内容过多，压缩后仍超出识别服务的大小限制，请裁成几张后重新上传"
+    return message
+
+
+def run_ocr_batch(
+    images: list[tuple[str, bytes]],
+    api_key: Optional[str],
+    secret_key: Optional[str],
+    max_workers: int = 4,
+    cache: Optional[OcrResultCache] = None,
+    on_wait: Optional[Callable[[int], None]] = None,
+) -> Iterator[tuple[int, str]]:
+    # 按完成顺序逐张产出 (序号, 片段)，由调用方按序号重新排序拼接。
+    # 命中缓存的图片直接产出；只有存在未命中时才去取 access token。
+    # 等待期间若本会话在 OCR 限流队列里排队，在调用线程回调 on_wait(排队位置)。
+    if cache is None:
+        cache = get_ocr_cache()
+
+    pending: list[tuple[int, str, bytes, str]] = []
+    for idx, (name, data) in enumerate(images, start=1):
+        digest = image_digest(data)
+        dialogue = cache.get_dialogue(digest)
+        if dialogue is not None:
+            yield idx, f"--- 图{idx}：{name} ---\n{dialogue or NO_DIALOGUE_NOTE}"
         else:
-            # 坐标判定算法（V1.5）：
-            # 1) 按 top 从上到下排序
-            # 2) 计算 gap = current_top - last_bottom_y
-            #    - gap 很小：视为同一气泡内换行，继承 last_speaker，并拼接到上一句
-            #    - gap 很大：视为新气泡，才做 X 坐标中心点判定
-            # 3) X 坐标判定：Center_X = left + (width / 2)
-            #    - Center_X < ImageWidth/2 -> 【对方】
-            #    - Center_X > ImageWidth/2 -> 【我】
-            center_x = left + (width / 2.0)
-            speaker = "对方" if center_x < (image_width / 2.0) else "我"
-            last_speaker = speaker
-            dialogue_lines.append(f"【{speaker}】: {text}")
-
-        last_bottom_y = max(last_bottom_y, top + height)
-        last_line_height = height
-
-    return "\n".join(dialogue_lines).strip()
-
-
-def analyze_chat(transcript: str, model: str, style_mode: Optional[str]) -> str:
-    client = build_client()
-    system_prompt = build_system_prompt(style_mode)
-    resp = client.chat.completions.create(
-        model=model,
-        temperature=0.2,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": transcript},
-        ],
+            pending.append((idx, name, data, digest))
+    if not pending:
+        return
+
+    # access token 先取一次再交给工作线程，取 token 失败时整批直接给出失败说明；
+    # 配了本地识别引擎时不放弃，交给路由逐张回退到本地。
+    access_token: Optional[str] = None
+    if api_key and secret_key and "baidu" in ocr_backend_names():
+        try:
+            access_token = ensure_baidu_access_token(api_key, secret_key)
+        except Exception as e:
+            if get_local_ocr_backend() is None:
+                for idx, name, _, _ in pending:
+                    yield idx, f"--- 图{idx}：{name} ---\n（OCR 失败：{describe_ocr_error(e)}）"
+                return
+
+    workers = max(1, min(int(max_workers), len(pending)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sq-ocr") as pool:
+        futures = {
+            submit_with_context(
+                pool,
+                ocr_image_cached,
+                data,
+                api_key,
+                secret_key,
+                access_token,
+                cache,
+                digest,
+            ): (idx, name)
+            for idx, name, data, digest in pending
+        }
+        limiter = get_upstream_limiter("baidu_ocr")
+        not_done = set(futures)
+        try:
+            while not_done:
+                done, not_done = wait(not_done, timeout=0.5, return_when=FIRST_COMPLETED)
+                if not done:
+                    position = limiter.queue_position()
+                    if on_wait and position:
+                        on_wait(position)
+                    continue
+                for future in done:
+                    idx, name = futures[future]
+                    try:
+                        dialogue = future.result()
+                    except Exception as e:
+                        yield idx, f"--- 图{idx}：{name} ---\n（OCR 失败：{describe_ocr_error(e)}）"
+                    else:
+                        yield idx, f"--- 图{idx}：{name} ---\n{dialogue or NO_DIALOGUE_NOTE}"
+        finally:
+            # 调用方提前停止（例如后台识别被新的上传取代）时，还没开始的图不再识别
+            for future in not_done:
+                future.cancel()
+
+
+def normalize_transcript(transcript: str) -> str:
+    lines = [re.sub(r"\s+", " ", line).strip() for line in (transcript or "").splitlines()]
+    return "\n".join(line for line in lines if line)
+
+
+PROMPT_LAYOUT_VERSION = "base-user-style"
+
+
+def prompt_fingerprint(style_mode: Optional[str]) -> str:
+    payload = f"{PROMPT_LAYOUT_VERSION}\n{build_system_prompt(style_mode)}"
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def report_cache_key(transcript: str, model: str, style_mode: Optional[str]) -> str:
+    # system prompt 的指纹进入缓存键：提示词一改，旧报告自然失效。
+    mode = normalize_style_mode(style_mode)
+    transcript_hash = hashlib.sha256(normalize_transcript(transcript).encode("utf-8")).hexdigest()
+    return f"{transcript_hash}:{mode}:{model}:{prompt_fingerprint(mode)}"
+
+
+@st.cache_resource(show_spinner=False)
+def get_report_cache() -> LRUCache:
+    return LRUCache(
+        max_entries=get_int_setting("REPORT_CACHE_MAX_ENTRIES", 256),
+        max_bytes=get_int_setting("REPORT_CACHE_MAX_MB", 16) * 1024 * 1024,
+        ttl_seconds=get_int_setting("REPORT_CACHE_TTL_SECONDS", 0),
     )
+
+
+DIALOGUE_LINE_RE = re.compile(r"^【(我|对方)】\s*[:：]\s*(.*)$")
+PART_HEADER_RE = re.compile(r"^--- 图\d+[：:].*---$")
+CJK_CHAR_RE = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    # DeepSeek 官方给的换算：1 个中文字符约 0.6 token，1 个英文字符约 0.3 token
+    text = text or ""
+    cjk = len(CJK_CHAR_RE.findall(text))
+    other = len(re.sub(r"\s+", "", text)) - cjk
+    return int(math.ceil(cjk * 0.6 + other * 0.3))
+
+
+def _dialogue_key(line: str) -> Optional[tuple[str, str]]:
+    m = DIALOGUE_LINE_RE.match(line.strip())
+    if not m:
+        return None
+    return m.group(1), re.sub(r"\s+", "", m.group(2))
+
+
+def _dialogue_lines_match(a: str, b: str, clipped: str = "") -> bool:
+    # clipped="head"：b 可能是截图顶部被裁掉上半截的气泡，只剩尾部
+    # clipped="tail"：a 可能是截图底部被裁掉下半截的气泡，只剩开头
+    ka, kb = _dialogue_key(a), _dialogue_key(b)
+    if ka is None or kb is None or ka[0] != kb[0]:
+        return False
+    ta, tb = ka[1], kb[1]
+    if ta == tb:
+        return True
+    if clipped == "head" and len(tb) >= 4 and ta.endswith(tb):
+        return True
+    if clipped == "tail" and len(ta) >= 4 and tb.startswith(ta):
+        return True
+    if min(len(ta), len(tb)) < 6:
+        return False
+    return SequenceMatcher(None, ta, tb, autojunk=False).ratio() >= 0.85
+
+
+def find_dialogue_overlap(prev_lines: list[str], next_lines: list[str], max_overlap: int = 30) -> int:
+    # 找最长的 k：上一张尾部 k 行与下一张头部 k 行逐行对齐
+    for k in range(min(len(prev_lines), len(next_lines), max_overlap), 0, -1):
+        tail = prev_lines[-k:]
+        if not all(
+            _dialogue_lines_match(
+                tail[i],
+                next_lines[i],
+                clipped="head" if i == 0 else ("tail" if i == k - 1 else ""),
+            )
+            for i in range(k)
+        ):
+            continue
+        if k == 1:
+            # 单行重叠容易误伤“好的”“嗯”这类常见短回复，要求足够长
+            key = _dialogue_key(next_lines[0])
+            if key is None or len(key[1]) < 8:
+                continue
+        return k
+    return 0
+
+
+DUPLICATE_PART_NOTE = "（与上一张截图内容重复，已省略）"
+PENDING_PART_NOTE = "（识别中...）"
+
+
+def merge_dialogue_parts(parts: list[str]) -> tuple[str, dict]:
+    # 按顺序拼接各张截图的片段，去掉相邻截图之间重复截进去的气泡。
+    blocks: list[tuple[list[str], list[str]]] = []
+    prev_body: Optional[list[str]] = None
+    lines_removed = 0
+    tokens_removed = 0
+
+    for part in parts:
+        lines = [line for line in part.strip().splitlines() if line.strip()]
+        header = lines[:1] if lines and PART_HEADER_RE.match(lines[0].strip()) else []
+        body = lines[len(header):]
+        is_dialogue = bool(body) and all(_dialogue_key(line) is not None for line in body)
+
+        if is_dialogue and prev_body:
+            k = find_dialogue_overlap(prev_body, body)
+            if k:
+                removed = body[:k]
+                if len(removed[-1]) > len(prev_body[-1]):
+                    # 上一张最后一行是被裁断的半句，换成这一张里的完整版本
+                    prev_body[-1], removed[-1] = removed[-1], prev_body[-1]
+                lines_removed += k
+                tokens_removed += estimate_tokens("\n".join(removed))
+                body = body[k:]
+
+        if is_dialogue and not body:
+            # 整张都与上一张重复：保留标题占位，继续拿上一张的尾部和下一张对齐
+            blocks.append((header, [DUPLICATE_PART_NOTE]))
+            continue
+
+        blocks.append((header, body))
+        # OCR 失败说明等非对话内容打断连续性，不跨过它去对齐
+        prev_body = body if is_dialogue else None
+
+    merged = "\n\n".join("\n".join(header + body).strip() for header, body in blocks).strip()
+    return merged, {"lines_removed": lines_removed, "tokens_removed": tokens_removed}
+
+
+# 系统提示只按整行匹配，且只用于没有说话人标记的行：消息正文里提到“拍了拍”“撤回”不能被当成系统提示删掉
+SYSTEM_ACTOR_PATTERN = r'(?:我|你|对方|"[^"]{1,20}"|“[^”]{1,20}”)'
+SYSTEM_LINE_RE = re.compile(
+    r"^(?:"
+    rf"{SYSTEM_ACTOR_PATTERN}\s*撤回了一条消息"
+    rf"|{SYSTEM_ACTOR_PATTERN}\s*拍了拍\s*(?:自己|{SYSTEM_ACTOR_PATTERN})[^\s，,。！？!?]{{0,12}}"
+    r"|以下[为是]新消息|以上是打招呼的内容"
+    r"|你已添加了.{1,24}?[，,]?现在可以开始聊天了。?"
+    r"|.{1,24}?开启了朋友验证.*"
+    r"|消息已发出，但被对方拒收了?。?"
+    r"|对方正在输入[.…。]*"
+    r")$"
+)
+SPEAKER_PREFIX_RE = re.compile(r"^(?:【\s*)?(我|对方)(?:\s*】)?\s*[:：]\s*(.*)$")
+# 精简后的说话人标记：【我】/【对方】，以及导出格式里带出来的昵称
+SPEAKER_TAG_RE = re.compile(r"^【\s*([^【】\s]{1,12})\s*】\s*[:：]\s*(.*)$")
+DATE_TIME_PATTERN = r"\d{4}[-/.]\d{1,2}[-/.]\d{1,2}\s+\d{1,2}:\d{2}(?::\d{2})?"
+EXPORT_HEADER_RE = re.compile(rf"^(?:(.+?)\s+{DATE_TIME_PATTERN}|{DATE_TIME_PATTERN}\s+(.+?))$")
+LEADING_TIMESTAMP_RE = re.compile(
+    r"^[\[(（]?(?:\d{4}[-/.]\d{1,2}[-/.]\d{1,2}\s+)?(?:上午|下午)?\d{1,2}:\d{2}(?::\d{2})?[\])）]?\s+"
+)
+
+
+def match_speaker(line: str) -> Optional[re.Match]:
+    return SPEAKER_PREFIX_RE.match(line) or SPEAKER_TAG_RE.match(line)
+
+
+def compact_transcript(transcript: str) -> str:
+    # 发给模型前的精简：去掉截图标题、OCR 说明、时间戳、系统提示和多余空白，统一说话人标记。
+    lines: list[str] = []
+    export_speaker: Optional[str] = None
+    for raw in (transcript or "").splitlines():
+        line = WHITESPACE_RE.sub(" ", raw).strip()
+        if not line or PART_HEADER_RE.match(line):
+            continue
+        if line.startswith("（OCR 失败") or line in (NO_DIALOGUE_NOTE, DUPLICATE_PART_NOTE, PENDING_PART_NOTE):
+            continue
+        if is_timestamp_line(line):
+            continue
+
+        stripped = LEADING_TIMESTAMP_RE.sub("", line)
+        m = match_speaker(stripped)
+        if m:
+            # 带说话人标记的行自成一句，也结束了上面导出格式的发言块
+            export_speaker = None
+            line = f"【{m.group(1)}】: {m.group(2).strip()}"
+        else:
+            # 微信导出格式：“昵称 2024-02-16 21:03:12” 单独一行，下面几行是这个人说的话
+            header = EXPORT_HEADER_RE.match(line)
+            if header:
+                export_speaker = (header.group(1) or header.group(2) or "").strip() or None
+                continue
+            line = stripped
+            if SYSTEM_LINE_RE.match(line):
+                continue
+            if export_speaker:
+                # 昵称只认导出格式的标题行；正文里的“结论：……”之类不是说话人
+                line = f"【{export_speaker}】: {line}"
+
+        if lines and lines[-1] == line:
+            continue
+        lines.append(line)
+    return "\n".join(lines)
+
+
+TRUNCATED_NOTE = "（聊天记录过长，以下仅保留最近的部分）"
+
+
+def fit_transcript_to_budget(transcript: str, budget_tokens: int) -> tuple[str, bool]:
+    # 超出预算时从后往前保留最近的对话：争执的落点通常在最后
+    if budget_tokens <= 0 or estimate_tokens(transcript) <= budget_tokens:
+        return transcript, False
+    kept: list[str] = []
+    used = estimate_tokens(TRUNCATED_NOTE)
+    for line in reversed(transcript.splitlines()):
+        cost = estimate_tokens(line) + 1
+        if used + cost > budget_tokens:
+            break
+        kept.append(line)
+        used += cost
+    kept.append(TRUNCATED_NOTE)
+    return "\n".join(reversed(kept)), True
+
+
+@dataclass
+class PreparedTranscript:
+    text: str
+    raw_tokens: int
+    tokens: int
+    truncated: bool
+
+
+def prepare_transcript(transcript: str, budget_tokens: Optional[int] = None) -> PreparedTranscript:
+    if budget_tokens is None:
+        budget_tokens = get_int_setting("TRANSCRIPT_TOKEN_BUDGET", 120000)
+    compacted = compact_transcript(transcript)
+    text, truncated = fit_transcript_to_budget(compacted, budget_tokens)
+    return PreparedTranscript(
+        text=text,
+        raw_tokens=estimate_tokens(transcript),
+        tokens=estimate_tokens(text),
+        truncated=truncated,
+    )
+
+
+def usage_to_dict(usage: Any) -> dict:
+    if usage is None:
+        return {}
+    prompt_tokens = int(getattr(usage, "prompt_tokens", 0) or 0)
+    # DeepSeek 直接给出 prompt_cache_hit/miss_tokens；OpenAI 兼容格式放在 prompt_tokens_details.cached_tokens
+    hit = getattr(usage, "prompt_cache_hit_tokens", None)
+    if hit is None:
+        details = getattr(usage, "prompt_tokens_details", None)
+        hit = getattr(details, "cached_tokens", None) if details is not None else None
+    hit = int(hit or 0)
+    miss = getattr(usage, "prompt_cache_miss_tokens", None)
+    miss = int(miss) if miss is not None else max(0, prompt_tokens - hit)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": int(getattr(usage, "completion_tokens", 0) or 0),
+        "prompt_cache_hit_tokens": hit,
+        "prompt_cache_miss_tokens": miss,
+    }
+
+
+class UsageStats:
+    def __init__(self, recent_size: int = 200) -> None:
+        self.calls = 0
+        self.totals: dict[str, int] = {}
+        self.by_label: dict[str, dict[str, int]] = {}
+        self.recent: "deque[dict]" = deque(maxlen=recent_size)
+        self._lock = threading.Lock()
+
+    def record(self, label: str, model: str, usage: dict) -> None:
+        if not usage:
+            return
+        with self._lock:
+            self.calls += 1
+            per_label = self.by_label.setdefault(label, {"calls": 0})
+            per_label["calls"] += 1
+            for key, value in usage.items():
+                self.totals[key] = self.totals.get(key, 0) + value
+                per_label[key] = per_label.get(key, 0) + value
+            self.recent.append({"label": label, "model": model, "at": time.time(), **usage})
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            hit = self.totals.get("prompt_cache_hit_tokens", 0)
+            miss = self.totals.get("prompt_cache_miss_tokens", 0)
+            return {
+                "calls": self.calls,
+                "totals": dict(self.totals),
+                "by_label": {k: dict(v) for k, v in self.by_label.items()},
+                "prompt_cache_hit_rate": hit / (hit + miss) if hit + miss else 0.0,
+                "recent": list(self.recent),
+            }
+
+
+@st.cache_resource(show_spinner=False)
+def get_usage_stats() -> UsageStats:
+    return UsageStats()
+
+
+def complete_chat(
+    messages: list[dict],
+    model: str,
+    label: str = "report",
+    usage_sink: Optional[dict] = None,
+) -> str:
+    client = build_client()
+    breaker = get_circuit_breaker("llm")
+    breaker.check()
+    get_upstream_limiter("llm").acquire()
+    started = time.monotonic()
+
+    def attempt(is_hedge: bool) -> Any:
+        if is_hedge:
+            get_upstream_limiter("llm").acquire()
+        with breaker.guard(), span("llm_complete", label=label, model=model, hedge=is_hedge) as attrs:
+            resp = client.chat.completions.create(
+                model=model,
+                temperature=0.2,
+                messages=messages,
+                timeout=remaining_time(get_float_setting("DEEPSEEK_TIMEOUT_SECONDS", 60)),
+            )
+            usage = usage_to_dict(getattr(resp, "usage", None))
+            attrs.update(usage)
+        get_usage_stats().record(label, model, usage)
+        return resp, usage
+
+    delay = hedge_delay("llm_complete")
+    # 对冲请求算在同一个名额里：它只在首个请求迟迟不回时短暂并存
+    with llm_slot():
+        if delay is None:
+            resp, usage = attempt(False)
+        else:
+            resp, usage = hedged_call(lambda: attempt(False), lambda: attempt(True), delay)
+    get_latency_window("llm_complete").record(time.monotonic() - started)
+    if usage_sink is not None:
+        usage_sink.update(usage)
     content = (resp.choices[0].message.content or "").strip()
     if not content:
         raise RuntimeError("empty_response")
     return content
 
 
-def main() -> None:
-    st.set_page_config(
-        page_title="Sober Queen",
-        page_icon="👑",
-        layout="wide",
-        initial_sidebar_state="collapsed",
+def close_stream(stream: Any) -> None:
+    close = getattr(stream, "close", None)
+    if close is not None:
+        close()
+
+
+def stream_chat(
+    messages: list[dict],
+    model: str,
+    label: str = "report",
+    usage_sink: Optional[dict] = None,
+    on_wait: Optional[Callable[[int], None]] = None,
+) -> Iterator[str]:
+    client = build_client()
+    breaker = get_circuit_breaker("llm")
+    breaker.check()
+    get_upstream_limiter("llm").acquire(on_wait=on_wait)
+    started = time.monotonic()
+
+    def open_stream(is_hedge: bool) -> tuple[Any, Iterator[Any], list[Any]]:
+        # 打开流并读到第一个带正文的 chunk：对冲只针对“建连 + 首包”这段最容易卡住的时间
+        if is_hedge:
+            get_upstream_limiter("llm").acquire()
+        with breaker.guard(), span("llm_first_chunk", label=label, model=model, hedge=is_hedge):
+            stream = client.chat.completions.create(
+                model=model,
+                temperature=0.2,
+                stream=True,
+                stream_options={"include_usage": True},
+                messages=messages,
+                timeout=remaining_time(get_float_setting("DEEPSEEK_TIMEOUT_SECONDS", 60)),
+            )
+            iterator = iter(stream)
+            prefetched: list[Any] = []
+            try:
+                for chunk in iterator:
+                    prefetched.append(chunk)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        break
+            except BaseException:
+                close_stream(stream)
+                raise
+        return stream, iterator, prefetched
+
+    # 名额一直占到流读完或被关闭为止
+    with llm_slot():
+        delay = hedge_delay("llm_first_chunk")
+        if delay is None:
+            stream, iterator, prefetched = open_stream(False)
+        else:
+            stream, iterator, prefetched = hedged_call(
+                lambda: open_stream(False),
+                lambda: open_stream(True),
+                delay,
+                on_discard=lambda opened: close_stream(opened[0]),
+            )
+        get_latency_window("llm_first_chunk").record(time.monotonic() - started)
+        attrs: dict = {"label": label, "model": model, "first_chunk_ms": round((time.monotonic() - started) * 1000, 2)}
+        error: Optional[str] = None
+        try:
+            for chunk in chain(prefetched, iterator):
+                # 开启 include_usage 后，最后一个 chunk 没有 choices，只带本次用量
+                if getattr(chunk, "usage", None) is not None:
+                    usage = usage_to_dict(chunk.usage)
+                    attrs.update(usage)
+                    get_usage_stats().record(label, model, usage)
+                    if usage_sink is not None:
+                        usage_sink.update(usage)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+                remaining_time()
+        except Exception as e:
+            error = str(e)[:200] if isinstance(e, RuntimeError) else type(e).__name__
+            if counts_as_upstream_failure(e) and str(e) != "deadline_exceeded":
+                breaker.record_failure()
+            raise
+        finally:
+            # 调用方提前结束（例如后台预生成被取消）时及时断开上游连接
+            close_stream(stream)
+            record_span("llm_stream", started, attrs, error)
+
+
+CHUNK_EXTRACT_PROMPT = """\
+你是 Sober Queen 的聊天记录预处理助手。用户会给你一段较长聊天记录中的某一段（按时间顺序切分）。
+只做事实与逻辑要点提炼：不写诊断报告、不下结论、不寒暄，直接按以下格式输出 Markdown：
+- **本段议题：** 这一段在争什么、有没有切换话题
+- **关键原话：** 逐条照抄对理解冲突最关键的原话，保留【我】/【对方】等说话人标记，最多 8 条
+- **逻辑问题线索：** 可能的概念混淆、偷换前提、以偏概全、议题漂移等，每条附对应原话
+- **互动动作：** 谁在追问、解释、回避、指责、撤退
+- **情绪与边界信号：** 明显的情绪表达、贬损用语、边界表述
+信息不足的条目写“无”。
+"""
+
+MAP_REDUCE_SYNTHESIS_NOTE = """\
+以下聊天记录较长，已按时间顺序分为 {total} 段，并逐段提炼了事实与逻辑要点。
+请把这些要点视为完整的聊天记录，严格按既定格式输出诊断报告；引用证据时使用要点中的原话。
+"""
+
+
+def split_transcript_chunks(transcript: str, max_tokens: int) -> list[str]:
+    # 只在说话人换人的行首切分；从头贪心装箱，后续追加聊天时前面的分段保持不变，分段缓存才能命中。
+    turns: list[list[str]] = []
+    for line in transcript.splitlines():
+        if not line.strip():
+            continue
+        if not turns or match_speaker(line):
+            turns.append([line])
+        else:
+            turns[-1].append(line)
+
+    chunks: list[str] = []
+    current: list[str] = []
+    used = 0
+    for turn in turns:
+        text = "\n".join(turn)
+        cost = estimate_tokens(text) + 1
+        if current and used + cost > max_tokens:
+            chunks.append("\n".join(current))
+            current, used = [], 0
+        current.append(text)
+        used += cost
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+@st.cache_resource(show_spinner=False)
+def get_chunk_notes_cache() -> LRUCache:
+    return LRUCache(
+        max_entries=get_int_setting("CHUNK_CACHE_MAX_ENTRIES", 2048),
+        max_bytes=get_int_setting("CHUNK_CACHE_MAX_MB", 32) * 1024 * 1024,
     )
 
-    st.markdown(
-        """
-        <style>
-          .stApp {
-            background: #FAFAFB;
-          }
-          [data-testid="stHeader"] { background: transparent; }
-          #MainMenu, footer { visibility: hidden; }
-
-          section.main .block-container {
-            max-width: 1120px;
-            padding-top: 2.0rem;
-            padding-bottom: 3.0rem;
-          }
-
-          html, body, [data-testid="stAppViewContainer"], .stApp {
-            color: #111827;
-          }
-          .stMarkdown, .stMarkdown p, .stMarkdown li, .stMarkdown span {
-            color: #111827;
-          }
-
-          section.main div[data-testid="stVerticalBlockBorderWrapper"] {
-            background: #FFFFFF;
-            border: 1px solid #EEEFF2;
-            border-radius: 16px;
-            box-shadow: 0 1px 8px rgba(17, 24, 39, 0.04);
-            padding: 20px 18px;
-          }
-          section.main div[data-testid="stVerticalBlockBorderWrapper"]:hover {
-            box-shadow: 0 6px 18px rgba(17, 24, 39, 0.06);
-          }
-
-          section.main div[data-testid="stVerticalBlockBorderWrapper"] > div {
-            border: none !important;
-          }
-
-          [data-testid="stFileUploader"] {
-            background: transparent;
-            border: none;
-          }
-
-          .stTextArea textarea {
-            border-radius: 12px;
-            min-height: 240px !important;
-            height: 260px !important;
-            max-height: 360px !important;
-            overflow: auto !important;
-          }
-          .stTextArea textarea, .stTextArea textarea::placeholder {
-            color: #111827;
-          }
-
-          .stButton button {
-            border-radius: 12px;
-            font-weight: 700;
-            border: none;
-            background: #FF3B7A;
-            color: #FFFFFF;
-            box-shadow: 0 8px 18px rgba(255, 59, 122, 0.20);
-          }
-          .stButton button:hover {
-            background: #ff2f72;
-            color: #FFFFFF;
-          }
-          .stButton button:active {
-            transform: translateY(0.5px);
-          }
-
-          [data-testid="stProgress"] {
-            background: rgba(255, 59, 122, 0.10);
-            border-radius: 999px;
-          }
-          [data-testid="stProgress"] > div > div > div {
-            background: #FF3B7A !important;
-          }
-
-          [data-testid="stAlert"] {
-            background: rgba(255, 59, 122, 0.06);
-            border: 1px solid rgba(255, 59, 122, 0.16);
-            border-radius: 14px;
-          }
-
-          .sq-report h1, .sq-report h2, .sq-report h3 {
-            color: #111827;
-            letter-spacing: 0.2px;
-          }
-          .sq-report p, .sq-report li {
-            line-height: 1.7;
-            letter-spacing: 0.15px;
-          }
-
-          button[aria-label="开始诊断"] {
-            font-size: 1.05rem;
-            padding: 0.85rem 1rem;
-            border-radius: 16px;
-          }
-          button[aria-label="清空本次内容"] {
-            background: transparent !important;
-            color: #FF3B7A !important;
-            border: 1px solid rgba(255, 59, 122, 0.45) !important;
-            box-shadow: none !important;
-          }
-          button[aria-label="清空本次内容"]:hover {
-            background: rgba(255, 59, 122, 0.06) !important;
-            border: 1px solid rgba(255, 59, 122, 0.60) !important;
-          }
-
-          [data-testid="stSegmentedControl"],
-          [data-testid="stPills"] {
-            width: 100%;
-          }
-          [data-testid="stSegmentedControl"] [role="radiogroup"],
-          [data-testid="stPills"] [role="listbox"] {
-            flex-wrap: wrap;
-            gap: 8px;
-          }
-
-          @media (max-width: 900px) {
-            section.main .block-container { max-width: 760px; }
-          }
-
-          .sq-muted {
-            color: #6B7280 !important;
-          }
-        </style>
-        """,
-        unsafe_allow_html=True,
+
+class SingleFlight:
+    # 同一个键同时只放一个线程去算，其他线程等它算完再查缓存；键在最后一个使用者离开时删除，不随历史请求增长
+    def __init__(self) -> None:
+        self._locks: dict[str, tuple[threading.Lock, int]] = {}
+        self._guard = threading.Lock()
+
+    @contextmanager
+    def hold(self, key: str) -> Iterator[None]:
+        with self._guard:
+            lock, users = self._locks.get(key) or (threading.Lock(), 0)
+            self._locks[key] = (lock, users + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self._guard:
+                lock, users = self._locks[key]
+                if users == 1:
+                    del self._locks[key]
+                else:
+                    self._locks[key] = (lock, users - 1)
+
+
+@st.cache_resource(show_spinner=False)
+def get_chunk_notes_flight() -> SingleFlight:
+    return SingleFlight()
+
+
+def extract_chunk_notes(chunk: str, model: str) -> str:
+    cache = get_chunk_notes_cache()
+    prompt_hash = hashlib.sha256(CHUNK_EXTRACT_PROMPT.encode("utf-8")).hexdigest()[:16]
+    cache_key = f"{hashlib.sha256(chunk.encode('utf-8')).hexdigest()}:{model}:{prompt_hash}"
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return str(cached)
+    # 前台报告和后台预生成的另外两种风格会同时提炼同一批分段：只让第一个真正调用模型，其余等它写进缓存
+    with get_chunk_notes_flight().hold(cache_key):
+        if cache.peek(cache_key):
+            cached = cache.get(cache_key)
+            if cached is not None:
+                return str(cached)
+        notes = complete_chat(
+            [
+                {"role": "system", "content": CHUNK_EXTRACT_PROMPT},
+                {"role": "user", "content": chunk},
+            ],
+            model,
+            label="map",
+        )
+        cache.put(cache_key, notes, size=len(notes.encode("utf-8")))
+    return notes
+
+
+def needs_map_reduce(transcript: str) -> bool:
+    return estimate_tokens(transcript) > get_int_setting("MAP_REDUCE_THRESHOLD_TOKENS", 6000)
+
+
+def build_map_reduce_input(
+    transcript: str,
+    model: str,
+    on_progress: Optional[Callable[[str], None]] = None,
+) -> str:
+    chunks = split_transcript_chunks(transcript, get_int_setting("MAP_REDUCE_CHUNK_TOKENS", 3000))
+    total = len(chunks)
+    notes: dict[int, str] = {}
+    if on_progress:
+        on_progress(f"聊天记录较长，正在分 {total} 段并行提炼要点...")
+
+    workers = max(1, min(get_int_setting("MAP_REDUCE_MAX_WORKERS", 4), total))
+    with span("map_reduce", chunks=total), ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sq-map") as pool:
+        futures = {
+            submit_with_context(pool, extract_chunk_notes, chunk, model): idx for idx, chunk in enumerate(chunks, start=1)
+        }
+        for future in as_completed(futures):
+            notes[futures[future]] = future.result()
+            if on_progress:
+                on_progress(f"已提炼 {len(notes)}/{total} 段要点...")
+
+    sections = [f"### 第 {idx} 段要点\n{notes[idx]}" for idx in sorted(notes)]
+    return MAP_REDUCE_SYNTHESIS_NOTE.format(total=total) + "\n" + "\n\n".join(sections)
+
+
+def analyze_chat(
+    transcript: str,
+    model: str,
+    style_mode: Optional[str],
+    usage_sink: Optional[dict] = None,
+) -> str:
+    cache = get_report_cache()
+    cache_key = report_cache_key(transcript, model, style_mode)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return str(cached)
+
+    user_content = build_map_reduce_input(transcript, model) if needs_map_reduce(transcript) else transcript
+    content = complete_chat(build_analysis_messages(user_content, style_mode), model, usage_sink=usage_sink)
+    cache.put(cache_key, content, size=len(content.encode("utf-8")))
+    return content
+
+
+def stream_analyze_chat(
+    transcript: str,
+    model: str,
+    style_mode: Optional[str],
+    on_progress: Optional[Callable[[str], None]] = None,
+    usage_sink: Optional[dict] = None,
+) -> Iterator[str]:
+    cache = get_report_cache()
+    cache_key = report_cache_key(transcript, model, style_mode)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        yield str(cached)
+        return
+
+    # 超长记录走 map-reduce：各段并行提炼要点，再用标准格式流式合成报告
+    user_content = build_map_reduce_input(transcript, model, on_progress) if needs_map_reduce(transcript) else transcript
+    on_wait = (lambda position: on_progress(f"当前使用人数较多，正在排队（第 {position} 位）...")) if on_progress else None
+    chunks: list[str] = []
+    for delta in stream_chat(build_analysis_messages(user_content, style_mode), model, usage_sink=usage_sink, on_wait=on_wait):
+        chunks.append(delta)
+        yield delta
+
+    content = "".join(chunks).strip()
+    if not content:
+        raise RuntimeError("empty_response")
+    cache.put(cache_key, content, size=len(content.encode("utf-8")))
+
+
+SECTION_REGENERATE_PROMPT = """\
+请只重写上面这份报告的第 {number} 节「{title}」：
+- 严格沿用输出格式中这一节的结构，第一行输出这一节的小标题（#### {title}），之后不要输出其它小节
+- 与报告其余小节的事实和判断保持一致，引用证据仍使用聊天记录原话
+- 换一个角度或表述给出新版本，不要照抄原来的内容；不要寒暄
+"""
+
+
+def build_section_messages(user_content: str, style_mode: Optional[str], report: ParsedReport, number: int) -> list[dict]:
+    # 前两条与整份报告的请求逐字节相同，上游前缀缓存可以命中；之后只要求输出一节，输出 token 约为整份的六分之一
+    section = report.section(number)
+    title = section.title if section is not None else str(number)
+    return build_analysis_messages(user_content, style_mode) + [
+        {"role": "assistant", "content": report.to_markdown()},
+        {"role": "user", "content": SECTION_REGENERATE_PROMPT.format(number=number, title=title)},
+    ]
+
+
+def extract_section_body(output: str, number: int) -> str:
+    # 模型偶尔多带出别的小节或漏掉小标题：有对应小标题就只取这一节的正文，否则整段当作正文
+    parsed = parse_report(output)
+    section = parsed.section(number)
+    if section is not None:
+        return section.body
+    return output.strip()
+
+
+def stream_regenerate_section(
+    transcript: str,
+    model: str,
+    style_mode: Optional[str],
+    report: ParsedReport,
+    number: int,
+    on_progress: Optional[Callable[[str], None]] = None,
+    usage_sink: Optional[dict] = None,
+) -> Iterator[str]:
+    if report.section(number) is None:
+        raise RuntimeError(f"unknown_section:{number}")
+    user_content = build_map_reduce_input(transcript, model, on_progress) if needs_map_reduce(transcript) else transcript
+    on_wait = (lambda position: on_progress(f"当前使用人数较多，正在排队（第 {position} 位）...")) if on_progress else None
+    yield from stream_chat(
+        build_section_messages(user_content, style_mode, report, number),
+        model,
+        label="section",
+        usage_sink=usage_sink,
+        on_wait=on_wait,
     )
 
-    st.markdown("# 👑 Sober Queen")
-    st.markdown('<div class="sq-muted">一键粉碎无效沟通与情绪内耗</div>', unsafe_allow_html=True)
 
+def regenerate_section(
+    transcript: str,
+    model: str,
+    style_mode: Optional[str],
+    report: ParsedReport,
+    number: int,
+    usage_sink: Optional[dict] = None,
+) -> ParsedReport:
+    content = "".join(stream_regenerate_section(transcript, model, style_mode, report, number, usage_sink=usage_sink))
+    return apply_regenerated_section(transcript, model, style_mode, report, number, content)
+
+
+def apply_regenerated_section(
+    transcript: str,
+    model: str,
+    style_mode: Optional[str],
+    report: ParsedReport,
+    number: int,
+    content: str,
+) -> ParsedReport:
+    # 把重写的一节替换进报告；新报告写回报告缓存，之后切回这个风格看到的是最新版本
+    body = extract_section_body(content, number)
+    if not body:
+        raise RuntimeError("empty_response")
+    updated = report.replace(number, body)
+    markdown = updated.to_markdown()
+    get_report_cache().put(report_cache_key(transcript, model, style_mode), markdown, size=len(markdown.encode("utf-8")))
+    return updated
+
+
+def transcribe_screenshots(
+    images: list[tuple[str, bytes]],
+    max_workers: Optional[int] = None,
+    on_result: Optional[Callable[[int, int], None]] = None,
+    on_wait: Optional[Callable[[int], None]] = None,
+) -> tuple[str, dict]:
+    # 不依赖 Streamlit 会话的 OCR 流水线：截图 -> 按序拼接并去重的对话。
+    # on_result(已完成张数, 总张数) 与 on_wait(排队位置) 都在调用线程里回调，便于界面或命令行显示进度。
+    api_key, secret_key = get_baidu_ocr_credentials()
+    if max_workers is None:
+        max_workers = get_int_setting("OCR_MAX_WORKERS", 4)
+    results: dict[int, str] = {}
+    with start_trace("ocr"), deadline_scope(get_float_setting("OCR_DEADLINE_SECONDS", 120)):
+        for idx, part in run_ocr_batch(images, api_key=api_key, secret_key=secret_key, max_workers=max_workers, on_wait=on_wait):
+            results[idx] = part
+            if on_result:
+                on_result(len(results), len(images))
+    return merge_dialogue_parts([results[i] for i in sorted(results)])
+
+
+@st.cache_resource(show_spinner=False)
+def get_ocr_job_executor() -> ThreadPoolExecutor:
+    # 进程级线程池：同时在后台识别的上传批次上限，每批内部仍按 OCR_MAX_WORKERS 并发
+    return ThreadPoolExecutor(
+        max_workers=max(1, get_int_setting("OCR_JOB_MAX_CONCURRENCY", 4)),
+        thread_name_prefix="sq-ocr-job",
+    )
+
+
+class OcrJob:
+    # 一次上传对应一个后台识别任务：逐张完成的片段存在任务里，挂在会话上，
+    # 脚本重跑、点别的控件都不会打断它，也不会把已识别的图再识别一遍。
+    def __init__(self, signature: str, names: list[str]) -> None:
+        self.signature = signature
+        self.names = names
+        self.parts: dict[int, str] = {}
+        self.queue_position = 0
+        self.trace: Optional[Trace] = None
+        self.cancel_event = threading.Event()
+        self.future: Optional[Future] = None
+        self._lock = threading.Lock()
+
+    def cancel(self) -> None:
+        self.cancel_event.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    def done(self) -> bool:
+        return self.future is None or self.future.done()
+
+    def wait(self, timeout: Optional[float] = None) -> None:
+        if self.future is None or self.future.cancelled():
+            return
+        try:
+            self.future.result(timeout=timeout)
+        except Exception:
+            pass
+
+    def add_part(self, idx: int, part: str) -> None:
+        with self._lock:
+            self.parts[idx] = part
+        self.queue_position = 0
+
+    def progress(self) -> tuple[int, int]:
+        with self._lock:
+            return len(self.parts), len(self.names)
+
+    def transcript(self) -> tuple[str, dict]:
+        # 按原顺序拼接已完成的图，未完成的占位；占位不是对话，去重不会越过它对齐
+        with self._lock:
+            parts = dict(self.parts)
+        return merge_dialogue_parts(
+            [parts.get(idx) or f"--- 图{idx}：{name} ---\n{PENDING_PART_NOTE}" for idx, name in enumerate(self.names, start=1)]
+        )
+
+    def failure(self) -> Optional[BaseException]:
+        if self.future is None or not self.future.done() or self.future.cancelled():
+            return None
+        return self.future.exception()
+
+
+def _run_ocr_job(job: OcrJob, images: list[tuple[str, bytes]], api_key: Optional[str], secret_key: Optional[str], max_workers: int) -> None:
+    if job.cancel_event.is_set():
+        return
+
+    def on_wait(position: int) -> None:
+        job.queue_position = position
+
+    with start_trace("ocr", detached=True) as trace, deadline_scope(get_float_setting("OCR_DEADLINE_SECONDS", 120)):
+        job.trace = trace
+        batch = run_ocr_batch(images, api_key=api_key, secret_key=secret_key, max_workers=max_workers, on_wait=on_wait)
+        try:
+            for idx, part in batch:
+                job.add_part(idx, part)
+                if job.cancel_event.is_set():
+                    return
+        finally:
+            batch.close()
+
+
+def start_ocr_job(signature: str, images: list[tuple[str, bytes]], max_workers: Optional[int] = None) -> OcrJob:
+    # 与 transcribe_screenshots 相同的流水线，只是放到后台跑；结果通过 job.transcript() 随时取
+    api_key, secret_key = get_baidu_ocr_credentials()
+    if max_workers is None:
+        max_workers = get_int_setting("OCR_MAX_WORKERS", 4)
+    job = OcrJob(signature, [name for name, _ in images])
+    job.future = submit_with_context(get_ocr_job_executor(), _run_ocr_job, job, images, api_key, secret_key, max_workers)
+    return job
+
+
+def diagnose_transcript(
+    transcript: str,
+    model: str = "deepseek-chat",
+    style_mode: Optional[str] = None,
+) -> dict:
+    # 不依赖 Streamlit 会话的诊断流水线：精简 -> 生成报告，返回报告与用量信息。
+    prepared = prepare_transcript(transcript)
+    if len(prepared.text.strip()) < 10:
+        raise RuntimeError("transcript_too_short")
+    usage: dict = {}
+    with start_trace("diagnose"), deadline_scope(get_float_setting("ANALYZE_DEADLINE_SECONDS", 180)):
+        report = analyze_chat(prepared.text, model=model, style_mode=style_mode, usage_sink=usage)
+    report = sanitize_report_markdown(report)
+    return {
+        "report": report,
+        "sections": parse_report(report).to_dict()["sections"],
+        "style_mode": normalize_style_mode(style_mode),
+        "model": model,
+        "transcript_tokens": prepared.tokens,
+        "truncated": prepared.truncated,
+        "usage": usage,
+    }
+
+
+@st.cache_resource(show_spinner=False)
+def get_speculative_executor() -> ThreadPoolExecutor:
+    # 进程级线程池：它的大小就是整个进程同时在跑的后台预生成 LLM 调用上限
+    return ThreadPoolExecutor(
+        max_workers=max(1, get_int_setting("SPECULATIVE_MAX_CONCURRENCY", 4)),
+        thread_name_prefix="sq-speculative",
+    )
+
+
+class SpeculativeBatch:
+    def __init__(self, transcript: str, model: str) -> None:
+        self.transcript = transcript
+        self.model = model
+        self.transcript_hash = hashlib.sha256(normalize_transcript(transcript).encode("utf-8")).hexdigest()
+        self.cancel_event = threading.Event()
+        self.futures: dict[str, Future] = {}
+
+    def cancel(self) -> None:
+        self.cancel_event.set()
+        for future in self.futures.values():
+            future.cancel()
+
+    def matches(self, transcript: str) -> bool:
+        return self.transcript_hash == hashlib.sha256(normalize_transcript(transcript).encode("utf-8")).hexdigest()
+
+    def is_ready(self, style_mode: StyleMode) -> bool:
+        return get_report_cache().peek(report_cache_key(self.transcript, self.model, style_mode))
+
+    def wait(self, style_mode: StyleMode, timeout: Optional[float] = None) -> bool:
+        # 还在排队的直接取消，由前台自己生成，不必排在其它会话的预生成后面；已经在跑的最多等 timeout 秒
+        future = self.futures.get(style_mode)
+        if future is None or future.cancel():
+            return False
+        try:
+            future.result(timeout=timeout)
+        except Exception:
+            return False
+        return True
+
+
+def _generate_speculatively(transcript: str, model: str, style_mode: StyleMode, cancel_event: threading.Event) -> None:
+    if cancel_event.is_set():
+        return
+    stream = stream_analyze_chat(transcript, model=model, style_mode=style_mode)
+    try:
+        with start_trace("speculative", detached=True), deadline_scope(get_float_setting("ANALYZE_DEADLINE_SECONDS", 180)):
+            for _ in stream:
+                if cancel_event.is_set():
+                    return
+    finally:
+        stream.close()
+
+
+def start_speculative_generation(transcript: str, model: str, primary_mode: StyleMode) -> SpeculativeBatch:
+    # 后台并发生成另外两种风格，结果进报告缓存；用户切换风格时直接命中缓存。
+    batch = SpeculativeBatch(transcript, model)
+    executor = get_speculative_executor()
+    for mode in STYLE_MODE_LABELS:
+        if mode == primary_mode or batch.is_ready(mode):
+            continue
+        batch.futures[mode] = submit_with_context(executor, _generate_speculatively, transcript, model, mode, batch.cancel_event)
+    return batch
+
+
+def describe_analyze_error(e: Exception) -> str:
+    if isinstance(e, RuntimeError):
+        if str(e).startswith("missing_secret:") or str(e) == "missing_api_key":
+            return "未检测到 DeepSeek 密钥：请在 Streamlit Secrets 配置 DEEPSEEK_API_KEY。"
+        if str(e) == "empty_response":
+            return "模型返回了空内容，请重试一次。"
+        if str(e).startswith("rate_limited:"):
+            return "当前使用人数较多，排队超时，请稍后再试。"
+        if str(e).startswith("circuit_open:"):
+            retry_after = math.ceil(get_circuit_breaker(str(e).split(":", 1)[1]).retry_after())
+            return f"模型服务暂时不可用（连续失败，已暂停调用），请约 {max(1, retry_after)} 秒后重试。"
+        if str(e) == "deadline_exceeded":
+            return "生成超时，请稍后重试一次。"
+        return "发生未知错误，请稍后重试。"
+    if isinstance(e, APITimeoutError):
+        return "模型响应超时，请稍后重试一次。"
+    return f"调用失败：{e}"
+
+
+def render_report_stream(placeholder, transcript: str, model: str, style_mode: StyleMode) -> Optional[str]:
+    chunks: list[str] = []
+    last_render = 0.0
+    usage: dict = {}
+    trace: Optional[Trace] = None
+    try:
+        with start_trace("report") as trace, deadline_scope(get_float_setting("ANALYZE_DEADLINE_SECONDS", 180)):
+            for delta in stream_analyze_chat(
+                transcript,
+                model=model,
+                style_mode=style_mode,
+                on_progress=lambda message: placeholder.caption(message),
+                usage_sink=usage,
+            ):
+                chunks.append(delta)
+                now = time.monotonic()
+                # 控制刷新频率，避免每个 token 都向前端推送一次整段 Markdown
+                if now - last_render >= 0.05:
+                    placeholder.markdown(sanitize_partial_report_markdown("".join(chunks)))
+                    last_render = now
+    except Exception as e:
+        placeholder.empty()
+        st.error(describe_analyze_error(e))
+        return None
+    finally:
+        remember_trace("report", trace)
+
+    report = "".join(chunks).strip()
+    placeholder.markdown(sanitize_report_markdown(report))
+    st.session_state["last_usage"] = usage
+    return report or None
+
+
+def render_section_stream(
+    slot,
+    transcript: str,
+    model: str,
+    style_mode: StyleMode,
+    report: ParsedReport,
+    number: int,
+) -> Optional[ParsedReport]:
+    section = report.section(number)
+    if section is None:
+        return None
+    chunks: list[str] = []
+    last_render = 0.0
+    usage: dict = {}
+    trace: Optional[Trace] = None
+    try:
+        with start_trace("section") as trace, deadline_scope(get_float_setting("ANALYZE_DEADLINE_SECONDS", 180)):
+            for delta in stream_regenerate_section(
+                transcript,
+                model=model,
+                style_mode=style_mode,
+                report=report,
+                number=number,
+                on_progress=lambda message: slot.caption(message),
+                usage_sink=usage,
+            ):
+                chunks.append(delta)
+                now = time.monotonic()
+                if now - last_render >= 0.05:
+                    partial = "".join(chunks).lstrip()
+                    # 小标题还没输出完整时先不渲染正文，避免半行标题闪一下
+                    body = "" if partial.startswith("#") and "\n" not in partial else extract_section_body(partial, number)
+                    slot.markdown(f"#### {section.title}\n{body}")
+                    last_render = now
+            updated = apply_regenerated_section(transcript, model, style_mode, report, number, "".join(chunks))
+    except Exception as e:
+        slot.markdown(f"#### {section.title}\n{section.body}")
+        st.error(describe_analyze_error(e))
+        return None
+    finally:
+        remember_trace("report", trace)
+
+    st.session_state["last_usage"] = usage
+    return updated
+
+
+def remember_trace(kind: str, trace: Optional[Trace]) -> None:
+    if trace is None:
+        return
+    st.session_state.setdefault("last_traces", {})[kind] = {
+        "trace_id": trace.trace_id,
+        "duration_ms": round(trace.duration * 1000, 2),
+        "breakdown": trace.breakdown(),
+    }
+
+
+def debug_panel_enabled() -> bool:
+    return bool(get_int_setting("DEBUG_PANEL", 0)) or st.query_params.get("debug") == "1"
+
+
+def render_debug_panel() -> None:
+    traces = st.session_state.get("last_traces") or {}
+    with st.expander("调试：本次耗时分解", expanded=False):
+        if not traces:
+            st.caption("还没有记录：上传截图或生成一次报告后再来看。")
+            return
+        for kind, title in (("ocr", "截图识别"), ("report", "诊断报告")):
+            trace = traces.get(kind)
+            if not trace:
+                continue
+            st.caption(f"{title} · trace {trace['trace_id']} · 总耗时 {trace['duration_ms']:.0f} ms")
+            st.table(
+                [
+                    {
+                        "阶段": row["stage"],
+                        "次数": row["count"],
+                        "累计 ms": f"{row['total_ms']:.1f}",
+                        "最长 ms": f"{row['max_ms']:.1f}",
+                        "失败": row["errors"],
+                    }
+                    for row in trace["breakdown"]
+                ]
+            )
+
+
+def render_usage_panel() -> None:
+    usage = st.session_state.get("last_usage")
+    stats = get_usage_stats().snapshot()
+    with st.expander("用量与缓存命中", expanded=False):
+        if usage:
+            st.caption(
+                f"本次：输入 {usage.get('prompt_tokens', 0)} tokens"
+                f"（缓存命中 {usage.get('prompt_cache_hit_tokens', 0)} / 未命中 {usage.get('prompt_cache_miss_tokens', 0)}），"
+                f"输出 {usage.get('completion_tokens', 0)} tokens"
+            )
+        elif usage is not None:
+            st.caption("本次：命中报告缓存，未调用模型")
+        totals = stats["totals"]
+        st.caption(
+            f"本进程累计：{stats['calls']} 次调用，输入 {totals.get('prompt_tokens', 0)} tokens，"
+            f"上游缓存命中率 {stats['prompt_cache_hit_rate']:.0%}"
+        )
+
+
+# 全局样式：整页重跑时注入一次，各区块的局部重跑不会重复发送
+APP_CSS = """
+<style>
+  .stApp {
+    background: #FAFAFB;
+  }
+  [data-testid="stHeader"] { background: transparent; }
+  #MainMenu, footer { visibility: hidden; }
+
+  section.main .block-container {
+    max-width: 1120px;
+    padding-top: 2.0rem;
+    padding-bottom: 3.0rem;
+  }
+
+  html, body, [data-testid="stAppViewContainer"], .stApp {
+    color: #111827;
+  }
+  .stMarkdown, .stMarkdown p, .stMarkdown li, .stMarkdown span {
+    color: #111827;
+  }
+
+  section.main div[data-testid="stVerticalBlockBorderWrapper"] {
+    background: #FFFFFF;
+    border: 1px solid #EEEFF2;
+    border-radius: 16px;
+    box-shadow: 0 1px 8px rgba(17, 24, 39, 0.04);
+    padding: 20px 18px;
+  }
+  section.main div[data-testid="stVerticalBlockBorderWrapper"]:hover {
+    box-shadow: 0 6px 18px rgba(17, 24, 39, 0.06);
+  }
+
+  section.main div[data-testid="stVerticalBlockBorderWrapper"] > div {
+    border: none !important;
+  }
+
+  [data-testid="stFileUploader"] {
+    background: transparent;
+    border: none;
+  }
+
+  .stTextArea textarea {
+    border-radius: 12px;
+    min-height: 240px !important;
+    height: 260px !important;
+    max-height: 360px !important;
+    overflow: auto !important;
+  }
+  .stTextArea textarea, .stTextArea textarea::placeholder {
+    color: #111827;
+  }
+
+  .stButton button {
+    border-radius: 12px;
+    font-weight: 700;
+    border: none;
+    background: #FF3B7A;
+    color: #FFFFFF;
+    box-shadow: 0 8px 18px rgba(255, 59, 122, 0.20);
+  }
+  .stButton button:hover {
+    background: #ff2f72;
+    color: #FFFFFF;
+  }
+  .stButton button:active {
+    transform: translateY(0.5px);
+  }
+
+  [data-testid="stProgress"] {
+    background: rgba(255, 59, 122, 0.10);
+    border-radius: 999px;
+  }
+  [data-testid="stProgress"] > div > div > div {
+    background: #FF3B7A !important;
+  }
+
+  [data-testid="stAlert"] {
+    background: rgba(255, 59, 122, 0.06);
+    border: 1px solid rgba(255, 59, 122, 0.16);
+    border-radius: 14px;
+  }
+
+  .sq-report h1, .sq-report h2, .sq-report h3 {
+    color: #111827;
+    letter-spacing: 0.2px;
+  }
+  .sq-report p, .sq-report li {
+    line-height: 1.7;
+    letter-spacing: 0.15px;
+  }
+
+  button[aria-label="开始诊断"] {
+    font-size: 1.05rem;
+    padding: 0.85rem 1rem;
+    border-radius: 16px;
+  }
+  button[aria-label="清空本次内容"] {
+    background: transparent !important;
+    color: #FF3B7A !important;
+    border: 1px solid rgba(255, 59, 122, 0.45) !important;
+    box-shadow: none !important;
+  }
+  button[aria-label="清空本次内容"]:hover {
+    background: rgba(255, 59, 122, 0.06) !important;
+    border: 1px solid rgba(255, 59, 122, 0.60) !important;
+  }
+
+  [data-testid="stSegmentedControl"],
+  [data-testid="stPills"] {
+    width: 100%;
+  }
+  [data-testid="stSegmentedControl"] [role="radiogroup"],
+  [data-testid="stPills"] [role="listbox"] {
+    flex-wrap: wrap;
+    gap: 8px;
+  }
+
+  @media (max-width: 900px) {
+    section.main .block-container { max-width: 760px; }
+  }
+
+  .sq-muted {
+    color: #6B7280 !important;
+  }
+</style>
+"""
+
+
+STYLE_MODE_UI_TO_VALUE: dict[str, StyleMode] = {
+    "专业清醒版": "professional",
+    "姐妹嘴替版": "sister_support",
+    "冷静止损版": "cold_boundary",
+}
+STYLE_MODE_VALUE_TO_UI: dict[StyleMode, str] = {value: label for label, value in STYLE_MODE_UI_TO_VALUE.items()}
+
+
+# 各区块按 fragment 独立重跑：切换风格、编辑记录、重新生成都不会重新走上传/OCR 与整页渲染。
+# 旧版 Streamlit 没有 st.fragment 时退化成普通函数，行为与整页重跑一致。
+_st_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None)
+
+
+def ui_fragment(fn: Callable[..., None], run_every: Optional[float] = None) -> Callable[..., None]:
+    if _st_fragment is None:
+        return fn
+    return _st_fragment(fn, run_every=run_every) if run_every else _st_fragment(fn)
+
+
+def rerun_section() -> None:
+    # 只重跑当前区块；不支持 scope 的版本、或本轮本来就是整页重跑时退回整页重跑
+    try:
+        st.rerun(scope="fragment")
+    except (TypeError, StreamlitAPIException):
+        st.rerun()
+
+
+def upload_signature(uploads: list) -> str:
+    # 以内容哈希作签名：同名换图也能识别，重复上传同一张图不会再跑一遍 OCR。
+    # 哈希按 file_id 记在会话里，每个文件只算一次。
+    known: dict = st.session_state.setdefault("_upload_digests", {})
+    digests = {}
+    for f in uploads:
+        file_id = getattr(f, "file_id", None) or f"{f.name}:{getattr(f, 'size', '')}"
+        digests[file_id] = known.get(file_id) or image_digest(f.getvalue())
+    st.session_state["_upload_digests"] = digests
+    return "|".join(digests.values())
+
+
+def store_report(report: str, style_mode: StyleMode, transcript: Optional[str] = None) -> None:
+    st.session_state["report"] = report
+    # 清洗后的 Markdown 与按小节拆好的结构只算一次，之后报告区重跑直接复用
+    st.session_state["report_markdown"] = sanitize_report_markdown(report)
+    st.session_state["report_sections"] = parse_report(st.session_state["report_markdown"])
+    st.session_state["generated_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    st.session_state["style_mode_used"] = style_mode
+    if transcript is not None:
+        st.session_state["last_input"] = transcript
+
+
+def discard_stale_speculative(text: str) -> Optional[SpeculativeBatch]:
+    speculative: Optional[SpeculativeBatch] = st.session_state.get("_speculative")
+    if speculative is not None and not speculative.matches(text):
+        # 聊天记录改了，之前的后台预生成已经没有意义
+        speculative.cancel()
+        st.session_state.pop("_speculative", None)
+        speculative = None
+    return speculative
+
+
+@ui_fragment
+def render_upload_section() -> None:
     with st.container(border=True):
         uploads = st.file_uploader(
             "上传截图（可多选）",
             type=["png", "jpg", "jpeg"],
             accept_multiple_files=True,
         )
+    notice = st.session_state.pop("_upload_notice", None)
+    if notice:
+        level, message = notice
+        getattr(st, level)(message)
+
+    if not uploads:
+        return
+    ordered = sorted(uploads, key=lambda f: (f.name or "").lower())
+    current_sig = upload_signature(ordered)
+    if current_sig == st.session_state.get("_last_upload_sig"):
+        return
+    st.session_state["_last_upload_sig"] = current_sig
 
-    if uploads:
-        ordered = sorted(uploads, key=lambda f: (f.name or "").lower())
-        current_sig = "|".join([f"{f.name}:{getattr(f, 'size', '')}" for f in ordered])
-        last_sig = st.session_state.get("_last_upload_sig")
-        if current_sig != last_sig:
-            st.session_state["_last_upload_sig"] = current_sig
+    try:
+        get_baidu_ocr_credentials()
+    except RuntimeError as e:
+        if str(e).startswith("missing_secret:"):
+            st.error("未检测到百度 OCR 密钥：请在 Streamlit Secrets 配置 BAIDU_OCR_API_KEY / BAIDU_OCR_SECRET_KEY。")
+        else:
+            st.error("读取百度 OCR 密钥失败：请检查 Secrets 配置。")
+        return
+
+    # 识别放到后台：已完成的图由聊天记录区轮询写入，期间可以编辑或直接诊断
+    previous: Optional[OcrJob] = st.session_state.pop("_ocr_job", None)
+    if previous is not None:
+        previous.cancel()
+    st.session_state["_ocr_job"] = start_ocr_job(current_sig, [(f.name, f.getvalue()) for f in ordered])
+    st.session_state["_ocr_written"] = st.session_state.get("transcript") or ""
+    st.session_state.pop("_ocr_result", None)
+    st.session_state.pop("report", None)
+    # 聊天记录区要切换成轮询模式，报告区要清掉旧报告，这里整页重跑一次
+    st.rerun()
+
+
+def sync_ocr_job(job: OcrJob) -> None:
+    # 把后台已完成的图写进聊天记录；用户改过聊天记录后不再覆盖，识别完成后改为提供一键替换
+    merged, dedupe_stats = job.transcript()
+    current = st.session_state.get("transcript") or ""
+    edited = current != st.session_state.get("_ocr_written")
+    if not edited and merged != current:
+        st.session_state["transcript"] = merged
+        st.session_state["_ocr_written"] = merged
+    if not job.done():
+        return
+
+    st.session_state.pop("_ocr_job", None)
+    st.session_state.pop("_ocr_written", None)
+    remember_trace("ocr", job.trace)
+    failure = job.failure()
+    if failure is not None:
+        st.session_state["_upload_notice"] = ("error", f"截图识别中断：{describe_ocr_error(failure)}")
+    elif not merged:
+        st.session_state["_upload_notice"] = ("warning", "已读取截图，但未拼接出有效文字：建议更换更清晰的截图后重试。")
+    elif dedupe_stats["lines_removed"]:
+        st.session_state["_upload_notice"] = (
+            "info",
+            f"已去除相邻截图间重复的 {dedupe_stats['lines_removed']} 行对话（约 {dedupe_stats['tokens_removed']} tokens）。",
+        )
+    if edited and merged:
+        st.session_state["_ocr_result"] = merged
+    # 识别完成：聊天记录区切回普通模式，上传区显示结果提示
+    st.rerun()
+
+
+def apply_ocr_result() -> None:
+    result = st.session_state.pop("_ocr_result", None)
+    if result:
+        st.session_state["transcript"] = result
 
-            try:
-                baidu_api_key = get_baidu_ocr_api_key()
-                baidu_secret_key = get_baidu_ocr_secret_key()
-            except RuntimeError as e:
-                if str(e).startswith("missing_secret:"):
-                    st.error("未检测到百度 OCR 密钥：请在 Streamlit Secrets 配置 BAIDU_OCR_API_KEY / BAIDU_OCR_SECRET_KEY。")
-                else:
-                    st.error("读取百度 OCR 密钥失败：请检查 Secrets 配置。")
-            else:
-                progress = st.progress(0)
-                status = st.empty()
-                parts: list[str] = []
-                total = len(ordered)
-
-                with st.spinner("正在提取截图文字并分离角色..."):
-                    for idx, f in enumerate(ordered, start=1):
-                        status.info(f"正在提取第 {idx}/{total} 张截图文字...")
-                        try:
-                            ocr_json = baidu_general_ocr(
-                                f.getvalue(),
-                                api_key=baidu_api_key,
-                                secret_key=baidu_secret_key,
-                            )
-                            img = Image.open(io.BytesIO(f.getvalue()))
-                            image_width = int(img.size[0])
-                            dialogue = build_role_dialogue_from_ocr(ocr_json, image_width=image_width)
-                            if not dialogue:
-                                dialogue = "（本图未识别到可用对话：可能是时间戳/系统提示或识别不到位置数据）"
-                            parts.append(f"--- 图{idx}：{f.name} ---\n{dialogue}")
-                        except Exception as e:
-                            parts.append(f"--- 图{idx}：{f.name} ---\n（OCR 失败：{e}）")
-
-                        progress.progress(int(idx / total * 100))
-
-                status.empty()
-                progress.empty()
-                merged = "\n\n".join(parts).strip()
-                if not merged:
-                    st.warning("已读取截图，但未拼接出有效文字：建议更换更清晰的截图后重试。")
-                else:
-                    st.session_state.pop("report", None)
-                    st.session_state["transcript"] = merged
+
+def _transcript_section() -> None:
+    job: Optional[OcrJob] = st.session_state.get("_ocr_job")
+    if job is not None:
+        if _st_fragment is None:
+            # 不支持 fragment 时没有轮询，只能在本轮等识别完成
+            with st.spinner("正在提取截图文字并分离角色..."):
+                job.wait()
+        sync_ocr_job(job)
 
     with st.container(border=True):
+        if job is not None:
+            done, total = job.progress()
+            st.progress(done / max(1, total), text=f"已识别 {done}/{total} 张截图，可以先编辑或直接诊断已识别的部分")
+            if job.queue_position:
+                st.caption(f"当前使用人数较多，截图识别排队中（第 {job.queue_position} 位），请稍候...")
+            if (st.session_state.get("transcript") or "") != st.session_state.get("_ocr_written"):
+                st.caption("你已修改聊天记录，后续识别结果不会自动覆盖，识别完成后可一键替换。")
         transcript = st.text_area(
             "聊天记录",
             key="transcript",
             placeholder="请将让你内耗的聊天记录粘贴在这里...",
             height=260,
         )
+        ocr_result = st.session_state.get("_ocr_result")
+        if ocr_result and ocr_result != transcript:
+            st.button("用完整的截图识别结果替换", on_click=apply_ocr_result)
+        prepared = prepare_transcript(transcript or "")
+        if prepared.raw_tokens:
+            budget_note = "，已超出预算，仅保留最近的对话" if prepared.truncated else ""
+            if not prepared.truncated and needs_map_reduce(prepared.text):
+                budget_note = "，较长，将分段并行提炼后再合成报告"
+            st.caption(f"预计 tokens：原文约 {prepared.raw_tokens} → 精简后约 {prepared.tokens}{budget_note}")
+    discard_stale_speculative(prepared.text.strip())
+
+
+render_transcript_section = ui_fragment(_transcript_section)
 
-    style_mode_ui_to_value: dict[str, StyleMode] = {
-        "专业清醒版": "professional",
-        "姐妹嘴替版": "sister_support",
-        "冷静止损版": "cold_boundary",
-    }
-    style_mode_value_to_ui: dict[StyleMode, str] = {
-        "professional": "专业清醒版",
-        "sister_support": "姐妹嘴替版",
-        "cold_boundary": "冷静止损版",
-    }
 
+@ui_fragment
+def render_mode_selector() -> None:
     with st.container(border=True):
+        options = list(STYLE_MODE_UI_TO_VALUE.keys())
         if hasattr(st, "segmented_control"):
             selected_mode_ui = st.segmented_control(
                 "这次你更需要哪种帮助？",
-                options=list(style_mode_ui_to_value.keys()),
+                options=options,
                 default="专业清醒版",
+                key="style_mode_ui",
             )
         elif hasattr(st, "pills"):
             selected_mode_ui = st.pills(
                 "这次你更需要哪种帮助？",
-                options=list(style_mode_ui_to_value.keys()),
+                options=options,
                 default="专业清醒版",
+                key="style_mode_ui",
             )
         else:
             selected_mode_ui = st.radio(
                 "这次你更需要哪种帮助？",
-                options=list(style_mode_ui_to_value.keys()),
+                options=options,
                 index=0,
                 horizontal=True,
+                key="style_mode_ui",
             )
 
-        selected_mode = style_mode_ui_to_value.get(str(selected_mode_ui), "professional")
+        selected_mode = STYLE_MODE_UI_TO_VALUE.get(str(selected_mode_ui), "professional")
         meta = STYLE_MODE_CARDS[selected_mode]
         title = str(meta["title"])
         desc = str(meta["desc"])
@@ -772,6 +3842,14 @@ def main() -> None:
             st.caption(desc)
             st.markdown("\n".join([f"- {b}" for b in bullets]))
 
+        st.toggle(
+            "诊断时在后台同时准备另外两种风格（切换更快）",
+            key="speculative_enabled",
+        )
+
+
+@ui_fragment
+def render_report_view() -> None:
     with st.container(border=True):
         c1, c2 = st.columns([2, 1])
         with c1:
@@ -780,53 +3858,108 @@ def main() -> None:
             clear = st.button("清空本次内容", use_container_width=True)
 
         if clear:
+            speculative = st.session_state.pop("_speculative", None)
+            if speculative is not None:
+                speculative.cancel()
+            ocr_job = st.session_state.pop("_ocr_job", None)
+            if ocr_job is not None:
+                ocr_job.cancel()
+            st.session_state.pop("_ocr_written", None)
+            st.session_state.pop("_ocr_result", None)
             st.session_state.pop("report", None)
+            st.session_state.pop("report_markdown", None)
+            st.session_state.pop("report_sections", None)
             st.session_state.pop("last_input", None)
+            st.session_state.pop("last_usage", None)
+            st.session_state.pop("last_traces", None)
             st.session_state.pop("transcript", None)
             st.session_state.pop("_last_upload_sig", None)
-            st.session_state.pop("baidu_access_token", None)
-            st.session_state.pop("baidu_access_token_expires_at", None)
             st.rerun()
 
+    # 风格与聊天记录都在各自的区块里编辑，这里从会话状态读取最新值
+    selected_mode = STYLE_MODE_UI_TO_VALUE.get(str(st.session_state.get("style_mode_ui", "专业清醒版")), "professional")
+    prepared = prepare_transcript(st.session_state.get("transcript") or "")
+    speculative = discard_stale_speculative(prepared.text.strip())
+
     if run:
-        text = (transcript or "").strip()
+        text = prepared.text.strip()
         if len(text) < 10:
             st.error("内容太短了：请粘贴更完整的聊天记录后再诊断。")
         else:
-            with st.spinner("正在深度诊断..."):
-                try:
-                    report = analyze_chat(text, model="deepseek-chat", style_mode=selected_mode)
-                except RuntimeError as e:
-                    if str(e).startswith("missing_secret:") or str(e) == "missing_api_key":
-                        st.error("未检测到 DeepSeek 密钥：请在 Streamlit Secrets 配置 DEEPSEEK_API_KEY。")
-                        report = None
-                    elif str(e) == "empty_response":
-                        st.error("模型返回了空内容，请重试一次。")
-                        report = None
-                    else:
-                        st.error("发生未知错误，请稍后重试。")
-                        report = None
-                except Exception as e:
-                    st.error(f"调用失败：{e}")
-                    report = None
+            if st.session_state.get("speculative_enabled"):
+                if speculative is not None:
+                    speculative.cancel()
+                st.session_state["_speculative"] = start_speculative_generation(
+                    text,
+                    model="deepseek-chat",
+                    primary_mode=selected_mode,
+                )
+            with st.container(border=True):
+                st.markdown("### 诊断报告")
+                st.caption(f"当前模式：{STYLE_MODE_VALUE_TO_UI[selected_mode]}")
+                st.markdown('<div class="sq-report">', unsafe_allow_html=True)
+                report = render_report_stream(st.empty(), text, model="deepseek-chat", style_mode=selected_mode)
+                st.markdown("</div>", unsafe_allow_html=True)
 
             if report:
-                st.session_state["report"] = report
-                st.session_state["last_input"] = text
-                st.session_state["generated_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                st.session_state["style_mode_used"] = selected_mode
+                store_report(report, selected_mode, transcript=text)
+                rerun_section()
 
     if st.session_state.get("report"):
         with st.container(border=True):
             st.markdown("### 诊断报告")
             st.caption(f"生成时间：{st.session_state.get('generated_at','')}")
             used_mode = normalize_style_mode(st.session_state.get("style_mode_used"))
-            st.caption(f"当前模式：{style_mode_value_to_ui[used_mode]}")
+            st.caption(f"当前模式：{STYLE_MODE_VALUE_TO_UI[used_mode]}")
             st.markdown('<div class="sq-report">', unsafe_allow_html=True)
-            st.markdown(sanitize_report_markdown(st.session_state["report"]))
+            report_slot = st.empty()
+            if "report_markdown" not in st.session_state:
+                st.session_state["report_markdown"] = sanitize_report_markdown(st.session_state["report"])
+                st.session_state["report_sections"] = parse_report(st.session_state["report_markdown"])
+            parsed: ParsedReport = st.session_state["report_sections"]
+            section_slots: dict = {}
+            if parsed.sections:
+                # 每节一个占位，单独重写某一节时只刷新这一块
+                with report_slot.container():
+                    if parsed.preamble:
+                        st.markdown(parsed.preamble)
+                    for section in parsed.sections:
+                        section_slots[section.number] = st.empty()
+                        section_slots[section.number].markdown(f"#### {section.title}\n{section.body}")
+            else:
+                report_slot.markdown(st.session_state["report_markdown"])
             st.markdown("</div>", unsafe_allow_html=True)
+            render_usage_panel()
 
             last_input = st.session_state.get("last_input")
+            if last_input and section_slots:
+                st.divider()
+                st.markdown("#### 只重写其中一节")
+                s1, s2 = st.columns([3, 1])
+                with s1:
+                    number = st.selectbox(
+                        "选择要重写的小节",
+                        options=list(section_slots),
+                        format_func=lambda n: parsed.section(n).title,
+                        key="regen_section_number",
+                        label_visibility="collapsed",
+                    )
+                with s2:
+                    regenerate = st.button("重新生成这一节", key="regen_section", use_container_width=True)
+                if regenerate and number in section_slots:
+                    # 只让模型输出这一节，其它小节原样保留
+                    updated = render_section_stream(
+                        section_slots[number],
+                        str(last_input),
+                        model="deepseek-chat",
+                        style_mode=used_mode,
+                        report=parsed,
+                        number=number,
+                    )
+                    if updated is not None:
+                        store_report(updated.to_markdown(), used_mode)
+                        rerun_section()
+
             if last_input:
                 other_modes = [m for m in STYLE_MODE_LABELS.keys() if m != used_mode]
                 if len(other_modes) == 2:
@@ -835,40 +3968,58 @@ def main() -> None:
                     b1, b2 = st.columns(2)
                     for col, m in zip([b1, b2], other_modes):
                         with col:
+                            ready = speculative is not None and speculative.is_ready(m)
                             if st.button(
-                                STYLE_MODE_LABELS[m],
+                                f"{STYLE_MODE_LABELS[m]} ⚡" if ready else STYLE_MODE_LABELS[m],
                                 key=f"regen_{m}",
                                 use_container_width=True,
                             ):
-                                with st.spinner("正在重新生成..."):
-                                    try:
-                                        new_report = analyze_chat(
-                                            str(last_input),
-                                            model="deepseek-chat",
-                                            style_mode=m,
-                                        )
-                                    except RuntimeError as e:
-                                        if str(e).startswith("missing_secret:") or str(e) == "missing_api_key":
-                                            st.error("未检测到 DeepSeek 密钥：请在 Streamlit Secrets 配置 DEEPSEEK_API_KEY。")
-                                            new_report = None
-                                        elif str(e) == "empty_response":
-                                            st.error("模型返回了空内容，请重试一次。")
-                                            new_report = None
-                                        else:
-                                            st.error("发生未知错误，请稍后重试。")
-                                            new_report = None
-                                    except Exception as e:
-                                        st.error(f"调用失败：{e}")
-                                        new_report = None
-
+                                if speculative is not None and not ready and m in speculative.futures:
+                                    # 后台已经在生成这一种风格，等它完成比重新发起一次更快；超时后前台自己生成
+                                    with st.spinner("后台预生成即将完成..."):
+                                        speculative.wait(m, timeout=get_float_setting("SPECULATIVE_WAIT_SECONDS", 20))
+                                # 直接在上方报告区域流式覆盖，生成完成后只重跑报告区
+                                new_report = render_report_stream(
+                                    report_slot,
+                                    str(last_input),
+                                    model="deepseek-chat",
+                                    style_mode=m,
+                                )
                                 if new_report:
-                                    st.session_state["report"] = new_report
-                                    st.session_state["generated_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                                    st.session_state["style_mode_used"] = m
-                                    st.rerun()
+                                    store_report(new_report, m)
+                                    rerun_section()
+                                else:
+                                    report_slot.markdown(st.session_state["report_markdown"])
+
+    if debug_panel_enabled():
+        render_debug_panel()
+
+
+def main() -> None:
+    st.set_page_config(
+        page_title="Sober Queen",
+        page_icon="👑",
+        layout="wide",
+        initial_sidebar_state="collapsed",
+    )
+    # 每个浏览器会话一个标识，上游限流按它轮流放行
+    if "_session_id" not in st.session_state:
+        st.session_state["_session_id"] = uuid.uuid4().hex
+    CURRENT_SESSION.set(st.session_state["_session_id"])
 
+    st.markdown(APP_CSS, unsafe_allow_html=True)
+    st.markdown("# 👑 Sober Queen")
+    st.markdown('<div class="sq-muted">一键粉碎无效沟通与情绪内耗</div>', unsafe_allow_html=True)
+
+    render_upload_section()
+    if "_ocr_job" in st.session_state:
+        # 后台识别进行中：聊天记录区定时重跑，把新完成的图写进来
+        ui_fragment(_transcript_section, run_every=get_float_setting("OCR_POLL_SECONDS", 1.0))()
+    else:
+        render_transcript_section()
+    render_mode_selector()
+    render_report_view()
 
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,148 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterator, Optional
+
+import app
+
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+
+def iter_transcript_jobs(path: str) -> Iterator[dict]:
+    with open(path, "r", encoding="utf-8") as fh:
+        for line_no, line in enumerate(fh, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            yield {
+                "id": str(record.get("id") or line_no),
+                "transcript": str(record.get("transcript") or ""),
+                "style_mode": record.get("style_mode"),
+            }
+
+
+def iter_screenshot_jobs(root: str) -> Iterator[dict]:
+    # 每个子目录是一组截图，按文件名排序；根目录下直接放截图时视为一组
+    entries = sorted(os.listdir(root))
+    set_dirs = [name for name in entries if os.path.isdir(os.path.join(root, name))]
+    if not set_dirs:
+        set_dirs = [""]
+    for name in set_dirs:
+        set_dir = os.path.join(root, name)
+        files = sorted(
+            (f for f in os.listdir(set_dir) if f.lower().endswith(IMAGE_EXTENSIONS)),
+            key=str.lower,
+        )
+        if files:
+            yield {"id": name or os.path.basename(os.path.abspath(root)), "files": [os.path.join(set_dir, f) for f in files]}
+
+
+def load_checkpoint(output_path: str, need_report: bool = True) -> set[tuple[str, str]]:
+    # 输出文件本身就是断点：已成功写出的 (id, style_mode) 重跑时跳过；
+    # 完整运行只认带报告的记录，--ocr-only 写出的记录不能让后面的完整运行跳过诊断
+    done: set[tuple[str, str]] = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "r", encoding="utf-8") as fh:
+        for line in fh:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if not record.get("error") and (record.get("report") or not need_report):
+                done.add((str(record.get("id")), str(record.get("style_mode"))))
+    return done
+
+
+def run_job(
+    job: dict,
+    style_mode: str,
+    model: str,
+    skip_analysis: bool,
+) -> dict:
+    started = time.monotonic()
+    record: dict = {"id": job["id"], "style_mode": style_mode, "model": model}
+    # 每个任务在上游限流队列里算一个会话，多任务并发时轮流放行
+    session_token = app.CURRENT_SESSION.set(f"batch:{job['id']}:{style_mode}")
+    try:
+        transcript = job.get("transcript")
+        if transcript is None:
+            images = []
+            for path in job["files"]:
+                with open(path, "rb") as fh:
+                    images.append((os.path.basename(path), fh.read()))
+            transcript, dedupe_stats = app.transcribe_screenshots(images)
+            record["dedupe"] = dedupe_stats
+        record["transcript"] = transcript
+        if not skip_analysis:
+            record.update(app.diagnose_transcript(transcript, model=model, style_mode=style_mode))
+    except Exception as e:
+        record["error"] = str(e)
+    finally:
+        app.CURRENT_SESSION.reset(session_token)
+    record["elapsed_ms"] = int((time.monotonic() - started) * 1000)
+    return record
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Sober Queen 离线批处理：截图 OCR -> 角色对话 -> 诊断报告")
+    parser.add_argument("kind", choices=["transcripts", "screenshots"], help="输入类型")
+    parser.add_argument("input", help="transcripts：JSONL 文件（id / transcript / style_mode）；screenshots：截图目录")
+    parser.add_argument("-o", "--output", required=True, help="输出 JSONL，同时作为断点文件")
+    parser.add_argument("--style", dest="styles", action="append", choices=list(app.STYLE_MODE_LABELS), help="可重复；默认使用记录里的 style_mode 或 professional")
+    parser.add_argument("--model", default="deepseek-chat")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--llm-rps", type=float, default=None, help="每秒最多发起的模型请求数（覆盖 LLM_QPS），0 为不限")
+    parser.add_argument("--ocr-rps", type=float, default=None, help="每秒最多发起的 OCR 请求数（覆盖 BAIDU_OCR_QPS），0 为不限")
+    parser.add_argument("--ocr-only", action="store_true", help="只做 OCR，不调用模型")
+    parser.add_argument("--limit", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    jobs = list(iter_transcript_jobs(args.input) if args.kind == "transcripts" else iter_screenshot_jobs(args.input))
+    if args.limit:
+        jobs = jobs[: args.limit]
+
+    done = load_checkpoint(args.output, need_report=not args.ocr_only)
+    tasks: list[tuple[dict, str]] = []
+    for job in jobs:
+        styles = args.styles or [app.normalize_style_mode(job.get("style_mode"))]
+        for style_mode in styles:
+            if (job["id"], style_mode) not in done:
+                tasks.append((job, style_mode))
+
+    print(f"共 {len(jobs)} 条输入，{len(tasks)} 个任务待处理（已完成 {len(done)} 个）", file=sys.stderr)
+    if not tasks:
+        return 0
+
+    # 限流走 app 里的进程级限流器，在第一次调用上游之前用环境变量覆盖配额
+    if args.llm_rps is not None:
+        os.environ["LLM_QPS"] = str(args.llm_rps)
+    if args.ocr_rps is not None:
+        os.environ["BAIDU_OCR_QPS"] = str(args.ocr_rps)
+    failures = 0
+    write_lock = threading.Lock()
+    with open(args.output, "a", encoding="utf-8") as out, ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as pool:
+        futures = [
+            pool.submit(run_job, job, style_mode, args.model, args.ocr_only)
+            for job, style_mode in tasks
+        ]
+        for finished, future in enumerate(as_completed(futures), start=1):
+            record = future.result()
+            failures += 1 if record.get("error") else 0
+            with write_lock:
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+            print(f"[{finished}/{len(tasks)}] {record['id']} {record['style_mode']} {record.get('error') or 'ok'} {record['elapsed_ms']}ms", file=sys.stderr)
+
+    print(f"完成：{len(tasks) - failures} 成功，{failures} 失败；失败任务重跑同一命令即可续跑", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
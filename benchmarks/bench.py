@@ -0,0 +1,259 @@
+import argparse
+import json
+import os
+import platform
+import re
+import statistics
+import sys
+import timeit
+import tracemalloc
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import numpy as np  # noqa: E402
+
+import app  # noqa: E402
+import fixtures  # noqa: E402
+
+
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+
+
+@dataclass
+class Case:
+    name: str
+    fn: Callable[[], Any]
+    items: int = 0
+
+
+def legacy_build_role_dialogue_from_ocr(ocr_json: dict, image_width: int) -> str:
+    # V1.5 的逐行实现，保留作对照基线
+    def legacy_is_timestamp_line(text: str) -> bool:
+        t = (text or "").strip()
+        if not t:
+            return True
+        if len(t) > 24:
+            return False
+        t = re.sub(r"\s+", " ", t)
+        return app.TIMESTAMP_RE.match(t) is not None
+
+    words_result = ocr_json.get("words_result") or []
+    rows = []
+    for item in words_result:
+        text = (item.get("words") or "").strip()
+        if not text:
+            continue
+        loc = item.get("location") or {}
+        left = loc.get("left")
+        top = loc.get("top")
+        width = loc.get("width")
+        height = loc.get("height")
+        if left is None or width is None or top is None or height is None:
+            continue
+        rows.append((int(top), int(left), int(width), int(height), text))
+
+    rows.sort(key=lambda x: (x[0], x[1]))
+
+    dialogue_lines: list[str] = []
+    last_speaker: Optional[str] = None
+    last_bottom_y = 0
+    last_line_height = 0
+
+    for top, left, width, height, text in rows:
+        if legacy_is_timestamp_line(text):
+            last_speaker = None
+            last_bottom_y = top + height
+            last_line_height = height
+            continue
+
+        gap = top - last_bottom_y
+        proximity_threshold = int(max(6, min(last_line_height, height) * 0.9)) if last_line_height else int(max(6, height * 0.9))
+
+        if last_speaker is not None and gap >= 0 and gap < proximity_threshold:
+            if dialogue_lines:
+                dialogue_lines[-1] = f"{dialogue_lines[-1]} {text}".strip()
+            else:
+                dialogue_lines.append(f"【{last_speaker}】: {text}")
+        else:
+            center_x = left + (width / 2.0)
+            speaker = "对方" if center_x < (image_width / 2.0) else "我"
+            last_speaker = speaker
+            dialogue_lines.append(f"【{speaker}】: {text}")
+
+        last_bottom_y = max(last_bottom_y, top + height)
+        last_line_height = height
+
+    return "\n".join(dialogue_lines).strip()
+
+
+def build_cases(include_legacy: bool) -> list[Case]:
+    cases: list[Case] = []
+    ocr = fixtures.ocr_fixtures()
+    for name, (ocr_json, image_width) in ocr.items():
+        boxes = len(ocr_json.get("words_result") or [])
+        cases.append(Case(f"layout:{name}", lambda o=ocr_json, w=image_width: app.build_role_dialogue_from_ocr(o, w), boxes))
+        if include_legacy:
+            cases.append(Case(f"layout_legacy:{name}", lambda o=ocr_json, w=image_width: legacy_build_role_dialogue_from_ocr(o, w), boxes))
+
+    texts = [w["words"] for w in ocr["stress_5k"][0]["words_result"]] + fixtures.TIMESTAMPS * 50
+    normalized = [app.WHITESPACE_RE.sub(" ", t.strip()) for t in texts]
+    cases.append(Case("is_timestamp_line", lambda: [app.is_timestamp_line(t) for t in texts], len(texts)))
+    cases.append(Case("timestamp_re", lambda: [app.TIMESTAMP_RE.match(t) for t in normalized], len(normalized)))
+
+    parts = []
+    for idx, part in enumerate(fixtures.screen_parts(ocr["long_scroll_10k"][0]), start=1):
+        parts.append(f"--- 图{idx}：{idx}.png ---\n{app.build_role_dialogue_from_ocr(part, 1080)}")
+    cases.append(Case("merge_dialogue_parts:long_scroll_10k", lambda: app.merge_dialogue_parts(parts), len(parts)))
+
+    report = fixtures.sample_report()
+    cases.append(Case("sanitize_report_markdown", lambda: app.sanitize_report_markdown(report), len(report)))
+    cases.append(Case("sanitize_partial_report_markdown", lambda: app.sanitize_partial_report_markdown(report[: len(report) // 2]), len(report) // 2))
+
+    modes = list(app.STYLE_MODE_LABELS)
+    cases.append(Case("build_system_prompt", lambda: [app.build_system_prompt(m) for m in modes], len(modes)))
+    cases.append(Case("build_analysis_messages", lambda: [app.build_analysis_messages("【我】: 在吗", m) for m in modes], len(modes)))
+
+    for name, transcript in fixtures.transcript_fixtures().items():
+        cases.append(Case(f"prepare_transcript:{name}", lambda t=transcript: app.prepare_transcript(t), len(transcript)))
+        cases.append(Case(f"estimate_tokens:{name}", lambda t=transcript: app.estimate_tokens(t), len(transcript)))
+    return cases
+
+
+def calibrate() -> float:
+    # 固定的纯 Python 负载：比较基线时用它把耗时换算到当前机器
+    def work() -> int:
+        total = 0
+        for i in range(20000):
+            total += i * i % 7
+        return total
+
+    return statistics.median(timeit.repeat(work, number=20, repeat=5)) / 20
+
+
+def measure(case: Case, repeat: int, min_time: float) -> dict:
+    case.fn()
+    timer = timeit.Timer(case.fn)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time or number >= 1_000_000:
+            break
+        number *= 2 if elapsed <= 0 else max(2, min(10, int(min_time / elapsed) + 1))
+    # 取中位数而不是最小值：最小值只反映最幸运的一轮，和基线比较时来回跳得厉害
+    typical = statistics.median(timer.repeat(repeat=repeat, number=number)) / number
+
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        case.fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "us_per_op": typical * 1e6,
+        "items_per_s": case.items / typical if case.items else None,
+        "peak_kib": max(0, peak - before) / 1024,
+    }
+
+
+def compare(result: dict, base: Optional[dict], scale: float, tolerance: float, alloc_tolerance: float) -> tuple[str, bool]:
+    if not base:
+        return "new", False
+    expected = base["us_per_op"] * scale
+    ratio = result["us_per_op"] / expected if expected else 1.0
+    slow = ratio > 1 + tolerance
+    # 峰值内存很小时波动占比大，留 16 KiB 的绝对余量
+    heavy = result["peak_kib"] > base["peak_kib"] * (1 + alloc_tolerance) + 16
+    status = f"{(ratio - 1) * 100:+.0f}%"
+    if slow:
+        status += " SLOWER"
+    if heavy:
+        status += " MORE-ALLOC"
+    return status, slow or heavy
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="纯 Python 热路径微基准：版面还原、时间戳识别、报告清洗、提示词与记录精简")
+    parser.add_argument("--filter", default="", help="只跑名字匹配该正则的用例")
+    parser.add_argument("--repeat", type=int, default=7, help="每个用例测几轮，取中位数")
+    parser.add_argument("--min-time", type=float, default=0.2, help="每轮至少运行的秒数")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="把本次结果写成新的基线")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="耗时中位数超过基线（已按机器换算）多少视为回退；同机空闲时单次波动可达 ±20%%")
+    parser.add_argument("--confirm", type=int, default=2, help="判为回退的用例再复测几次，取最好的一次，滤掉偶发的机器抖动")
+    parser.add_argument("--alloc-tolerance", type=float, default=0.3, help="峰值内存超过基线多少视为回退")
+    parser.add_argument("--legacy", action="store_true", help="同时跑旧版逐行版面还原，对照加速比")
+    parser.add_argument("--json", dest="json_path", help="把结果另存为 JSON")
+    args = parser.parse_args(argv)
+    if args.save_baseline and args.filter:
+        parser.error("--save-baseline 需要跑全部用例，不能和 --filter 一起用")
+
+    pattern = re.compile(args.filter) if args.filter else None
+    cases = [case for case in build_cases(args.legacy) if pattern is None or pattern.search(case.name)]
+    calibration = calibrate()
+
+    baseline: dict = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, "r", encoding="utf-8") as fh:
+            baseline = json.load(fh)
+    scale = calibration / baseline["calibration_s"] if baseline.get("calibration_s") else 1.0
+
+    results: dict[str, dict] = {}
+    regressions = []
+    print(f"{'case':<44} {'us/op':>12} {'items/s':>14} {'peak KiB':>10}  vs baseline")
+    for case in cases:
+        base = baseline.get("cases", {}).get(case.name)
+        result = measure(case, args.repeat, args.min_time)
+        status, regressed = compare(result, base, scale, args.tolerance, args.alloc_tolerance)
+        for _ in range(args.confirm if regressed else 0):
+            retry = measure(case, args.repeat, args.min_time)
+            if retry["us_per_op"] < result["us_per_op"]:
+                result = retry
+            status, regressed = compare(result, base, scale, args.tolerance, args.alloc_tolerance)
+            if not regressed:
+                break
+        results[case.name] = result
+        if regressed:
+            regressions.append(case.name)
+        items = f"{result['items_per_s']:14.0f}" if result["items_per_s"] else f"{'-':>14}"
+        print(f"{case.name:<44} {result['us_per_op']:12.1f} {items} {result['peak_kib']:10.1f}  {status}")
+
+    if args.legacy:
+        for name, result in results.items():
+            if name.startswith("layout_legacy:"):
+                fast = results.get(name.replace("layout_legacy:", "layout:"))
+                if fast:
+                    print(f"speedup {name.split(':', 1)[1]:<36} {result['us_per_op'] / fast['us_per_op']:.2f}x")
+
+    report = {
+        "calibration_s": calibration,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cases": {name: result for name, result in results.items() if not name.startswith("layout_legacy:")},
+    }
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as fh:
+            json.dump(report, fh, ensure_ascii=False, indent=1)
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as fh:
+            json.dump(report, fh, ensure_ascii=False, indent=1)
+            fh.write("\n")
+        print(f"基线已写入 {args.baseline}", file=sys.stderr)
+        return 0
+    if not baseline:
+        print("没有基线：先运行 --save-baseline 记录一次", file=sys.stderr)
+        return 0
+    if regressions:
+        print(f"性能回退：{', '.join(regressions)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
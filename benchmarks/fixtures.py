@@ -0,0 +1,173 @@
+import glob
+import json
+import os
+import random
+from typing import Optional
+
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+MESSAGE_CHARS = "你我他她今天为什么不回消息没关系好的嗯在忙晚点说吧算了随便你开心就好明天再聊"
+TIMESTAMPS = ["21:03", "昨天 23:41", "星期三 08:15", "上午 9:02", "2024年5月3日 下午3:20", "5月3日 21:07"]
+SYSTEM_LINES = ["以下为新消息", "对方撤回了一条消息", "你已添加了对方，现在可以开始聊天了"]
+
+
+def synthetic_chat_ocr(
+    image_width: int = 1080,
+    seed: int = 7,
+    max_boxes: Optional[int] = None,
+    max_bubbles: Optional[int] = None,
+    max_height: Optional[int] = None,
+) -> dict:
+    # 模拟百度 general 接口的返回：对方左对齐、我右对齐，夹杂多行气泡、时间戳和系统提示
+    rng = random.Random(seed)
+    words_result: list[dict] = []
+    top = 40
+    line_height = 42
+    bubbles = 0
+
+    def full() -> bool:
+        return (
+            (max_boxes is not None and len(words_result) >= max_boxes)
+            or (max_bubbles is not None and bubbles >= max_bubbles)
+            or (max_height is not None and top >= max_height)
+        )
+
+    while not full():
+        roll = rng.random()
+        if roll < 0.08:
+            text = rng.choice(TIMESTAMPS)
+            width = 24 * len(text)
+            words_result.append({"words": text, "location": {"left": (image_width - width) // 2, "top": top, "width": width, "height": 28}})
+            top += 28 + 36
+            continue
+        if roll < 0.1:
+            text = rng.choice(SYSTEM_LINES)
+            width = 26 * len(text)
+            words_result.append({"words": text, "location": {"left": (image_width - width) // 2, "top": top, "width": width, "height": 30}})
+            top += 30 + 36
+            continue
+
+        is_me = rng.random() < 0.5
+        lines = rng.choice([1, 1, 1, 2, 3])
+        width = rng.randint(120, int(image_width * 0.62))
+        left = image_width - 170 - width if is_me else 170
+        for _ in range(lines):
+            words_result.append({
+                "words": "".join(rng.choice(MESSAGE_CHARS) for _ in range(max(2, width // 36))),
+                "location": {"left": left, "top": top, "width": width, "height": line_height},
+            })
+            top += line_height + 4
+        top += 48
+        bubbles += 1
+
+    if max_boxes is not None:
+        words_result = words_result[:max_boxes]
+    return {
+        "log_id": rng.getrandbits(62),
+        "words_result_num": len(words_result),
+        "words_result": words_result,
+    }
+
+
+def screen_parts(ocr_json: dict, screen_height: int = 2340, overlap: int = 400) -> list[dict]:
+    # 把长截图按屏切开，相邻两屏有重叠，模拟连续上传的多张截图
+    words_result = ocr_json.get("words_result") or []
+    bottom = max((w["location"]["top"] + w["location"]["height"] for w in words_result), default=0)
+    parts = []
+    top = 0
+    while top < bottom:
+        parts.append({
+            "words_result": [
+                {"words": w["words"], "location": {**w["location"], "top": w["location"]["top"] - top}}
+                for w in words_result
+                if top <= w["location"]["top"] and w["location"]["top"] + w["location"]["height"] <= top + screen_height
+            ]
+        })
+        top += screen_height - overlap
+    return parts
+
+
+def synthetic_pasted_transcript(num_messages: int, seed: int = 11) -> str:
+    # 微信导出格式：「昵称 日期 时间」一行，下一行是内容；夹杂系统提示和「我：」式手打行
+    rng = random.Random(seed)
+    lines: list[str] = []
+    minute = 0
+    for _ in range(num_messages):
+        minute += rng.randint(0, 9)
+        stamp = f"2024-05-{3 + minute // 1440:02d} {minute // 60 % 24:02d}:{minute % 60:02d}:{rng.randint(0, 59):02d}"
+        if rng.random() < 0.05:
+            lines.append(rng.choice(SYSTEM_LINES))
+            continue
+        body = "".join(rng.choice(MESSAGE_CHARS) for _ in range(rng.randint(4, 60)))
+        if rng.random() < 0.2:
+            lines.append(f"{'我' if rng.random() < 0.5 else '对方'}：{body}")
+        else:
+            lines.append(f"{'我' if rng.random() < 0.5 else '阿哲'} {stamp}")
+            lines.append(body)
+            if rng.random() < 0.3:
+                lines.append("")
+    return "\n".join(lines)
+
+
+def sample_report(seed: int = 5) -> str:
+    # 标准六段式报告，夹杂模型偶尔会带出来的时间戳
+    rng = random.Random(seed)
+    headers = [
+        "📍 1. 情境定位（事实层）",
+        "🔍 2. 逻辑结构分析（可验证）",
+        "🕸️ 3. 互动模式识别（倾向判断）",
+        "⚠️ 4. 风险评估（本轮对话）",
+        "🛡️ 5. 情感健康建议（行动策略）",
+        "💬 6. 输出总结与回应模板",
+    ]
+    sections = []
+    for header in headers:
+        paragraphs = []
+        for _ in range(rng.randint(2, 4)):
+            text = "".join(rng.choice(MESSAGE_CHARS + "，。") for _ in range(rng.randint(60, 160)))
+            if rng.random() < 0.4:
+                text = f"{rng.choice(TIMESTAMPS)} {text}"
+            paragraphs.append(f"- {text}")
+        sections.append(f"#### {header}\n" + "\n".join(paragraphs))
+    return "\n\n".join(sections)
+
+
+# synthetic_chat_ocr 生成的合成样本（不是线上抓的真实返回），固化成 JSON，生成器以后改了也不影响基线；
+# 5k 压测样本太大，运行时生成
+SYNTHETIC_OCR_FIXTURES = {
+    "single_bubble": {"seed": 1, "max_bubbles": 1},
+    "chat_50": {"seed": 2, "max_bubbles": 50},
+    "long_scroll_10k": {"seed": 3, "max_height": 10000},
+}
+
+
+def write_synthetic_fixtures() -> None:
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    for name, params in SYNTHETIC_OCR_FIXTURES.items():
+        data = {"image_width": 1080, **synthetic_chat_ocr(**params)}
+        with open(os.path.join(FIXTURE_DIR, f"{name}.json"), "w", encoding="utf-8") as fh:
+            json.dump(data, fh, ensure_ascii=False, indent=1)
+            fh.write("\n")
+
+
+def ocr_fixtures() -> dict[str, tuple[dict, int]]:
+    # fixtures/*.json 都会被加载：可以把线上抓到的百度原始返回直接放进去，image_width 缺省按 1080
+    fixtures: dict[str, tuple[dict, int]] = {}
+    for path in sorted(glob.glob(os.path.join(FIXTURE_DIR, "*.json"))):
+        with open(path, "r", encoding="utf-8") as fh:
+            data = json.load(fh)
+        fixtures[os.path.splitext(os.path.basename(path))[0]] = (data, int(data.get("image_width") or 1080))
+    fixtures["stress_5k"] = (synthetic_chat_ocr(seed=4, max_boxes=5000), 1080)
+    return fixtures
+
+
+def transcript_fixtures() -> dict[str, str]:
+    return {
+        "pasted_short": synthetic_pasted_transcript(40),
+        "pasted_long": synthetic_pasted_transcript(6000),
+    }
+
+
+if __name__ == "__main__":
+    write_synthetic_fixtures()
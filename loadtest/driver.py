@@ -0,0 +1,196 @@
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+LOADTEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(LOADTEST_DIR))
+sys.path.insert(0, LOADTEST_DIR)
+
+import fake_upstreams  # noqa: E402
+
+
+class Recorder:
+    def __init__(self) -> None:
+        self.samples: dict[str, list[float]] = {}
+        self.errors: dict[str, dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.samples.setdefault(stage, []).append(seconds * 1000)
+
+    def fail(self, stage: str, error: str) -> None:
+        with self._lock:
+            per_stage = self.errors.setdefault(stage, {})
+            per_stage[error] = per_stage.get(error, 0) + 1
+
+    def summary(self, wall_seconds: float) -> dict:
+        rows = {}
+        with self._lock:
+            stages = sorted(set(self.samples) | set(self.errors))
+            for stage in stages:
+                values = np.asarray(self.samples.get(stage) or [0.0])
+                errors = sum((self.errors.get(stage) or {}).values())
+                ok = len(self.samples.get(stage) or [])
+                rows[stage] = {
+                    "ok": ok,
+                    "errors": errors,
+                    "throughput_per_s": round(ok / wall_seconds, 3) if wall_seconds else 0.0,
+                    "p50_ms": round(float(np.percentile(values, 50)), 1),
+                    "p95_ms": round(float(np.percentile(values, 95)), 1),
+                    "p99_ms": round(float(np.percentile(values, 99)), 1),
+                    "max_ms": round(float(values.max()), 1),
+                    "error_kinds": dict(self.errors.get(stage) or {}),
+                }
+        return rows
+
+
+def make_screenshot(seed: int, width: int = 1080, height: int = 2340) -> bytes:
+    # 每个会话每轮都生成不同的图，保证 OCR 缓存不命中
+    rng = random.Random(seed)
+    img = Image.new("RGB", (width, height), (237, 237, 237))
+    draw = ImageDraw.Draw(img)
+    top = 60
+    while top < height - 120:
+        bubble_width = rng.randint(200, int(width * 0.6))
+        left = width - 170 - bubble_width if rng.random() < 0.5 else 170
+        color = (149, 236, 105) if left > width // 2 - 200 else (255, 255, 255)
+        draw.rectangle((left, top, left + bubble_width, top + 80), fill=color)
+        top += rng.randint(110, 220)
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def run_report(app, recorder: Recorder, stage: str, transcript: str, model: str, style_mode: str) -> bool:
+    # 与界面里的 render_report_stream 相同：带端到端预算地流式生成，记录首包与总耗时
+    started = time.monotonic()
+    first_chunk = None
+    try:
+        with app.deadline_scope(app.get_float_setting("ANALYZE_DEADLINE_SECONDS", 180)):
+            for _ in app.stream_analyze_chat(transcript, model=model, style_mode=style_mode):
+                if first_chunk is None:
+                    first_chunk = time.monotonic() - started
+    except Exception as e:
+        recorder.fail(stage, str(e).split(":", 1)[0] if isinstance(e, RuntimeError) else type(e).__name__)
+        return False
+    recorder.add(stage, time.monotonic() - started)
+    if first_chunk is not None:
+        recorder.add(f"{stage}_first_chunk", first_chunk)
+    return True
+
+
+def run_session(app, recorder: Recorder, session_idx: int, args: argparse.Namespace, start_at: float) -> None:
+    app.CURRENT_SESSION.set(f"loadtest-{session_idx}")
+    modes = list(app.STYLE_MODE_LABELS)
+    time.sleep(max(0.0, start_at - time.monotonic()))
+    for iteration in range(args.iterations):
+        session_started = time.monotonic()
+        images = [
+            (f"{n}.png", make_screenshot(hash((args.seed, session_idx, iteration, n)) & 0xFFFFFFFF))
+            for n in range(args.images)
+        ]
+
+        started = time.monotonic()
+        try:
+            transcript, _ = app.transcribe_screenshots(images)
+        except Exception as e:
+            recorder.fail("upload", type(e).__name__)
+            continue
+        # 有图识别失败时这次上传记为失败（界面上会显示失败说明），但带着剩下的内容继续诊断
+        if "（OCR 失败" in transcript:
+            recorder.fail("upload", "ocr_failed")
+        else:
+            recorder.add("upload", time.monotonic() - started)
+
+        prepared = app.prepare_transcript(transcript)
+        primary, other = modes[iteration % len(modes)], modes[(iteration + 1) % len(modes)]
+        time.sleep(args.think_time)
+        speculative = app.start_speculative_generation(prepared.text, args.model, primary) if args.speculative else None
+        if not run_report(app, recorder, "diagnose", prepared.text, args.model, primary):
+            continue
+
+        time.sleep(args.think_time)
+        if speculative is not None:
+            speculative.wait(other)
+        run_report(app, recorder, "regenerate", prepared.text, args.model, other)
+        recorder.add("session", time.monotonic() - session_started)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="模拟 N 个并发会话执行 上传截图 -> 诊断 -> 换风格重新生成，统计吞吐与 p50/p95/p99。"
+        "上游限流、并发、超时等仍按应用自身的配置项（环境变量）生效。"
+    )
+    parser.add_argument("--sessions", type=int, default=20, help="并发会话数")
+    parser.add_argument("--iterations", type=int, default=1, help="每个会话重复几轮")
+    parser.add_argument("--images", type=int, default=3, help="每轮上传几张截图")
+    parser.add_argument("--ramp-up", type=float, default=5.0, help="在多少秒内把会话逐个启动")
+    parser.add_argument("--think-time", type=float, default=1.0, help="两步操作之间的停顿秒数")
+    parser.add_argument("--speculative", action="store_true", help="像界面开关一样在后台预生成另外两种风格")
+    parser.add_argument("--model", default="deepseek-chat")
+    parser.add_argument("--target", choices=["embedded", "env"], default="embedded", help="embedded：进程内启动假服务；env：使用已配置的上游地址")
+    parser.add_argument("--json", dest="json_path", help="结果另存为 JSON")
+    fake_upstreams.add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    upstreams = None
+    if args.target == "embedded":
+        upstreams, server = fake_upstreams.start_in_background(fake_upstreams.profile_from_args(args))
+        base = f"http://127.0.0.1:{server.server_address[1]}"
+        os.environ["BAIDU_BASE_URL"] = base
+        os.environ["DEEPSEEK_BASE_URL"] = f"{base}/v1"
+        for key in ("BAIDU_OCR_API_KEY", "BAIDU_OCR_SECRET_KEY", "DEEPSEEK_API_KEY"):
+            os.environ.setdefault(key, "loadtest")
+
+    import app
+
+    recorder = Recorder()
+    wall_started = time.monotonic()
+    threads = []
+    for idx in range(args.sessions):
+        start_at = wall_started + (args.ramp_up * idx / max(1, args.sessions - 1) if args.sessions > 1 else 0.0)
+        thread = threading.Thread(target=run_session, args=(app, recorder, idx, args, start_at), name=f"session-{idx}")
+        threads.append(thread)
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_seconds = time.monotonic() - wall_started
+
+    summary = recorder.summary(wall_seconds)
+    print(f"{args.sessions} 个会话 × {args.iterations} 轮，用时 {wall_seconds:.1f}s")
+    print(f"{'stage':<26} {'ok':>6} {'err':>5} {'/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for stage, row in summary.items():
+        print(
+            f"{stage:<26} {row['ok']:>6} {row['errors']:>5} {row['throughput_per_s']:>8.2f} "
+            f"{row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['p99_ms']:>9.1f} {row['max_ms']:>9.1f}"
+        )
+        if row["error_kinds"]:
+            print(f"{'':<26} 错误：{row['error_kinds']}")
+
+    result = {
+        "sessions": args.sessions,
+        "iterations": args.iterations,
+        "wall_seconds": round(wall_seconds, 3),
+        "stages": summary,
+        "upstream_queues": {name: app.get_upstream_limiter(name).stats() for name in app.UPSTREAM_RATE_SETTINGS},
+        "circuits": {name: app.get_circuit_breaker(name).stats() for name in app.UPSTREAM_RATE_SETTINGS},
+        "upstream_requests": dict(upstreams.counts) if upstreams is not None else None,
+    }
+    print(f"上游请求：{result['upstream_requests']}")
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as fh:
+            json.dump(result, fh, ensure_ascii=False, indent=1)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
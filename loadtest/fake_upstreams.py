@@ -0,0 +1,264 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from dataclasses import dataclass, fields
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, "benchmarks"))
+
+import fixtures  # noqa: E402
+
+
+@dataclass
+class UpstreamProfile:
+    # 延迟单位毫秒，按对数正态抖动；各类错误率取值 0~1
+    token_latency_ms: float = 50
+    ocr_latency_ms: float = 400
+    ocr_error_rate: float = 0.0
+    ocr_qps_error_rate: float = 0.0
+    ocr_429_rate: float = 0.0
+    llm_ttft_ms: float = 800
+    llm_chunk_ms: float = 25
+    llm_chunk_chars: int = 8
+    llm_error_rate: float = 0.0
+    llm_429_rate: float = 0.0
+    jitter: float = 0.3
+    unique_text: bool = True
+    seed: int = 0
+
+
+class FakeUpstreams:
+    # 本地替身：百度 token / general OCR，以及 OpenAI 兼容的 /v1/chat/completions（含 SSE 流式）
+    def __init__(self, profile: UpstreamProfile, ocr_fixture_dir: Optional[str] = None) -> None:
+        self.profile = profile
+        fixture_dir = ocr_fixture_dir or fixtures.FIXTURE_DIR
+        self.ocr_responses = []
+        for path in sorted(glob.glob(os.path.join(fixture_dir, "*.json"))):
+            with open(path, "r", encoding="utf-8") as fh:
+                data = json.load(fh)
+            data.pop("image_width", None)
+            self.ocr_responses.append(data)
+        if not self.ocr_responses:
+            raise SystemExit(f"{fixture_dir} 下没有 OCR 样本（*.json）")
+        self.rng = random.Random(profile.seed)
+        self.counts: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def count(self, key: str) -> None:
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def roll(self, rate: float) -> bool:
+        with self._lock:
+            return self.rng.random() < rate
+
+    def delay(self, median_ms: float) -> None:
+        if median_ms <= 0:
+            return
+        with self._lock:
+            factor = self.rng.lognormvariate(0, self.profile.jitter) if self.profile.jitter > 0 else 1.0
+        time.sleep(median_ms * factor / 1000.0)
+
+    def ocr_response(self, image_b64: str) -> dict:
+        # 同一张图总是回放同一份样本；unique_text 时在首个气泡后加上图片摘要，让不同截图拼出不同的聊天记录
+        digest = hashlib.sha256(image_b64.encode("utf-8")).hexdigest()
+        data = self.ocr_responses[int(digest[:8], 16) % len(self.ocr_responses)]
+        if not self.profile.unique_text:
+            return data
+        words_result = [dict(item) for item in data.get("words_result") or []]
+        for item in words_result:
+            if item.get("words") and item["location"]["width"] > 200:
+                item["words"] = f"{item['words']}#{digest[:6]}"
+                break
+        return {**data, "words_result": words_result}
+
+    def serve(self, host: str = "127.0.0.1", port: int = 8900) -> ThreadingHTTPServer:
+        upstreams = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+            def read_body(self) -> bytes:
+                length = int(self.headers.get("Content-Length") or 0)
+                return self.rfile.read(length) if length else b""
+
+            def send_json(self, status: int, payload: dict, headers: Optional[dict] = None) -> None:
+                body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self) -> None:
+                if urlparse(self.path).path == "/oauth/2.0/token":
+                    self.handle_token()
+                else:
+                    self.send_json(404, {"error": "not_found"})
+
+            def do_POST(self) -> None:
+                path = urlparse(self.path).path
+                body = self.read_body()
+                if path == "/oauth/2.0/token":
+                    self.handle_token()
+                elif path == "/rest/2.0/ocr/v1/general":
+                    self.handle_ocr(body)
+                elif path.endswith("/chat/completions"):
+                    self.handle_chat(body)
+                else:
+                    self.send_json(404, {"error": "not_found"})
+
+            def handle_token(self) -> None:
+                upstreams.count("token")
+                upstreams.delay(upstreams.profile.token_latency_ms)
+                self.send_json(200, {"access_token": f"fake-{uuid.uuid4().hex}", "expires_in": 2592000})
+
+            def handle_ocr(self, body: bytes) -> None:
+                profile = upstreams.profile
+                upstreams.count("ocr")
+                upstreams.delay(profile.ocr_latency_ms)
+                if upstreams.roll(profile.ocr_429_rate):
+                    upstreams.count("ocr_429")
+                    self.send_json(429, {"error_code": 18, "error_msg": "Open api qps request limit reached"}, {"Retry-After": "1"})
+                    return
+                if upstreams.roll(profile.ocr_qps_error_rate):
+                    upstreams.count("ocr_qps_error")
+                    self.send_json(200, {"error_code": 18, "error_msg": "Open api qps request limit reached"})
+                    return
+                if upstreams.roll(profile.ocr_error_rate):
+                    upstreams.count("ocr_error")
+                    self.send_json(200, {"error_code": 282000, "error_msg": "internal error"})
+                    return
+                image = (parse_qs(body.decode("utf-8")).get("image") or [""])[0]
+                self.send_json(200, upstreams.ocr_response(image))
+
+            def handle_chat(self, body: bytes) -> None:
+                profile = upstreams.profile
+                request = json.loads(body or b"{}")
+                upstreams.count("llm")
+                if upstreams.roll(profile.llm_429_rate):
+                    upstreams.count("llm_429")
+                    self.send_json(429, {"error": {"message": "rate limited", "type": "rate_limit"}}, {"Retry-After": "1"})
+                    return
+                if upstreams.roll(profile.llm_error_rate):
+                    upstreams.count("llm_error")
+                    self.send_json(500, {"error": {"message": "upstream error", "type": "server_error"}})
+                    return
+
+                messages = request.get("messages") or []
+                prompt_chars = sum(len(str(m.get("content") or "")) for m in messages)
+                system_chars = sum(len(str(m.get("content") or "")) for m in messages if m.get("role") == "system")
+                is_report = any("####" in str(m.get("content") or "") for m in messages if m.get("role") == "system")
+                content = fixtures.sample_report(seed=upstreams.rng.randint(0, 1 << 30)) if is_report else "- 要点：双方在回复时效上反复拉扯。"
+                prompt_tokens = max(1, int(prompt_chars * 0.6))
+                # 模拟上游前缀缓存：system 部分算命中
+                hit_tokens = min(prompt_tokens, int(system_chars * 0.6))
+                usage = {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": max(1, int(len(content) * 0.6)),
+                    "total_tokens": prompt_tokens + max(1, int(len(content) * 0.6)),
+                    "prompt_cache_hit_tokens": hit_tokens,
+                    "prompt_cache_miss_tokens": prompt_tokens - hit_tokens,
+                }
+                completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+                model = request.get("model") or "deepseek-chat"
+                upstreams.delay(profile.llm_ttft_ms)
+
+                if not request.get("stream"):
+                    upstreams.delay(profile.llm_chunk_ms * len(content) / max(1, profile.llm_chunk_chars))
+                    self.send_json(200, {
+                        "id": completion_id,
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": model,
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                        "usage": usage,
+                    })
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+
+                def event(payload: dict) -> None:
+                    self.wfile.write(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+
+                base = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model}
+                step = max(1, profile.llm_chunk_chars)
+                try:
+                    for start in range(0, len(content), step):
+                        event({**base, "choices": [{"index": 0, "delta": {"content": content[start:start + step]}, "finish_reason": None}]})
+                        upstreams.delay(profile.llm_chunk_ms)
+                    event({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+                    if (request.get("stream_options") or {}).get("include_usage"):
+                        event({**base, "choices": [], "usage": usage})
+                    self.wfile.write(b"data: [DONE]\n\n")
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    # 客户端提前断开（例如预生成被取消）
+                    upstreams.count("llm_cancelled")
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        return server
+
+
+def start_in_background(profile: UpstreamProfile, host: str = "127.0.0.1", port: int = 0) -> tuple[FakeUpstreams, ThreadingHTTPServer]:
+    upstreams = FakeUpstreams(profile)
+    server = upstreams.serve(host, port)
+    threading.Thread(target=server.serve_forever, name="fake-upstreams", daemon=True).start()
+    return upstreams, server
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser) -> None:
+    for field in fields(UpstreamProfile):
+        flag = "--" + field.name.replace("_", "-")
+        if field.type in (bool, "bool"):
+            parser.add_argument(flag, type=lambda v: v.lower() in ("1", "true", "yes", "on"), default=field.default)
+        else:
+            parser.add_argument(flag, type=type(field.default), default=field.default)
+
+
+def profile_from_args(args: argparse.Namespace) -> UpstreamProfile:
+    return UpstreamProfile(**{field.name: getattr(args, field.name) for field in fields(UpstreamProfile)})
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="百度 OCR 与 DeepSeek 的本地替身服务，用于离线压测")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--ocr-fixtures", help="回放的 OCR 样本目录，默认 benchmarks/fixtures 下的合成样本")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    server = FakeUpstreams(profile_from_args(args), args.ocr_fixtures).serve(args.host, args.port)
+    base = f"http://{args.host}:{server.server_address[1]}"
+    print("让应用指向本服务：", file=sys.stderr)
+    print(f"  BAIDU_BASE_URL={base} DEEPSEEK_BASE_URL={base}/v1 BAIDU_OCR_API_KEY=x BAIDU_OCR_SECRET_KEY=x DEEPSEEK_API_KEY=x", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
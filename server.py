@@ -0,0 +1,190 @@
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+from fastapi import FastAPI, File, HTTPException, Request, UploadFile
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
+
+import app as sq
+
+
+class AnalyzeRequest(BaseModel):
+    transcript: str
+    style_mode: Optional[str] = None
+    model: str = "deepseek-chat"
+    stream: bool = True
+
+
+@asynccontextmanager
+async def lifespan(api: FastAPI) -> AsyncIterator[None]:
+    # 报告与页面共用 app.stream_analyze_chat，放在专用线程池里跑；打到上游的 LLM 并发仍由 app.llm_slot 统一限制，
+    # 这里的线程数只限制同时在生成的报告请求，免得占满事件循环默认线程池、饿死 /ocr
+    api.state.report_executor = ThreadPoolExecutor(
+        max_workers=max(1, sq.get_int_setting("API_MAX_CONCURRENT_LLM", 32)),
+        thread_name_prefix="sq-api-report",
+    )
+    api.state.ocr_semaphore = asyncio.Semaphore(max(1, sq.get_int_setting("API_MAX_CONCURRENT_OCR", 8)))
+    yield
+    api.state.report_executor.shutdown(wait=False, cancel_futures=True)
+
+
+# 启动：uvicorn server:api --host 0.0.0.0 --port 8000（依赖见 requirements-server.txt）
+api = FastAPI(title="Sober Queen API", lifespan=lifespan)
+
+
+def error_status(e: Exception) -> int:
+    message = str(e)
+    if message.startswith("missing_secret:"):
+        return 503
+    if message == "transcript_too_short":
+        return 422
+    if message.startswith("rate_limited:"):
+        return 429
+    if message.startswith("circuit_open:"):
+        return 503
+    if message == "deadline_exceeded":
+        return 504
+    return 502
+
+
+def session_key(request: Request) -> str:
+    # 上游限流按调用方轮流放行：优先用调用方自带的会话标识，否则按来源地址
+    return request.headers.get("X-Session-Id") or (request.client.host if request.client else "anonymous")
+
+
+async def stream_report(
+    transcript: str,
+    model: str,
+    style_mode: Optional[str],
+    usage: dict,
+    session_id: str,
+) -> AsyncIterator[str]:
+    # 同步生成器整个放在一个工作线程里跑（span、deadline 等 contextvars 都在同一个上下文里设置和复原），
+    # 每段输出经队列交回事件循环；缓存、map-reduce、llm_slot 名额、对冲与链路埋点全部沿用页面的实现
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    stop = threading.Event()
+
+    def emit(item: tuple) -> None:
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            # 事件循环已关闭（服务退出），没人再读了
+            stop.set()
+
+    def produce() -> None:
+        sq.CURRENT_SESSION.set(session_id)
+        try:
+            with sq.start_trace("report", detached=True), sq.deadline_scope(sq.get_float_setting("ANALYZE_DEADLINE_SECONDS", 180)):
+                stream = sq.stream_analyze_chat(transcript, model, style_mode, usage_sink=usage)
+                try:
+                    for delta in stream:
+                        if stop.is_set():
+                            return
+                        emit(("delta", delta))
+                finally:
+                    # 客户端断开时及时关掉上游连接、归还名额
+                    stream.close()
+        except Exception as e:
+            emit(("error", e))
+            return
+        emit(("done", None))
+
+    future = sq.submit_with_context(api.state.report_executor, produce)
+    try:
+        while True:
+            kind, value = await queue.get()
+            if kind == "delta":
+                yield value
+            elif kind == "error":
+                raise value
+            else:
+                return
+    finally:
+        stop.set()
+        future.cancel()
+
+
+def sse_event(event: str, payload: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+@api.get("/health")
+async def health() -> dict:
+    usage = sq.get_usage_stats().snapshot()
+    return {
+        "status": "ok",
+        "ocr_cache": sq.get_ocr_cache().memory.stats(),
+        "report_cache": sq.get_report_cache().stats(),
+        "llm_calls": usage["calls"],
+        "prompt_cache_hit_rate": usage["prompt_cache_hit_rate"],
+        "upstream_queues": {name: sq.get_upstream_limiter(name).stats() for name in sq.UPSTREAM_RATE_SETTINGS},
+        "circuits": {name: sq.get_circuit_breaker(name).stats() for name in sq.UPSTREAM_RATE_SETTINGS},
+        "ocr_backends": sq.get_ocr_router().stats(),
+    }
+
+
+@api.get("/metrics", response_class=PlainTextResponse)
+async def metrics() -> PlainTextResponse:
+    # Prometheus 文本格式：各阶段耗时直方图、token 与字节计数、限流队列、熔断与缓存状态
+    return PlainTextResponse(sq.render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+@api.post("/ocr")
+async def ocr(request: Request, files: list[UploadFile] = File(...)) -> dict:
+    max_images = sq.get_int_setting("API_MAX_IMAGES", 20)
+    if len(files) > max_images:
+        raise HTTPException(status_code=413, detail=f"too_many_images:{max_images}")
+
+    ordered = sorted(files, key=lambda f: (f.filename or "").lower())
+    images = [(f.filename or f"image{idx}", await f.read()) for idx, f in enumerate(ordered, start=1)]
+    sq.CURRENT_SESSION.set(session_key(request))
+    async with api.state.ocr_semaphore:
+        try:
+            transcript, dedupe_stats = await asyncio.to_thread(sq.transcribe_screenshots, images)
+        except RuntimeError as e:
+            raise HTTPException(status_code=error_status(e), detail=str(e))
+    return {"transcript": transcript, "dedupe": dedupe_stats, "images": len(images)}
+
+
+@api.post("/analyze")
+async def analyze(req: AnalyzeRequest, request: Request):
+    session_id = session_key(request)
+    prepared = sq.prepare_transcript(req.transcript)
+    if len(prepared.text.strip()) < 10:
+        raise HTTPException(status_code=422, detail="transcript_too_short")
+    style_mode = sq.normalize_style_mode(req.style_mode)
+    meta = {"style_mode": style_mode, "model": req.model, "transcript_tokens": prepared.tokens, "truncated": prepared.truncated}
+
+    if not req.stream:
+        usage: dict = {}
+        try:
+            report = "".join([delta async for delta in stream_report(prepared.text, req.model, style_mode, usage, session_id)])
+        except Exception as e:
+            raise HTTPException(status_code=error_status(e), detail=str(e))
+        report = sq.sanitize_report_markdown(report)
+        return {"report": report, "sections": sq.parse_report(report).to_dict()["sections"], "usage": usage, **meta}
+
+    async def events() -> AsyncIterator[str]:
+        usage: dict = {}
+        chunks: list[str] = []
+        yield sse_event("meta", meta)
+        try:
+            async for delta in stream_report(prepared.text, req.model, style_mode, usage, session_id):
+                chunks.append(delta)
+                yield sse_event("delta", {"text": delta})
+        except Exception as e:
+            yield sse_event("error", {"error": str(e), "status": error_status(e)})
+            return
+        report = sq.sanitize_report_markdown("".join(chunks))
+        yield sse_event("done", {"report": report, "sections": sq.parse_report(report).to_dict()["sections"], "usage": usage})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
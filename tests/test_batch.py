@@ -0,0 +1,29 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+import batch  # noqa: E402
+
+
+def test_full_run_after_ocr_only_run_still_analyzes(tmp_path, monkeypatch):
+    calls = []
+
+    def fake_diagnose(transcript, model="deepseek-chat", style_mode=None):
+        calls.append(transcript)
+        return {"report": "#### 📍 1. 情境", "style_mode": style_mode}
+
+    monkeypatch.setattr(app, "diagnose_transcript", fake_diagnose)
+    source = tmp_path / "in.jsonl"
+    source.write_text(json.dumps({"id": "a", "transcript": "我：你好\n对方：在吗"}, ensure_ascii=False) + "\n", encoding="utf-8")
+    output = tmp_path / "out.jsonl"
+
+    assert batch.main(["transcripts", str(source), "-o", str(output), "--ocr-only"]) == 0
+    assert calls == []
+    assert batch.main(["transcripts", str(source), "-o", str(output)]) == 0
+    assert len(calls) == 1
+    assert batch.main(["transcripts", str(source), "-o", str(output)]) == 0
+    assert batch.main(["transcripts", str(source), "-o", str(output), "--ocr-only"]) == 0
+    assert len(calls) == 1
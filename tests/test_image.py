@@ -0,0 +1,44 @@
+import io
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def noise_png(width: int, height: int) -> bytes:
+    pixels = np.random.default_rng(3).integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(pixels).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def test_image_is_split_into_tiles_within_budget():
+    prepared = app.prepare_image_for_ocr(noise_png(200, 900), max_width=200, budget_bytes=256 * 1024, max_tile_height=400, tile_overlap=40)
+    assert len(prepared.tiles) == len(app.tile_ranges(prepared.height, 400, 40)) > 1
+
+
+def test_image_over_budget_is_rejected_instead_of_truncated():
+    with pytest.raises(RuntimeError, match="^image_over_budget:"):
+        app.prepare_image_for_ocr(noise_png(200, 900), max_width=200, budget_bytes=64, max_tile_height=400, tile_overlap=40)
+
+
+@pytest.mark.parametrize("size", [(1080, 2340), (1170, 2532)])
+def test_ordinary_screenshot_is_a_single_tile(size):
+    buf = io.BytesIO()
+    Image.new("RGB", size, (237, 237, 237)).save(buf, format="PNG")
+    prepared = app.prepare_image_for_ocr(buf.getvalue())
+    assert len(prepared.tiles) == 1
+
+
+def test_long_capture_is_split_evenly():
+    ranges = app.tile_ranges(10000, 4096, 160)
+    assert ranges[0][0] == 0 and ranges[-1][1] == 10000
+    assert all(bottom - top <= 4096 for top, bottom in ranges)
+    assert len({bottom - top for top, bottom in ranges}) == 1
+    assert all(prev[1] - cur[0] == 160 for prev, cur in zip(ranges, ranges[1:]))
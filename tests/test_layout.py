@@ -0,0 +1,37 @@
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def _random_layout(rng: random.Random, count: int, width: int) -> tuple[list[str], list[tuple[int, int, int, int]]]:
+    texts: list[str] = []
+    boxes: list[tuple[int, int, int, int]] = []
+    top = 0
+    for i in range(count):
+        height = rng.choice([0, 20, 28, 36])
+        if rng.random() < 0.1:
+            texts.append(rng.choice(["昨天 21:03", "12:30", "星期二 08:15"]))
+            boxes.append((top, width // 2 - 60, 120, height))
+        else:
+            box_width = rng.randint(40, width // 2)
+            left = rng.choice([24, 30, width - 24 - box_width, rng.randint(0, width - box_width)])
+            texts.append(f"消息{i}")
+            boxes.append((top, left, box_width, height))
+        top += rng.choice([-4, 0, 2, 5, 12, 40])
+    return texts, boxes
+
+
+def test_small_and_vectorized_layout_agree():
+    rng = random.Random(7)
+    for _ in range(200):
+        width = rng.choice([720, 1080])
+        texts, boxes = _random_layout(rng, rng.randint(1, 60), width)
+        assert app._layout_dialogue_small(texts, boxes, width) == app._layout_dialogue_vectorized(texts, boxes, width)
+
+
+def test_single_bubble_layout():
+    assert app.layout_dialogue(["好的"], [(100, 30, 80, 30)], 1080) == "【对方】: 好的"
@@ -0,0 +1,59 @@
+import io
+import os
+import sys
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+class StaticBackend(app.OcrBackend):
+    name = "static"
+    breaker_name = "static_ocr"
+
+    def recognize(self, image_bytes):
+        return [app.OcrBox(text="在吗", left=10, top=100, width=80, height=30)]
+
+
+def blank_png(color):
+    buf = io.BytesIO()
+    Image.new("RGB", (200, 300), color).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def test_backend_must_implement_recognize():
+    with pytest.raises(TypeError):
+        app.OcrBackend()
+
+
+def test_tesseract_is_opt_in(monkeypatch):
+    monkeypatch.delenv("OCR_BACKENDS", raising=False)
+    assert app.ocr_backend_names() == ["baidu"]
+
+
+def test_local_only_ocr_does_not_need_baidu_keys(monkeypatch):
+    monkeypatch.setenv("OCR_BACKENDS", "tesseract")
+    monkeypatch.delenv("BAIDU_OCR_API_KEY", raising=False)
+    monkeypatch.delenv("BAIDU_OCR_SECRET_KEY", raising=False)
+    monkeypatch.setattr(app, "get_local_ocr_backend", lambda: StaticBackend())
+
+    transcript, _ = app.transcribe_screenshots([("a.png", blank_png((250, 240, 230)))])
+
+    assert "在吗" in transcript
+
+
+def test_router_skips_open_breaker():
+    breaker = app.get_circuit_breaker("static_ocr")
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    try:
+        assert breaker.is_open()
+        local = StaticBackend()
+        other = StaticBackend()
+        other.breaker_name = "other_ocr"
+        assert app.OcrRouter().rank([local, other], 1000) == [other, local]
+    finally:
+        breaker.record_success()
@@ -0,0 +1,65 @@
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def make_cache(persist_dir, ttl_seconds=0, **limits):
+    return app.OcrResultCache(app.LRUCache(max_entries=64, ttl_seconds=ttl_seconds), persist_dir=str(persist_dir), **limits)
+
+
+def put(cache, digest):
+    cache.put(digest, [app.OcrBox(text="在吗", left=10, top=100, width=80, height=30)], "【对方】: 在吗", 1080)
+
+
+def test_disk_tier_keeps_newest_entries_within_limit(tmp_path):
+    cache = make_cache(tmp_path, max_disk_entries=2)
+    for digest in ("a", "b", "c"):
+        put(cache, digest)
+    assert sorted(os.listdir(tmp_path)) == ["b.json", "c.json"]
+
+
+def test_disk_tier_respects_byte_limit(tmp_path):
+    put(make_cache(tmp_path), "probe")
+    size = os.path.getsize(tmp_path / "probe.json")
+    os.remove(tmp_path / "probe.json")
+
+    cache = make_cache(tmp_path, max_disk_bytes=size * 5 // 2)
+    for digest in ("a", "b", "c"):
+        put(cache, digest)
+    assert sorted(os.listdir(tmp_path)) == ["b.json", "c.json"]
+
+
+def test_limits_apply_to_files_left_by_earlier_processes(tmp_path):
+    earlier = make_cache(tmp_path)
+    for i, digest in enumerate(("a", "b", "c")):
+        put(earlier, digest)
+        os.utime(tmp_path / f"{digest}.json", (1000 + i, 1000 + i))
+
+    make_cache(tmp_path, max_disk_entries=1)
+    assert os.listdir(tmp_path) == ["c.json"]
+
+
+def test_expired_files_are_removed_on_write(tmp_path):
+    cache = make_cache(tmp_path, ttl_seconds=60)
+    put(cache, "old")
+    cache._disk["old"] = (time.time() - 120, cache._disk["old"][1])
+    put(cache, "new")
+    assert os.listdir(tmp_path) == ["new.json"]
+
+
+def test_disk_hit_keeps_original_expiry(tmp_path):
+    put(make_cache(tmp_path), "a")
+    path = tmp_path / "a.json"
+    entry = json.loads(path.read_text(encoding="utf-8"))
+    entry["created_at"] = time.time() - 59.7
+    path.write_text(json.dumps(entry, ensure_ascii=False), encoding="utf-8")
+
+    cache = make_cache(tmp_path, ttl_seconds=60)
+    assert cache.get("a") is not None
+    time.sleep(0.5)
+    assert cache.memory.get("a") is None
@@ -0,0 +1,135 @@
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def test_caller_errors_do_not_trip_breaker():
+    assert not app.counts_as_upstream_failure(app.upstream_http_error("baidu_ocr_http", 403))
+    assert not app.counts_as_upstream_failure(RuntimeError("baidu_ocr_error:110:Access token invalid or no longer valid"))
+    assert not app.counts_as_upstream_failure(RuntimeError("baidu_ocr_error:17:Open api daily request limit reached"))
+    assert not app.counts_as_upstream_failure(RuntimeError("baidu_ocr_error:216201:image format error"))
+
+
+def test_upstream_errors_trip_breaker():
+    assert app.counts_as_upstream_failure(app.upstream_http_error("baidu_ocr_http", 502))
+    assert app.counts_as_upstream_failure(app.upstream_http_error("baidu_ocr_http", 429))
+    assert app.counts_as_upstream_failure(RuntimeError("baidu_ocr_error:282000:internal error"))
+    assert app.counts_as_upstream_failure(RuntimeError("baidu_ocr_error:1:Unknown error"))
+
+
+class FakeResponse:
+    def __init__(self, data, status_code=200):
+        self.data = data
+        self.status_code = status_code
+
+    def json(self):
+        return self.data
+
+
+class FakeSession:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.urls = []
+
+    def post(self, url, **kwargs):
+        self.urls.append(url)
+        return self.responses.pop(0)
+
+
+def test_expired_token_is_renewed_once(monkeypatch):
+    tokens = iter(["fresh", "fresher"])
+    monkeypatch.setattr(app, "fetch_baidu_access_token", lambda api_key, secret_key: (next(tokens), 1e12))
+    session = FakeSession([
+        FakeResponse({"error_code": 111, "error_msg": "Access token expired"}),
+        FakeResponse({"words_result": []}),
+    ])
+    monkeypatch.setattr(app, "get_baidu_http_session", lambda: session)
+
+    data = app.baidu_general_ocr(b"img", "renew-ak", "renew-sk", access_token="stale")
+
+    assert data == {"words_result": []}
+    assert [url.rsplit("=", 1)[1] for url in session.urls] == ["stale", "fresh"]
+
+
+def test_token_error_after_renewal_is_raised(monkeypatch):
+    monkeypatch.setattr(app, "fetch_baidu_access_token", lambda api_key, secret_key: ("fresh", 1e12))
+    session = FakeSession([FakeResponse({"error_code": 110, "error_msg": "Access token invalid"})] * 2)
+    monkeypatch.setattr(app, "get_baidu_http_session", lambda: session)
+
+    with pytest.raises(RuntimeError, match="^baidu_ocr_error:110:"):
+        app.baidu_general_ocr(b"img", "bad-ak", "bad-sk", access_token="stale")
+    assert len(session.urls) == 2
+
+
+def test_llm_slot_times_out_when_process_cap_is_reached(monkeypatch):
+    slots = threading.BoundedSemaphore(1)
+    monkeypatch.setattr(app, "get_llm_slots", lambda: slots)
+    with app.llm_slot():
+        with app.deadline_scope(0.05), pytest.raises(RuntimeError, match="^rate_limited:llm_concurrency$"):
+            with app.llm_slot():
+                pass
+    with app.llm_slot():
+        pass
+
+
+def test_speculative_wait_cancels_queued_generation():
+    batch = app.SpeculativeBatch("我：你好", "deepseek-chat")
+    batch.futures["sister_support"] = Future()
+    running = Future()
+    running.set_running_or_notify_cancel()
+    batch.futures["cold_boundary"] = running
+
+    assert batch.wait("sister_support", timeout=0.01) is False
+    assert batch.futures["sister_support"].cancelled()
+    assert batch.wait("cold_boundary", timeout=0.01) is False
+    running.set_result(None)
+    assert batch.wait("cold_boundary", timeout=0.01) is True
+
+
+def test_concurrent_chunk_extraction_calls_model_once(monkeypatch):
+    calls = []
+
+    def fake_complete_chat(messages, model, label="report", usage_sink=None):
+        calls.append(messages[-1]["content"])
+        time.sleep(0.1)
+        return "要点"
+
+    monkeypatch.setattr(app, "complete_chat", fake_complete_chat)
+    chunk = f"我：单飞测试 {time.time()}"
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(app.extract_chunk_notes(chunk, "deepseek-chat"))) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == ["要点"] * 3
+    assert calls == [chunk]
+
+
+def test_http_session_only_retries_post_on_connect_errors():
+    retry = app.build_http_session(pool_size=1, max_retries=2, backoff_factor=0).get_adapter("https://example.com").max_retries
+    assert not retry._is_method_retryable("POST")
+    assert retry._is_method_retryable("GET")
+    assert retry.connect == 2
+
+
+def test_transient_ocr_status_is_retried_through_limiter(monkeypatch):
+    monkeypatch.setenv("BAIDU_QPS_BACKOFF_SECONDS", "0")
+    session = FakeSession([FakeResponse(None, status_code=502), FakeResponse({"words_result": []})])
+    monkeypatch.setattr(app, "get_baidu_http_session", lambda: session)
+    acquired = []
+    limiter = app.get_upstream_limiter("baidu_ocr")
+    monkeypatch.setattr(limiter, "acquire", lambda *args, **kwargs: acquired.append(1))
+
+    assert app.baidu_general_ocr(b"img", "retry-ak", "retry-sk", access_token="t") == {"words_result": []}
+    assert len(session.urls) == 2
+    assert len(acquired) == 2
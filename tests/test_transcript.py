@@ -0,0 +1,56 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def test_message_mentioning_pat_is_kept():
+    transcript = "【我】: 你拍了拍我干嘛，我在开会\n对方拍了拍我\n“阿哲” 撤回了一条消息\n以下为新消息"
+    assert app.compact_transcript(transcript) == "【我】: 你拍了拍我干嘛，我在开会"
+
+
+def test_untagged_message_mentioning_recall_is_kept():
+    transcript = "我：好的\n你为什么撤回了一条消息，我都看到了"
+    assert app.compact_transcript(transcript) == "【我】: 好的\n你为什么撤回了一条消息，我都看到了"
+
+
+def test_colon_in_export_block_is_not_a_speaker():
+    transcript = "阿哲 2024-02-16 21:03:12\n结论：你就是不在乎我\n我 2024-02-16 21:04:00\n不是这样的"
+    assert app.compact_transcript(transcript) == "【阿哲】: 结论：你就是不在乎我\n【我】: 不是这样的"
+
+
+def test_chunks_split_only_at_speaker_turns():
+    transcript = app.compact_transcript("我：我想了一晚上\n结论：你就是不在乎我\n对方：不是这样的")
+    chunks = app.split_transcript_chunks(transcript, max_tokens=1)
+    assert chunks == ["【我】: 我想了一晚上\n结论：你就是不在乎我", "【对方】: 不是这样的"]
+
+
+def regex_only_is_timestamp_line(text):
+    # 加首字符预筛之前的判断方式
+    t = (text or "").strip()
+    return not t or (len(t) <= 24 and app.TIMESTAMP_RE.match(app.WHITESPACE_RE.sub(" ", t)) is not None)
+
+
+def test_timestamp_prefilter_matches_regex_only_check():
+    samples = [
+        "12:30", "１２:３０", "下午 3:05", "下午 ３:０５", "星期三 21:04", "2024-02-16 21:03", "２０２４-０２-１６",
+        "3月8日 10:00", "昨天 23:59", "٣:٤٥", "", "   ", "我：12:30 见", "上班了吗", "今天好累啊", "好的", "12点见",
+    ]
+    for text in samples:
+        assert app.is_timestamp_line(text) == regex_only_is_timestamp_line(text), text
+    assert app.is_timestamp_line("１２:３０")
+
+
+def test_tagged_line_ending_in_date_is_not_an_export_header():
+    assert app.compact_transcript("【我】: 那就约在 2024-02-16 21:03\n【对方】: 好") == "【我】: 那就约在 2024-02-16 21:03\n【对方】: 好"
+
+
+def test_untagged_line_after_tagged_date_line_keeps_no_speaker():
+    assert app.compact_transcript("【我】: 那就约在 2024-02-16 21:03\n不然改天") == "【我】: 那就约在 2024-02-16 21:03\n不然改天"
+
+
+def test_tagged_line_ends_export_block():
+    transcript = "阿哲 2024-02-16 21:03:12\n在吗\n【我】: 在\n你呢"
+    assert app.compact_transcript(transcript) == "【阿哲】: 在吗\n【我】: 在\n你呢"